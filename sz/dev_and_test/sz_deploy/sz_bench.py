@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    sz_deploy.py 的部署性能基准测试, 不需要真实的目标主机/容器
+    1. 在本机启动一个基于 paramiko 的 ssh/sftp 服务 (独立进程), 模拟目标主机
+    2. 目标主机上的 /sz/apps, /sz/deploy, /etc/nginx/conf.d 等目录, 映射到临时目录下 (通过 SZ_SETUP_ROOT 环境变量)
+    3. supervisorctl, nginx, chown 由临时目录下的假命令代替, 只记录状态, 不运行真正的进程
+    4. 按场景生成固定随机种子的合成制品/配置文件/web 应用, 端到端的调用 deploy_app_zip, deploy_conf, cmd_install_web_app
+    5. 每个场景分三个阶段: cold (首次部署), noop (内容没有变化, 再次部署), delta (修改一个文件后再次部署)
+       输出各阶段的耗时, 吞吐量, 实际传输的字节数, 目标主机的 CPU 时间, 写入的字节数, 以及磁盘占用
+
+    用法:
+        python3 sz_bench.py --list
+        python3 sz_bench.py --scenario app-50m --scenario web-1k --repeat 3 --json bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+from typing import List
+
+import paramiko
+from colorama import Fore
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, SFTP_OK
+
+import sz_deploy
+
+# 场景名称: (类型, 总大小(MB), 文件数量)
+bench_scenarios = {
+    'app-1m': ('app', 1, 10),
+    'app-50m': ('app', 50, 1000),
+    'app-500m': ('app', 500, 50000),
+    'conf-10': ('conf', 1, 10),
+    'conf-1k': ('conf', 10, 1000),
+    'web-10': ('web', 1, 10),
+    'web-1k': ('web', 20, 1000),
+    'web-50k': ('web', 200, 50000),
+}
+
+# 不指定 --scenario 时, 默认运行的场景 (不包含几百 MB 的大场景)
+default_scenarios = ['app-1m', 'app-50m', 'conf-10', 'conf-1k', 'web-10', 'web-1k']
+
+bench_app_name = 'bench_app'
+
+# 合成数据使用固定的随机种子, 保证每次运行的输入完全一致
+bench_seed = 20200101
+
+# zip 条目使用固定的时间戳, 相同的输入生成完全相同的 zip 文件
+zip_date_time = (2020, 1, 1, 0, 0, 0)
+
+# sz_deploy.py 中需要映射到临时根目录下的目标主机路径
+deploy_path_names = ['setup_script_path', 'supervisor_conf_dir', 'apps_dir', 'app_configs_dir', 'apps_zip_dir',
+                     'artifact_store_dir', 'manifests_dir', 'nginx_conf_dir', 'web_apps_dir', 'web_snippets_dir']
+deploy_paths = {name: getattr(sz_deploy, name) for name in deploy_path_names}
+
+fake_supervisorctl = '''#!/bin/sh
+# 基准测试用的 supervisorctl: 只记录进程状态, 不运行真正的进程
+state_dir="$SZ_SETUP_ROOT/var/fake_supervisor"
+mkdir -p "$state_dir"
+action="$1"
+shift
+for name in "$@"; do
+    # 单实例的应用, 进程组 <应用名称>:* 只有一个进程 <应用名称>
+    name="${name%:\*}"
+    case "$action" in
+        start) echo RUNNING > "$state_dir/$name"; echo "$name: started" ;;
+        stop) echo STOPPED > "$state_dir/$name"; echo "$name: stopped" ;;
+        status)
+            state=$(cat "$state_dir/$name" 2>/dev/null || echo STOPPED)
+            echo "$name    $state    pid 1, uptime 0:00:01" ;;
+    esac
+done
+exit 0
+'''
+
+fake_noop = '''#!/bin/sh
+exit 0
+'''
+
+
+def info(msg: str):
+    print(Fore.BLUE + '==> ' + Fore.RESET + Fore.GREEN + msg + Fore.RESET)
+
+
+# <editor-fold desc="模拟目标主机的 ssh/sftp 服务">
+
+class BenchSSHServer(paramiko.ServerInterface):
+    """
+    接受任意公钥认证, exec 请求在本机执行, 执行时带上 SZ_SETUP_ROOT 环境变量和假命令目录
+    """
+
+    def __init__(self, env: dict):
+        self.env = env
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target = exec_channel, args = (channel, command.decode('utf-8'), self.env),
+                         daemon = True).start()
+        return True
+
+
+def exec_channel(channel: paramiko.Channel, cmd: str, env: dict):
+    p = subprocess.Popen(['bash', '-c', cmd], stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                         stderr = subprocess.PIPE, env = env)
+
+    def pump_stdin():
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                p.stdin.write(data)
+                p.stdin.flush()
+        except (OSError, ValueError):
+            pass
+        with contextlib.suppress(OSError):
+            p.stdin.close()
+
+    def pump_stderr():
+        for data in iter(lambda: p.stderr.read1(65536), b''):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target = pump_stdin, daemon = True).start()
+    stderr_thread = threading.Thread(target = pump_stderr, daemon = True)
+    stderr_thread.start()
+    for data in iter(lambda: p.stdout.read1(65536), b''):
+        channel.sendall(data)
+    stderr_thread.join()
+    channel.send_exit_status(p.wait())
+    channel.close()
+
+
+class BenchSFTPHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+def sftp_errors(func):
+    """
+    将本机文件操作的 OSError 转换为 sftp 错误码
+    """
+
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    return wrapper
+
+
+class BenchSFTPServer(SFTPServerInterface):
+    """
+    直接操作本机文件的 sftp 服务, 部署端使用的已经是映射到临时根目录下的路径
+    """
+
+    @sftp_errors
+    def list_folder(self, path):
+        attrs = []
+        for name in os.listdir(path):
+            attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+            attr.filename = name
+            attrs.append(attr)
+        return attrs
+
+    @sftp_errors
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    @sftp_errors
+    def lstat(self, path):
+        return SFTPAttributes.from_stat(os.lstat(path))
+
+    @sftp_errors
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0o666)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = BenchSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @sftp_errors
+    def remove(self, path):
+        os.remove(path)
+        return SFTP_OK
+
+    @sftp_errors
+    def rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    @sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+        return SFTP_OK
+
+    @sftp_errors
+    def rmdir(self, path):
+        os.rmdir(path)
+        return SFTP_OK
+
+    @sftp_errors
+    def chattr(self, path, attr):
+        if attr._flags & attr.FLAG_PERMISSIONS:
+            os.chmod(path, attr.st_mode)
+        if attr._flags & attr.FLAG_AMTIME:
+            os.utime(path, (attr.st_atime, attr.st_mtime))
+        return SFTP_OK
+
+    @sftp_errors
+    def symlink(self, target_path, path):
+        os.symlink(target_path, path)
+        return SFTP_OK
+
+    @sftp_errors
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if path.startswith('/') else '/' + path)
+
+
+def serve(root: str):
+    """
+    模拟目标主机的 ssh/sftp 服务进程入口, 监听本机的随机端口, 端口号输出到 stdout 的第一行
+    """
+    bin_dir = os.path.join(root, 'bench_bin')
+    env = dict(os.environ)
+    env['SZ_SETUP_ROOT'] = root
+    env['PATH'] = f'{bin_dir}:{env.get("PATH", "/usr/bin:/bin")}'
+    host_key = paramiko.RSAKey.generate(2048)
+    # 部署端断开连接时的 socket 异常不需要输出
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    print(sock.getsockname()[1], flush = True)
+    while True:
+        conn, _ = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTPServer)
+        transport.start_server(server = BenchSSHServer(env))
+
+
+class BenchTarget(object):
+    """
+    一个模拟的目标主机: 临时根目录 + ssh/sftp 服务进程. 服务进程执行的所有命令 (包括 sz_setup.py agent) 都是它的子进程,
+    子进程退出后, 其 CPU 时间和 IO 字节数都会累计到服务进程上, 从 /proc 中可以读取
+    """
+
+    def __init__(self, work_dir: str):
+        self.root = os.path.join(work_dir, 'target')
+        bin_dir = os.path.join(self.root, 'bench_bin')
+        os.makedirs(bin_dir)
+        for name, content in [('supervisorctl', fake_supervisorctl), ('nginx', fake_noop), ('chown', fake_noop)]:
+            fpath = os.path.join(bin_dir, name)
+            with open(fpath, 'w') as f:
+                f.write(content)
+            os.chmod(fpath, 0o755)
+        for name in ['etc/supervisor/conf.d', 'etc/nginx/conf.d']:
+            os.makedirs(os.path.join(self.root, name))
+
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', self.root],
+                                     stdout = subprocess.PIPE)
+        self.port = int(self.proc.stdout.readline())
+
+    def usage(self) -> dict:
+        """
+        服务进程及其已退出子进程累计的 CPU 时间(秒) 和写入字节数
+        """
+        self.wait_children()
+        with open(f'/proc/{self.proc.pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        # utime, stime, cutime, cstime
+        cpu = sum([int(v) for v in fields[11:15]]) / ticks
+        io_stats = {}
+        with open(f'/proc/{self.proc.pid}/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                io_stats[key] = int(value)
+        return {'cpu': cpu, 'wchar': io_stats['wchar'], 'write_bytes': io_stats['write_bytes']}
+
+    def wait_children(self, timeout: float = 5.0):
+        """
+        ssh 连接关闭后, 服务进程回收子进程是异步的, 等待子进程全部退出后再读取统计信息
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            children = ''
+            for tid in os.listdir(f'/proc/{self.proc.pid}/task'):
+                with contextlib.suppress(IOError):
+                    with open(f'/proc/{self.proc.pid}/task/{tid}/children', 'r') as f:
+                        children += f.read().strip()
+            if children == '':
+                return
+            time.sleep(0.05)
+
+    def disk_usage(self) -> int:
+        """
+        临时根目录下 (不含假命令) 实际占用的磁盘空间, 硬链接只计算一次
+        """
+        seen = set()
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+        return total
+
+    def close(self):
+        self.proc.kill()
+        self.proc.wait()
+
+# </editor-fold>
+
+
+# <editor-fold desc="合成数据">
+
+def random_bytes(seed: str, size: int) -> bytes:
+    return random.Random(f'{bench_seed}:{seed}').randbytes(size)
+
+
+def file_sizes(total_mb: int, files: int) -> List[int]:
+    total = total_mb * 1024 * 1024
+    return [max(1, total // files)] * files
+
+
+def write_app_zip(zip_path: str, total_mb: int, files: int, revision: int = 0):
+    """
+    生成与 gradle distZip 结构一致的应用 zip 包: <应用名称>/bin, <应用名称>/lib, <应用名称>/conf.
+    jar 本身已经是压缩格式, 所以 lib 下的文件使用随机内容, 不再压缩存储. revision 不为 0 时, 只有第一个 jar 的内容不同
+    """
+    os.makedirs(os.path.dirname(zip_path), exist_ok = True)
+    sizes = file_sizes(total_mb, files)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr(zipfile.ZipInfo(f'{bench_app_name}/bin/{bench_app_name}', zip_date_time),
+                    '#!/bin/sh\nexec sleep 3600\n')
+        zf.writestr(zipfile.ZipInfo(f'{bench_app_name}/conf/app.conf', zip_date_time), 'bench = true\n')
+        for i, size in enumerate(sizes[2:]):
+            seed = f'lib:{i}:{revision}' if i == 0 else f'lib:{i}'
+            zf.writestr(zipfile.ZipInfo(f'{bench_app_name}/lib/lib_{i:05d}.jar', zip_date_time), random_bytes(seed, size))
+
+
+def write_files(dir_path: str, total_mb: int, files: int, suffix: str):
+    """
+    生成配置文件/web 应用目录, 每个子目录最多 100 个文件. 文件修改时间固定, 只有内容改变的文件才需要重新传输
+    """
+    for i, size in enumerate(file_sizes(total_mb, files)):
+        fpath = os.path.join(dir_path, f'd{i // 100:03d}', f'f{i:05d}{suffix}')
+        os.makedirs(os.path.dirname(fpath), exist_ok = True)
+        with open(fpath, 'wb') as f:
+            f.write(random_bytes(f'file:{i}', size))
+        os.utime(fpath, (1577836800, 1577836800))
+
+
+def touch_first_file(dir_path: str, suffix: str):
+    fpath = os.path.join(dir_path, 'd000', f'f00000{suffix}')
+    size = os.path.getsize(fpath)
+    with open(fpath, 'wb') as f:
+        f.write(random_bytes('file:0:changed', size))
+
+# </editor-fold>
+
+
+# <editor-fold desc="运行场景">
+
+def deploy_args(target: BenchTarget, ssh_key: str, **kwargs) -> argparse.Namespace:
+    """
+    与 sz_deploy.py 命令行一致的参数对象
+    """
+    parser = argparse.ArgumentParser()
+    sz_deploy.add_restart_args(parser)
+    sz_deploy.add_host_args(parser)
+    # 模拟的目标主机上应用进程不会真正运行, 不检查端口
+    args = parser.parse_args(['--ssh-key', ssh_key, '--port', str(target.port), '--no-ready-tcp'])
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def prebuilt_apps(prj_dir: str) -> List[sz_deploy.AppBuild]:
+    """
+    跳过 gradle 构建, 直接使用已经生成的 zip 包作为构建结果
+    """
+    app = sz_deploy.AppBuild(prj_dir)
+    app.future = Future()
+    app.future.set_result({'artifact_sha256': sz_deploy.file_sha256(app.zip_path)})
+    return [app]
+
+
+def run_phase(target: BenchTarget, action, args: argparse.Namespace, payload: int, verbose: bool) -> dict:
+    """
+    在模拟的目标主机上执行一次部署操作, 返回本次操作的各项指标
+    """
+    sz_deploy.tracer = sz_deploy.Tracer()
+    before = target.usage()
+    disk_before = target.disk_usage()
+    out = sys.stdout if verbose else io.StringIO()
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        result = sz_deploy.run_on_host('127.0.0.1', target.port, action, args)
+    elapsed = time.perf_counter() - begin
+    if not result.ok:
+        if not verbose:
+            print(out.getvalue())
+        raise Exception(f'部署操作失败 [return code: {result.exit_code}] {result.error}')
+    after = target.usage()
+
+    sent = sum([s['args'].get('bytes', 0) for s in sz_deploy.tracer.spans if s['cat'] == 'transfer'])
+    return {
+        'latency': elapsed,
+        'payload': payload,
+        'throughput': payload / elapsed,
+        'sent': sent,
+        'remote_cpu': after['cpu'] - before['cpu'],
+        'remote_wchar': after['wchar'] - before['wchar'],
+        'remote_write_bytes': after['write_bytes'] - before['write_bytes'],
+        'disk_growth': target.disk_usage() - disk_before
+    }
+
+
+def run_scenario(name: str, verbose: bool) -> dict:
+    """
+    在新的临时根目录和 ssh 服务上运行一次场景, 返回 {阶段: 指标}
+    """
+    kind, total_mb, files = bench_scenarios[name]
+    work_dir = tempfile.mkdtemp(prefix = 'sz_bench_')
+    target = BenchTarget(work_dir)
+    try:
+        ssh_key = os.path.join(work_dir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(ssh_key)
+        sz_deploy.local_state_dir = os.path.join(work_dir, 'state/')
+        sz_deploy.artifact_chunk_index.cache_clear()
+        for path_name, path in deploy_paths.items():
+            setattr(sz_deploy, path_name, f'{target.root}{path}')
+
+        prj_dir = os.path.join(work_dir, 'prj', bench_app_name)
+        zip_path = sz_deploy.app_zip_path(prj_dir)
+
+        def deploy_app(revision: int) -> dict:
+            write_app_zip(zip_path, total_mb, files, revision)
+            args = deploy_args(target, ssh_key, cmd_name = 'app', app_builds = prebuilt_apps(prj_dir),
+                               min_free_mb = 0, host_count = 1, failed_hosts = 0)
+            return run_phase(target, sz_deploy.deploy_app_zip, args, os.path.getsize(zip_path), verbose)
+
+        phases = {}
+        if kind == 'app':
+            phases['cold'] = deploy_app(0)
+            phases['noop'] = deploy_app(0)
+            phases['delta'] = deploy_app(1)
+        elif kind == 'conf':
+            # 配置文件部署的前提是应用已经部署, 这一步不计入结果
+            write_app_zip(zip_path, 1, 10)
+            run_phase(target, sz_deploy.deploy_app_zip,
+                      deploy_args(target, ssh_key, cmd_name = 'app', app_builds = prebuilt_apps(prj_dir),
+                                  min_free_mb = 0, host_count = 1, failed_hosts = 0), 0, verbose)
+            conf_dir = os.path.join(work_dir, 'conf')
+            write_files(conf_dir, total_mb, files, '.conf')
+            args = deploy_args(target, ssh_key, cmd_name = 'conf', prj_dir = prj_dir, conf_dir = conf_dir)
+            payload = total_mb * 1024 * 1024
+            phases['cold'] = run_phase(target, sz_deploy.deploy_conf, args, payload, verbose)
+            phases['noop'] = run_phase(target, sz_deploy.deploy_conf, args, payload, verbose)
+            touch_first_file(conf_dir, '.conf')
+            phases['delta'] = run_phase(target, sz_deploy.deploy_conf, args, payload, verbose)
+        else:
+            web_dir = os.path.join(work_dir, 'web', 'bench_web')
+            write_files(web_dir, total_mb, files, '.js')
+            args = deploy_args(target, ssh_key, cmd_name = 'install_web_app', web_app = web_dir, app_name = '')
+            payload = total_mb * 1024 * 1024
+            phases['cold'] = run_phase(target, sz_deploy.cmd_install_web_app, args, payload, verbose)
+            phases['noop'] = run_phase(target, sz_deploy.cmd_install_web_app, args, payload, verbose)
+            touch_first_file(web_dir, '.js')
+            phases['delta'] = run_phase(target, sz_deploy.cmd_install_web_app, args, payload, verbose)
+        return phases
+    finally:
+        target.close()
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+
+def median_phases(runs: List[dict]) -> dict:
+    """
+    多次运行时, 每个阶段的每项指标取中位数
+    """
+    result = {}
+    for phase in runs[0]:
+        result[phase] = {key: statistics.median([run[phase][key] for run in runs]) for key in runs[0][phase]}
+    return result
+
+
+def print_report(report: dict):
+    mb = 1024 * 1024
+    print()
+    print(f'{"scenario":<10} {"phase":<6} {"latency":>9} {"payload":>10} {"throughput":>12} {"sent":>10} '
+          f'{"remote cpu":>10} {"remote wchar":>12} {"disk growth":>11}')
+    for name, phases in report.items():
+        for phase, m in phases.items():
+            print(f'{name:<10} {phase:<6} {m["latency"]:8.2f}s {m["payload"] / mb:7.1f} MB {m["throughput"] / mb:7.1f} MB/s '
+                  f'{m["sent"] / mb:7.1f} MB {m["remote_cpu"]:9.2f}s {m["remote_wchar"] / mb:9.1f} MB '
+                  f'{m["disk_growth"] / mb:8.1f} MB')
+
+# </editor-fold>
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'sz_deploy.py 部署性能基准测试 (本机模拟目标主机)')
+    parser.add_argument('--scenario',
+                        help = f'要运行的场景, 可以重复指定多个, 默认: {", ".join(default_scenarios)}',
+                        action = 'append',
+                        choices = list(bench_scenarios.keys()))
+    parser.add_argument('--all',
+                        help = '运行所有场景 (包括几百 MB 的大场景)',
+                        action = 'store_true')
+    parser.add_argument('--list',
+                        help = '列出所有场景',
+                        action = 'store_true')
+    parser.add_argument('--repeat',
+                        help = '每个场景运行的次数, 各项指标取中位数, 默认: 1',
+                        type = int,
+                        default = 1)
+    parser.add_argument('--json',
+                        action = sz_deploy.PathArgAction,
+                        help = '将结果保存为 json 文件',
+                        metavar = '~/bench.json')
+    parser.add_argument('--verbose',
+                        help = '输出部署过程的详细信息',
+                        action = 'store_true')
+    parser.add_argument('--serve',
+                        help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    if args.list:
+        for name, (kind, total_mb, files) in bench_scenarios.items():
+            print(f'{name:<10} {kind:<5} {total_mb:4} MB {files:6} files')
+        return
+
+    names = args.scenario or (list(bench_scenarios.keys()) if args.all else default_scenarios)
+    report = {}
+    for name in names:
+        runs = []
+        for i in range(args.repeat):
+            info(f'[{name}] 第 {i + 1}/{args.repeat} 次运行')
+            runs.append(run_scenario(name, args.verbose))
+        report[name] = median_phases(runs)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'repeat': args.repeat, 'scenarios': report}, f, indent = 2)
+        info(f'结果已保存到: {args.json}')
+
+
+if __name__ == '__main__':
+    main()
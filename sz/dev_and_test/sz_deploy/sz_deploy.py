@@ -2,29 +2,470 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import codecs
+import collections
+import contextlib
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
 import io
+import json
 import os
+import posixpath
+import queue
+import re
+import select
+import shlex
+import shutil
+import signal
+import stat
 import subprocess
 import sys
-from typing import List
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import List, Tuple
 
 import paramiko
 from colorama import Fore
-from paramiko import SSHClient
+from paramiko import SFTPClient, SSHClient
 
-ssh_client: SSHClient = paramiko.SSHClient()
-ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+import sz_setup
 
-dest_host = 'localhost'
-ssh_port = 10022
-sshkey = os.path.expanduser('~/.ssh/id_rsa')
+try:
+    # 可选依赖: 安装了 brotli 模块时, install_web_app --brotli 才能生成 .br 预压缩文件
+    import brotli
+except ImportError:
+    brotli = None
+
+default_host = '127.0.0.1'
+default_ssh_port = 10022
+default_parallel = 8
+
+# ssh_cmd 出错时用于报告的输出行数 (只保留最后这么多行)
+default_tail_lines = 200
+# 等待输出到终端的行数上限, 终端输出跟不上时, 超出的行被丢弃, 不阻塞远程命令
+output_queue_size = 2000
+
+setup_script_path = '/usr/local/bin/sz_setup.py'
+
+# 计算构建指纹时忽略的 gradle 工程目录下的输出目录
+build_ignored_dirs = ['build', 'out', 'node_modules']
+
+# 本机保存部署状态(例如: 各主机上 sz_setup.py 的指纹)的目录
+local_state_dir = os.path.expanduser('~/.sz_deploy/')
 
 supervisor_conf_dir = '/etc/supervisor/conf.d/'
 apps_dir = '/sz/apps/'
 app_configs_dir = '/sz/deploy/configs/'
 apps_zip_dir = '/sz/deploy/zips/'
+artifact_store_dir = '/sz/deploy/zips/store/'
+manifests_dir = '/sz/deploy/manifests/'
 nginx_conf_dir = '/etc/nginx/conf.d/'
 web_apps_dir = '/web_html/'
+# install_web_app --precompress 生成的 nginx 配置片段所在的目录, 需要在 server {} 中 include
+web_snippets_dir = '/etc/nginx/sz_web/'
+
+# gen_nginx_conf 生成的 /builtinstatic/ 代理缓存 (proxy_cache_path 位于 http {} 中, 单独一个配置文件)
+nginx_cache_conf = 'sz_proxy_cache.conf'
+nginx_cache_zone = 'sz_static'
+nginx_cache_dir = '/var/cache/nginx/sz_static'
+
+# 需要预压缩的静态资源类型, 以及最小文件大小 (与 nginx gzip_min_length 的作用相同)
+web_compress_exts = ['.html', '.htm', '.css', '.js', '.mjs', '.json', '.map', '.svg', '.xml', '.txt', '.wasm',
+                     '.ico', '.ttf', '.otf', '.eot']
+web_compress_min_size = 1024
+# 文件名中带有内容 hash (16 进制) 的静态资源, 例如: main.3f2a9c1b.js (webpack).
+# vite 等使用 base64 hash (index-BfX3kQ2a.js) 的, 与普通单词无法区分, 由 --immutable_dir 指定目录
+hashed_name_pattern = re.compile(r'[.-]([0-9a-fA-F]{8,64})\.[A-Za-z0-9]+$')
+# 带 hash 的静态资源, 内容永远不会变化, 可以被浏览器长期缓存
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+
+class AgentUnavailable(Exception):
+    """
+    目标主机上的 sz_setup.py 不存在, 无法执行, 或者与本机的 sz_setup.py 不一致
+    """
+    pass
+
+
+class RemoteAgent(object):
+    """
+    目标主机上以 agent 模式常驻运行的 sz_setup.py, 一个 ssh 通道上可以连续发送多批操作, 每批操作一次往返.
+    协议说明见 sz_setup.py 中的 Agent 类
+    """
+
+    def __init__(self, client: SSHClient, script_sha256: str = ''):
+        self.channel = client.get_transport().open_session()
+        self.channel.exec_command(f'{setup_script_path} agent')
+        self.stdin = self.channel.makefile('wb')
+        self.stdout = self.channel.makefile('r')
+        self.req_id = 0
+        # 本机 sz_setup.py 的 sha256, 第一批操作时由 agent 校验
+        self.script_sha256 = script_sha256
+        # 不支持校验的旧版本 agent, 执行完第一批操作后需要重新上传
+        self.outdated = False
+
+    def call(self, ops: List[dict], on_log = None, on_result = None) -> Tuple[int, List[dict]]:
+        """
+        发送一批操作, 等待执行完毕
+
+        Parameters
+        ----------
+        ops : List[dict]
+            操作列表, 格式: {"argv": [...], "check": True}
+        on_log :
+            收到操作输出行时的回调函数 on_log(op_index, line)
+        on_result :
+            收到操作执行结果时的回调函数 on_result(result)
+
+        Returns
+        ----------
+        (int, List[dict])
+            元组: (整批操作的 exit code, 每个已执行操作的结果)
+        """
+        self.req_id += 1
+        req = {'id': self.req_id, 'ops': ops}
+        if self.req_id == 1 and self.script_sha256:
+            # agent 在第一次响应中校验, 不需要额外的往返
+            req['script'] = self.script_sha256
+        self.stdin.write((json.dumps(req, ensure_ascii = False) + '\n').encode('utf-8'))
+        self.stdin.flush()
+
+        results: List[dict] = []
+        while True:
+            line = self.stdout.readline()
+            if not line:
+                status = self.channel.recv_exit_status()
+                if status in (126, 127) and self.req_id == 1:
+                    raise AgentUnavailable(f'{setup_script_path} [exit status: {status}]')
+                raise Exception(f'sz_setup.py agent 意外退出 [exit status: {status}]')
+            msg = json.loads(line)
+            if msg.get('id') != self.req_id:
+                continue
+            if msg['type'] == 'log':
+                if on_log is not None:
+                    on_log(msg['op'], msg['line'])
+            elif msg['type'] == 'result':
+                results.append(msg)
+                if on_result is not None:
+                    on_result(msg)
+            elif msg['type'] == 'done':
+                if msg.get('mismatch'):
+                    raise AgentUnavailable(f'{setup_script_path} 与本机的不一致 [sha256: {msg.get("script", "")[:16]}]')
+                if self.req_id == 1 and self.script_sha256 and msg.get('script') != self.script_sha256:
+                    self.outdated = True
+                return (msg['code'], results)
+
+    def close(self):
+        self.stdin.close()
+        self.channel.close()
+
+
+class SSHSession(object):
+    """
+    到一台目标主机的 ssh 会话, 每台目标主机一个, 由执行该主机部署任务的线程持有
+    """
+
+    def __init__(self, host: str, port: int, ssh_key: str):
+        self.host = host
+        self.port = port
+        self.ssh_key = ssh_key
+        self.client: SSHClient = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._sftp: SFTPClient = None
+        self._agent: RemoteAgent = None
+        # 本机 sz_setup.py 的 sha256, 由 deploy_setup_script 设置
+        self.setup_script_sha256 = ''
+
+    @property
+    def tag(self) -> str:
+        if self.port == default_ssh_port:
+            return self.host
+        return host_label(self.host, self.port)
+
+    def connect(self):
+        self.client.connect(hostname = self.host, port = self.port,
+                            username = 'root', key_filename = self.ssh_key)
+
+    def sftp(self) -> SFTPClient:
+        """
+        在已经认证的 ssh 连接上打开 sftp 通道, 整个会话期间复用
+        """
+        if self._sftp is None:
+            self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def has_agent(self) -> bool:
+        return self._agent is not None
+
+    def reset_agent(self):
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
+
+    def agent(self) -> RemoteAgent:
+        """
+        启动(或者复用)目标主机上的 sz_setup.py agent, 整个会话期间复用
+        """
+        if self._agent is None:
+            self._agent = RemoteAgent(self.client, self.setup_script_sha256)
+        return self._agent
+
+    def close(self):
+        self.reset_agent()
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        self.client.close()
+
+
+class HostResult(object):
+    """
+    在一台目标主机上执行子命令的结果, 用于最后输出汇总
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.exit_code = 0
+        self.elapsed = 0.0
+        self.error = ''
+        # 子命令的返回值, 例如: status 子命令返回的状态快照
+        self.data = None
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+
+# 当前线程绑定的 ssh 会话, 每个目标主机的任务在独立的线程中执行
+_thread_ctx = threading.local()
+
+# 同时对多台主机执行子命令时, 输出信息需要带上主机标识
+show_host_tag = False
+
+# 忽略本机缓存的指纹, 强制检查并上传 sz_setup.py
+force_setup_script = False
+
+_state_lock = threading.Lock()
+
+# info/warn/err, 远程命令输出和耗时汇总的输出位置, None 表示 stdout; 输出 json 时改为 stderr, 保证 stdout 中只有 json
+log_file = None
+
+# 部署被取消时 (例如: 某个应用构建失败, 或者所有目标主机的准备工作都失败) 置位,
+# 本机正在执行的命令被终止, 还没有开始的命令不再执行
+cancel_event = threading.Event()
+
+# 本机正在执行的命令 (shell() 启动的进程), 取消部署时终止它们
+_local_procs = set()
+
+
+class Tracer(object):
+    """
+    记录部署过程中每个阶段的耗时 (span): 本机命令, ssh 命令, 文件传输, 目标主机上的 sz_setup.py 操作等.
+    每个 span 可以附带传输字节数, exit code 等信息, 最后可以导出为 Chrome trace 格式的 json 文件
+    (chrome://tracing 或者 https://ui.perfetto.dev 打开), 并输出按阶段汇总的耗时
+    """
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+        self.spans: List[dict] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def lane() -> str:
+        """
+        span 所属的泳道: 当前线程连接的目标主机, 未连接目标主机时为本机
+        """
+        session = getattr(_thread_ctx, 'session', None)
+        return session.tag if session is not None else 'local'
+
+    def add(self, name: str, cat: str, start: float, elapsed: float, args: dict):
+        """
+        记录一个已经结束的 span
+
+        Parameters
+        ----------
+        name : str
+            span 名称, 汇总时按 (cat, name) 分组, 例如: gradle, sftp, op:wait_ready
+        cat : str
+            阶段分类, 例如: local, ssh, transfer, setup, remote
+        start : float
+            开始时间, time.perf_counter() 的值
+        elapsed : float
+            耗时(秒)
+        args : dict
+            附带信息, 例如: bytes, code
+        """
+        span = {'name': name, 'cat': cat, 'lane': self.lane(), 'start': start - self.begin,
+                'elapsed': elapsed, 'args': args}
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str, **args):
+        """
+        记录 with 语句块的耗时, 语句块中可以往返回的 dict 中补充附带信息 (例如: 传输字节数, exit code)
+        """
+        start = time.perf_counter()
+        try:
+            yield args
+        except SystemExit as e:
+            args.setdefault('code', e.code)
+            raise
+        except Exception as e:
+            args.setdefault('error', f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            self.add(name, cat, start, time.perf_counter() - start, args)
+
+    def export_chrome_trace(self, path: str):
+        """
+        导出为 Chrome trace event 格式, 每台目标主机一个线程泳道
+        """
+        with self.lock:
+            spans = list(self.spans)
+        lanes = {'local': 0}
+        events = []
+        for s in spans:
+            if s['lane'] not in lanes:
+                lanes[s['lane']] = len(lanes)
+            events.append({'name': s['name'], 'cat': s['cat'], 'ph': 'X', 'pid': 1, 'tid': lanes[s['lane']],
+                           'ts': round(s['start'] * 1e6), 'dur': round(s['elapsed'] * 1e6), 'args': s['args']})
+        for lane, tid in lanes.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': lane}})
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'sz_deploy'}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii = False, default = str)
+        info(f'trace 已导出到: {path}')
+
+    def print_summary(self):
+        """
+        按 (阶段分类, span 名称) 汇总: 次数, 总耗时, 最大耗时, 传输字节数
+        """
+        with self.lock:
+            spans = list(self.spans)
+        if len(spans) == 0:
+            return
+        groups = {}
+        for s in spans:
+            g = groups.setdefault((s['cat'], s['name']), {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0})
+            g['count'] += 1
+            g['total'] += s['elapsed']
+            g['max'] = max(g['max'], s['elapsed'])
+            g['bytes'] += s['args'].get('bytes', 0) or 0
+        info('各阶段耗时汇总:')
+        width = max([len(f'{cat}/{name}') for cat, name in groups])
+        # 中文字符占两列宽度, 表头按显示宽度手工对齐
+        print('    ' + '阶段' + ' ' * (width - 4) + '    次数      总耗时    最大耗时          传输', file = log_file)
+        for (cat, name), g in sorted(groups.items(), key = lambda it: -it[1]['total']):
+            size = f'{g["bytes"] / 1024 / 1024:.2f} MB' if g['bytes'] > 0 else ''
+            print(f'    {f"{cat}/{name}".ljust(width)}  {g["count"]:6}  {g["total"]:9.2f}s  {g["max"]:9.2f}s  {size:>12}',
+                  file = log_file)
+
+
+tracer = Tracer()
+
+
+class OutputPrinter(object):
+    """
+    远程命令输出的打印线程. 读取远程命令输出的线程只把行放入有界队列, 从不等待终端;
+    终端输出过慢, 队列已满时, 新的行被丢弃 (只计数), 远程命令不会因为终端而被阻塞.
+    多台主机/多个命令的输出在这里按行交错输出, 每行带有主机/应用前缀
+    """
+
+    def __init__(self, maxsize: int):
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, line: str, block: bool = False) -> bool:
+        """
+        将一行放入输出队列
+
+        Parameters
+        ----------
+        line : str
+            要输出的行
+        block : bool
+            队列已满时是否等待, 默认: False, 直接丢弃. 输出内容本身就是命令结果时 (例如: dump_nginx_conf), 不能丢弃
+
+        Returns
+        -------
+        bool
+            False 表示队列已满, 该行被丢弃
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+        try:
+            self.queue.put(line, block = block)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            # 一次取出队列中所有的行, 合并成一次写入
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            out = log_file or sys.stdout
+            out.write(''.join([f'{line}\n' for line in lines]))
+            out.flush()
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped > 0:
+                print(Fore.YELLOW + f'==> 终端输出过慢, 丢弃了 {dropped} 行输出' + Fore.RESET, file = out)
+            for _ in lines:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        等待已经放入队列的行全部输出, 使后续的 info/warn/err 不会出现在命令输出之前
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+
+output_printer = OutputPrinter(output_queue_size)
+
+
+class LineSplitter(object):
+    """
+    将从 channel 中读到的字节流按行切分 (增量 utf-8 解码), 不完整的行保留到下次. 没有换行的超长内容按 max_len 强制切分
+    """
+
+    def __init__(self, on_line, max_len: int = 65536):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+        self.pending = ''
+        self.on_line = on_line
+        self.max_len = max_len
+
+    def feed(self, data: bytes, final: bool = False):
+        text = self.pending + self.decoder.decode(data, final)
+        lines = text.split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.on_line(line.rstrip('\r'))
+        while len(self.pending) > self.max_len:
+            self.on_line(self.pending[:self.max_len])
+            self.pending = self.pending[self.max_len:]
+        if final and self.pending:
+            self.on_line(self.pending)
+            self.pending = ''
 
 
 class PathArgAction(argparse.Action):
@@ -38,12 +479,25 @@ class PathArgAction(argparse.Action):
         setattr(namespace, self.dest, absPath)
 
 
+class PathListArgAction(argparse.Action):
+    """
+    可以多次指定的路径参数, 每次指定的路径都转换为绝对路径后追加到列表中
+    """
+
+    def __call__(self, parser, namespace, values, option_string = None):
+        if not isinstance(values, list):
+            values = [values]
+        paths = list(getattr(namespace, self.dest, None) or [])
+        paths.extend(os.path.abspath(os.path.expanduser(v)) for v in values)
+        setattr(namespace, self.dest, paths)
+
+
 def app_home_dir(app_name: str) -> str:
     return f'{apps_dir}{app_name}'
 
 
 def app_script_path(app_name: str) -> str:
-    return f'{apps_dir}{app_name}/bin/{app_name}'
+    return f'{apps_dir}{app_name}/current/bin/{app_name}'
 
 
 def app_conf_dir(app_name: str) -> str:
@@ -54,75 +508,615 @@ def app_sz_props_url(app_name: str) -> str:
     return f'{app_conf_dir(app_name)}/sz.app.properties'
 
 
-def deploy_setup_script():
+def load_state(name: str) -> dict:
+    """
+    读取本机保存的部署状态文件 (~/.sz_deploy/<name>.json), 文件不存在或者损坏时, 返回空字典
+    """
+    fpath = os.path.join(local_state_dir, f'{name}.json')
+    with _state_lock:
+        try:
+            with open(fpath, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+def update_state(name: str, key: str, value):
+    """
+    更新本机保存的部署状态文件中的一项, value 为 None 时删除该项. 多个主机线程会同时更新, 所以需要加锁
+    """
+    fpath = os.path.join(local_state_dir, f'{name}.json')
+    with _state_lock:
+        try:
+            with open(fpath, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        if value is None:
+            state.pop(key, None)
+        else:
+            state[key] = value
+        os.makedirs(local_state_dir, exist_ok = True)
+        tmp_path = f'{fpath}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent = 2, sort_keys = True)
+        os.replace(tmp_path, fpath)
+
+
+def file_sha256(fpath: str) -> str:
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def deploy_setup_script(force: bool = False):
+    """
+    确保目标主机上的 sz_setup.py 与本机的一致, 只在内容发生变化的时候才上传.
+    * 本机按主机记录上次部署的 sz_setup.py 的 sha256, 一致时不需要任何网络往返;
+      目标主机上的 sz_setup.py 被替换时 (例如: 其他人部署了不同的版本), 由 agent 在第一次响应中发现, 见 RemoteAgent
+    * 本机记录不一致时, 在目标主机上计算 sha256 进行比对, 仍然不一致才上传
+    """
     script_dir = os.path.dirname(__file__)
     script_path = os.path.join(script_dir, 'sz_setup.py')
-    rsync(local_path = script_path, dest_path = '/usr/local/bin/', hideOutput = True)
+    local_hash = file_sha256(script_path)
+    session = current_session()
+    session.setup_script_sha256 = local_hash
+    cache_key = f'{session.host}:{session.port}'
 
+    if not force and load_state('setup_script').get(cache_key) == local_hash:
+        return
 
-def deploy_app_zip(args: argparse.Namespace):
-    app_prj_path = args.prj_dir
+    _, stdout, _ = session.client.exec_command(f'sha256sum {setup_script_path} 2>/dev/null')
+    remote_hash = stdout.read().decode('utf-8').split(' ', 1)[0].strip()
+    if remote_hash != local_hash:
+        # 内容已经确定不一致, 不做 quick check, 直接上传
+        sftp = session.sftp()
+        sftp_makedirs(sftp, posixpath.dirname(setup_script_path))
+        sftp_put_file(sftp, script_path, setup_script_path, SyncStats())
+    update_state('setup_script', cache_key, local_hash)
+
+
+def remote_agent() -> RemoteAgent:
+    """
+    返回当前 ssh 会话上的 sz_setup.py agent, 第一次使用时, 先确保目标主机上的 sz_setup.py 是最新的
+    """
+    session = current_session()
+    if not session.has_agent():
+        deploy_setup_script(force = force_setup_script)
+    return session.agent()
+
+
+def app_zip_path(app_prj_path: str) -> str:
+    app_name = os.path.basename(app_prj_path)
+    return os.path.join(app_prj_path, 'build/distributions', f'{app_name}.zip')
+
+
+def gradle_root_dir(app_prj_path: str) -> str:
+    """
+    返回应用工程所在的 gradle 构建的根目录 (包含 settings.gradle 的最上层目录).
+    多工程构建时, 应用依赖的兄弟工程的改动也会影响构建结果, 所以构建指纹需要覆盖整个根目录
+    """
+    root = app_prj_path
+    cur = app_prj_path
+    while True:
+        if os.path.exists(os.path.join(cur, 'settings.gradle')) or os.path.exists(os.path.join(cur, 'settings.gradle.kts')):
+            root = cur
+        parent = os.path.dirname(cur)
+        if parent == cur:
+            return root
+        cur = parent
+
+
+def build_fingerprint(app_prj_path: str, file_hashes: dict) -> str:
+    """
+    计算构建输入(源码和构建脚本)的指纹. 忽略 gradle 工程目录 (包含 build.gradle/build.gradle.kts 的目录) 下的 build 等输出目录,
+    以及 . 开头的目录 (.gradle, .git, .idea 等). 源码包中同名的目录 (例如: com/acme/build/) 不能忽略
+    file_hashes 为上次计算时每个文件的 [size, mtime_ns, sha256], 大小和修改时间都没有变化的文件不再重新计算 sha256,
+    计算完毕后, file_hashes 被更新为本次的结果
+
+    Returns
+    -------
+    str
+        构建输入的指纹
+    """
+    root = gradle_root_dir(app_prj_path)
+    current = {}
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        is_project = 'build.gradle' in filenames or 'build.gradle.kts' in filenames
+        dirnames[:] = sorted([d for d in dirnames
+                              if not (is_project and d in build_ignored_dirs) and not d.startswith('.')])
+        for name in sorted(filenames):
+            fpath = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(fpath, root)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            cached = file_hashes.get(rel_path)
+            if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                digest = cached[2]
+            else:
+                digest = file_sha256(fpath)
+            current[rel_path] = [st.st_size, st.st_mtime_ns, digest]
+            h.update(f'{rel_path}\0{digest}\0{st.st_mode & 0o111}\n'.encode('utf-8'))
+    file_hashes.clear()
+    file_hashes.update(current)
+    return h.hexdigest()
+
+
+def build_cache_lookup(app_prj_path: str, task: str, artifact_path: str, use_cache: bool = True) -> Tuple[dict, dict]:
+    """
+    检查构建缓存: 构建输入的指纹与上次构建一致, 并且上次的构建产物没有被改动时, 可以直接复用上次的构建产物.
+    缓存记录保存在 build/sz_deploy_build_cache.json, gradle clean 时会一起被清除
+
+    Returns
+    -------
+    Tuple[dict, dict]
+        (命中时为上次的构建记录, 否则为 None; 构建完成后交给 save_build_record 的本次构建的指纹等信息)
+    """
     app_name = os.path.basename(app_prj_path)
-    info(f'编译构建应用[{app_name}]')
-    os.chdir(app_prj_path)
-    shell(f'gradle build')
+    cache_path = os.path.join(app_prj_path, 'build', 'sz_deploy_build_cache.json')
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    record = cache.get(task, {})
+    file_hashes = record.get('files', {})
+    fingerprint = build_fingerprint(app_prj_path, file_hashes)
+    pending = {'cache_path': cache_path, 'cache': cache, 'fingerprint': fingerprint, 'files': file_hashes}
+
+    if use_cache:
+        if record.get('fingerprint') != fingerprint:
+            reason = '构建输入有变化' if record else '没有构建记录'
+        elif not os.path.exists(artifact_path):
+            reason = '构建产物不存在'
+        elif record.get('artifact_mtime_ns') != os.stat(artifact_path).st_mtime_ns:
+            reason = '构建产物已被改动'
+        else:
+            info(f'[build cache] hit: 应用[{app_name}]的构建输入没有变化, 复用 {artifact_path}')
+            return (record, pending)
+        info(f'[build cache] miss: 应用[{app_name}]{reason}')
+    return (None, pending)
 
-    ssh_cmd(f'/usr/local/bin/sz_setup.py init --app-name {app_name}')
-    ssh_cmd(f'/usr/local/bin/sz_setup.py stop --app-name {app_name}')
 
-    local_path = os.path.join(
-        app_prj_path, 'build/distributions', f'{app_name}.zip')
-    rsync(local_path, apps_zip_dir)
+def save_build_record(task: str, artifact_path: str, pending: dict) -> dict:
+    """
+    构建完成后, 将本次的构建记录写入构建缓存
 
-    ssh_cmd(f'/usr/local/bin/sz_setup.py installzip --app-name {app_name}')
-    ssh_cmd(f'/usr/local/bin/sz_setup.py start --app-name {app_name}')
-    ssh_cmd(f'supervisorctl status {app_name}')
-    info(f"应用[{app_name}]在目标机器上部署完毕")
+    Returns
+    -------
+    dict
+        构建记录, 构建产物为文件时, 包含它的 sha256 (artifact_sha256)
+    """
+    st = os.stat(artifact_path)
+    record = {
+        'fingerprint': pending['fingerprint'],
+        'artifact_mtime_ns': st.st_mtime_ns,
+        'files': pending['files']
+    }
+    if os.path.isfile(artifact_path):
+        record['artifact_sha256'] = file_sha256(artifact_path)
+    cache = pending['cache']
+    cache[task] = record
+    with open(pending['cache_path'], 'w') as f:
+        json.dump(cache, f)
+    return record
 
 
-def deploy_app(args: argparse.Namespace):
+def cached_build(app_prj_path: str, task: str, artifact_path: str, use_cache: bool = True):
     """
-    部署"应用"到目标服务器
+    执行 gradle 构建, 构建缓存命中时 (见 build_cache_lookup), 直接复用上次的构建产物
 
     Parameters
     ----------
-    args :
-           部署参数
+    app_prj_path : str
+        应用的 gradle 工程目录
+    task : str
+        gradle 构建任务, 例如: build, installDist
+    artifact_path : str
+        构建产物的路径 (zip 文件或者目录)
+    use_cache : bool
+        是否使用构建缓存, 默认: True
+
+    Returns
+    -------
+    dict
+        构建记录, 构建产物为文件时, 包含它的 sha256 (artifact_sha256)
     """
-    app_prj_path = args.prj_dir
-    app_name = os.path.basename(app_prj_path)
-    info(f'编译构建应用[{app_name}]')
-    os.chdir(app_prj_path)
-    shell(f'gradle installDist')
+    record, pending = build_cache_lookup(app_prj_path, task, artifact_path, use_cache = use_cache)
+    if record is not None:
+        return record
+    shell(f'gradle {task}', cwd = app_prj_path, tag = os.path.basename(app_prj_path))
+    return save_build_record(task, artifact_path, pending)
+
+
+def gradle_task_path(root_dir: str, app_prj_path: str, task: str) -> str:
+    """
+    在 gradle 构建的根目录下执行时, 应用工程的任务路径, 例如: :services:api_server:build
+    (按 gradle 的默认约定, 子工程的路径与其目录一致)
+    """
+    rel = os.path.relpath(app_prj_path, root_dir)
+    if rel == '.':
+        return task
+    return ':' + rel.replace(os.sep, ':') + ':' + task
+
+
+class AppBuild(object):
+    """
+    一次部署中的一个应用: gradle 工程目录, 依赖的应用 (重启顺序), 以及在后台进行的构建
+    """
+
+    def __init__(self, prj_dir: str, depends_on: List[str] = []):
+        self.prj_dir = prj_dir
+        self.name = os.path.basename(prj_dir)
+        self.depends_on = list(depends_on)
+        # 构建完成后, 结果为构建记录 (见 save_build_record)
+        self.future: Future = None
+
+    @property
+    def zip_path(self) -> str:
+        return app_zip_path(self.prj_dir)
+
+    @property
+    def sha256(self) -> str:
+        """
+        等待构建完成, 返回制品的 sha256. 构建失败时, 抛出构建线程中的异常 (SystemExit)
+        """
+        return self.future.result()['artifact_sha256']
+
+
+def load_app_builds(args: argparse.Namespace) -> List[AppBuild]:
+    """
+    由命令行的 --prj-dir (可以指定多个) 和 --apps-file 得到本次要部署的应用.
+    --apps-file 为 json 文件, 格式: {"apps": [{"prj_dir": "api_server", "depends_on": ["auth_server"]}]},
+    prj_dir 为相对路径时, 相对于该文件所在的目录; depends_on 中的应用先于该应用重启并就绪
+    """
+    apps: List[AppBuild] = [AppBuild(prj_dir) for prj_dir in (args.prj_dir or [])]
+    if args.apps_file:
+        with open(args.apps_file, 'r') as f:
+            spec = json.load(f)
+        base_dir = os.path.dirname(args.apps_file)
+        for it in spec.get('apps', []):
+            prj_dir = os.path.abspath(os.path.join(base_dir, os.path.expanduser(it['prj_dir'])))
+            apps.append(AppBuild(prj_dir, it.get('depends_on', [])))
+    if len(apps) == 0:
+        err('请通过 --prj-dir 或者 --apps-file 指定要部署的应用')
+        sys.exit(-1)
+
+    names = [app.name for app in apps]
+    if len(set(names)) != len(names):
+        err(f'要部署的应用名称重复: {names}')
+        sys.exit(-1)
+    for app in apps:
+        unknown = [dep for dep in app.depends_on if dep not in names]
+        if len(unknown) > 0:
+            err(f'应用[{app.name}]依赖的应用 {unknown} 不在本次部署的应用中')
+            sys.exit(-1)
+    if len(apps) > 1 and args.app_port not in [None, 'auto']:
+        err('同时部署多个应用时, --app-port 只能为 auto')
+        sys.exit(-1)
+    return apps
+
+
+def dependency_levels(apps: List[AppBuild]) -> List[List[AppBuild]]:
+    """
+    按依赖关系将应用分层: 每一层的应用只依赖前面各层中的应用, 同一层的应用可以同时重启. 层内保持用户指定的顺序
+    """
+    levels: List[List[AppBuild]] = []
+    done = set()
+    remaining = list(apps)
+    while len(remaining) > 0:
+        level = [app for app in remaining if all([dep in done for dep in app.depends_on])]
+        if len(level) == 0:
+            err(f'应用之间存在循环依赖: {[app.name for app in remaining]}')
+            sys.exit(-1)
+        levels.append(level)
+        done.update([app.name for app in level])
+        remaining = [app for app in remaining if app.name not in done]
+    return levels
+
+
+def build_app_zip(args: argparse.Namespace):
+    """
+    在本机后台并行编译构建各应用的 zip 包 (同时进行的构建数量不超过 --build-jobs), 无论部署到多少台目标主机, 每个应用只构建一次.
+    同一个 gradle 多工程构建中的应用, 在根目录下用一次 gradle 调用构建 (gradle :a:build :b:build), 共用的兄弟工程只构建一次,
+    也不会有多个 gradle 进程同时写同一个 build 目录, 争用根目录下 .gradle 的锁.
+    不等待构建完成: 部署线程在某个应用构建完成后立即开始上传它的制品, 与其他应用的构建同时进行
+    """
+    apps = load_app_builds(args)
+    dependency_levels(apps)
+    groups = collections.OrderedDict()
+    for app in apps:
+        groups.setdefault(gradle_root_dir(app.prj_dir), []).append(app)
+    jobs = max(1, min(args.build_jobs, len(groups)))
+    info(f'编译构建应用: {[app.name for app in apps]}, {len(groups)} 个 gradle 构建, 同时构建: {jobs} 个')
+    executor = ThreadPoolExecutor(max_workers = jobs)
+
+    def build(root_dir: str, group: List[AppBuild]):
+        # 已经被取消的应用 (其他应用构建失败) 不再构建
+        group = [app for app in group if app.future.set_running_or_notify_cancel()]
+        try:
+            pending = {}
+            for app in group:
+                record, pending[app.name] = build_cache_lookup(app.prj_dir, 'build', app.zip_path,
+                                                               use_cache = not args.no_build_cache)
+                if record is not None:
+                    app.future.set_result(record)
+            misses = [app for app in group if not app.future.done()]
+            if len(misses) == 0:
+                return
+            names = ','.join([app.name for app in misses])
+            tasks = ' '.join([gradle_task_path(root_dir, app.prj_dir, 'build') for app in misses])
+            with tracer.span(names, 'build'):
+                shell(f'gradle {tasks}', cwd = root_dir, tag = names)
+            for app in misses:
+                app.future.set_result(save_build_record('build', app.zip_path, pending[app.name]))
+        except BaseException as e:
+            # 任何一个应用构建失败, 本次部署都无法完成, 不必等待其他应用的构建
+            cancel_app_builds(apps, f'应用 {[app.name for app in group if not app.future.done()]} 构建失败')
+            for app in group:
+                if not app.future.done():
+                    app.future.set_exception(e)
+
+    for app in apps:
+        app.future = Future()
+    for root_dir, group in groups.items():
+        executor.submit(build, root_dir, group)
+    executor.shutdown(wait = False)
+    args.app_builds = apps
+    args.failed_hosts = 0
+
+
+def cancel_app_builds(apps: List[AppBuild], reason: str):
+    """
+    终止正在进行的构建, 还没有开始的构建不再执行. 等待构建的部署线程从 AppBuild.sha256 得到异常, 随即结束
+    """
+    cancel_local_work(reason)
+    for app in apps:
+        if app.future is not None:
+            app.future.cancel()
+
+
+def estimate_disk_need(apps: List[AppBuild]) -> Tuple[int, int]:
+    """
+    在构建完成之前, 由上次构建的 zip 包估算目标主机上需要的剩余空间. 没有上次构建的 zip 包时, 不计入
+
+    Returns
+    -------
+    Tuple[int, int]
+        (应用目录需要的字节数: 解压后的大小, 制品库需要的字节数: 制品本身以及上传时的临时文件)
+    """
+    apps_bytes = 0
+    store_bytes = 0
+    for app in apps:
+        try:
+            with zipfile.ZipFile(app.zip_path) as zf:
+                apps_bytes += sum([it.file_size for it in zf.infolist()])
+            store_bytes += os.path.getsize(app.zip_path) * 2
+        except (IOError, zipfile.BadZipFile):
+            pass
+    return (apps_bytes, store_bytes)
+
+
+@functools.lru_cache(maxsize = 8)
+def artifact_chunk_index(zip_path: str, sha256: str) -> List[List]:
+    """
+    制品的块索引, 多台主机共用, 只计算一次
+    """
+    return sz_setup.zip_chunk_index(zip_path)
+
+
+def upload_artifact(app_name: str, zip_path: str, sha256: str):
+    """
+    将应用的 zip 包存入目标主机的制品库 (按 sha256 寻址).
+    * 制品库中已经存在时 (例如: 回滚, 或者同一个构建部署到另一个应用槽位), 不上传任何数据
+    * 否则按 zip 条目切块, 只上传目标主机上最接近的已有制品中没有的块, 由目标主机还原出完整的 zip 文件
+    """
+    _, results = setup_ops(f'artifact_plan --sha256 {sha256}')
+    if results[0]['data']['present']:
+        info(f'[artifact] 制品[{sha256[:12]}]已经存在于目标主机, 跳过上传')
+        return
+
+    index = artifact_chunk_index(zip_path, sha256)
+    sftp = current_session().sftp()
+    tmp_dir = f'{artifact_store_dir}tmp/'
+    index_path = f'{tmp_dir}{sha256}.index.json'
+    with sftp.open(index_path, 'w') as f:
+        f.set_pipelined(True)
+        f.write(json.dumps(index).encode('utf-8'))
+
+    _, results = setup_ops(f'artifact_plan --sha256 {sha256} --index {index_path}')
+    plan = results[0]['data']
+    if plan['present']:
+        return
+    missing = plan['missing']
+
+    offsets = []
+    offset = 0
+    for _, size in index:
+        offsets.append(offset)
+        offset += size
+    sent = 0
+    with tracer.span('artifact delta', 'transfer', chunks = len(missing), total_chunks = len(index)) as span, \
+            open(zip_path, 'rb') as local, sftp.open(f'{tmp_dir}{sha256}.delta', 'w') as remote:
+        remote.set_pipelined(True)
+        for i in missing:
+            local.seek(offsets[i])
+            data = local.read(index[i][1])
+            remote.write(data)
+            sent += len(data)
+        span['bytes'] = sent
+    info(f'[artifact] 上传 {len(missing)}/{len(index)} 块, {sent}/{offset} bytes')
+
+    base_arg = f' --base {plan["base"]}' if plan['base'] else ''
+    setup_ops(f'artifact_assemble --sha256 {sha256}{base_arg}')
+
+
+def profile_ops(app_name: str, args: argparse.Namespace) -> List[str]:
+    """
+    根据命令行中的就绪检查/JVM 参数, 生成修改目标主机上应用部署参数的操作, 没有指定任何参数时, 沿用目标主机上保存的设置.
+    部署参数在应用切换版本 (部署/回滚) 时, 或者部署配置文件 (conf) 修改了部署参数时, 写入 supervisor 配置
+    """
+    opts: List[str] = []
+    if args.app_port is not None:
+        opts.append(f'--port {args.app_port}')
+    if args.instances is not None:
+        opts.append(f'--instances {args.instances}')
+    if args.ready_tcp is not None:
+        opts.append('--ready-tcp' if args.ready_tcp else '--no-ready-tcp')
+    if args.ready_http is not None:
+        opts.append(f'--ready-http {shlex.quote(args.ready_http)}')
+    if args.ready_log is not None:
+        opts.append(f'--ready-log {shlex.quote(args.ready_log)}')
+    if args.ready_timeout is not None:
+        opts.append(f'--ready-timeout {args.ready_timeout}')
+    if args.drain_timeout is not None:
+        opts.append(f'--drain-timeout {args.drain_timeout}')
+    if args.jvm_heap is not None:
+        opts.append(f'--jvm-heap {shlex.quote(args.jvm_heap)}')
+    if args.jvm_heap_percent is not None:
+        opts.append(f'--jvm-heap-percent {args.jvm_heap_percent}')
+    if args.jvm_gc is not None:
+        opts.append(f'--jvm-gc {args.jvm_gc}')
+    if args.cds is not None:
+        opts.append('--cds' if args.cds else '--no-cds')
+    if args.jvm_opts is not None:
+        # 以 - 开头的值需要用 = 连接, 否则会被当作参数名
+        opts.append(f'--jvm-opts={shlex.quote(args.jvm_opts)}')
+    if args.reload_files is not None:
+        opts.append('--reload-files ' + ' '.join([shlex.quote(f) for f in args.reload_files]))
+    if args.reload_signal is not None:
+        opts.append(f'--reload-signal={shlex.quote(args.reload_signal)}')
+    if len(opts) == 0:
+        return []
+    return [f'profile --app-name {app_name} ' + ' '.join(opts)]
+
+
+def restart_ops(app_name: str, args: argparse.Namespace, reconfigure: bool = False) -> List[str]:
+    """
+    重启应用的操作: 滚动重启, 或者 停止+启动+等待就绪.
+    reconfigure 为 True 时 (部署参数有变化), 在重启之前按新的部署参数重新生成 supervisor 配置
+    """
+    if args.rolling:
+        reconf_ops = [f'supervisor_conf --app-name {app_name} --rolling'] if reconfigure else []
+        return reconf_ops + [f'rolling_restart --app-name {app_name}']
+    reconf_ops = [f'supervisor_conf --app-name {app_name}'] if reconfigure else []
+    return [f'stop --app-name {app_name}'] + reconf_ops + [
+        f'start --app-name {app_name}',
+        f'wait_ready --app-name {app_name}']
 
-    ssh_cmd(f'/usr/local/bin/sz_setup.py init --app-name {app_name}')
-    ssh_cmd(
-        f'/usr/local/bin/sz_setup.py stop --app-name {app_name}', exitOnError = False)
 
-    local_path = os.path.join(app_prj_path, 'build/install', app_name)
-    rsync(local_path, apps_dir, excluded_del = ['logs/', 'h2db/'])
+def report_ready(app_name: str, results: List[dict]):
+    for r in results:
+        if r['cmd'] == 'wait_ready' and r['code'] == 0:
+            info(f'应用[{app_name}]启动就绪耗时: {r["data"]["ready_secs"]:.2f}s')
+        elif r['cmd'] == 'rolling_restart' and r['code'] == 0:
+            for it in r['data']['instances']:
+                info(f'应用[{app_name}]实例[{it["process"]}]启动就绪耗时: {it["ready_secs"]:.2f}s')
 
-    ssh_cmd(f'/usr/local/bin/sz_setup.py install --app-name {app_name}')
-    ssh_cmd(f'/usr/local/bin/sz_setup.py start --app-name {app_name}')
-    ssh_cmd(f'supervisorctl status {app_name}')
-    info(f"应用[{app_name}]在目标机器上部署完毕")
+
+def deploy_app_zip(args: argparse.Namespace):
+    """
+    * 按构建完成的先后顺序, 上传各应用的制品, 并解压到新的版本目录 (不影响正在运行的旧版本)
+    * 所有应用都准备好之后, 按依赖关系逐层切换版本并重启, 同一层的应用在一批操作中同时重启
+    """
+    apps: List[AppBuild] = args.app_builds
+
+    try:
+        # 在本机构建的同时: 上传 sz_setup.py, 创建目录, 检查剩余空间, 修改部署参数
+        apps_bytes, store_bytes = estimate_disk_need(apps)
+        reserve = args.min_free_mb * 1024 * 1024
+        ops = [f'prepare --app-name {" ".join([app.name for app in apps])} '
+               f'--apps-bytes {apps_bytes + reserve} --store-bytes {store_bytes + reserve}']
+        for app in apps:
+            ops.extend(profile_ops(app.name, args))
+        with tracer.span('prepare', 'setup'):
+            setup_ops(*ops)
+
+        futures = {app.future: app for app in apps}
+        for future in as_completed(futures):
+            app = futures[future]
+            sha256 = app.sha256
+            upload_artifact(app.name, app.zip_path, sha256)
+            setup_ops(f'stage --app-name {app.name} --sha256 {sha256}')
+    except BaseException:
+        # 所有目标主机都无法部署时, 本机的构建也没有必要继续
+        with _state_lock:
+            args.failed_hosts += 1
+            all_failed = args.failed_hosts >= args.host_count
+        if all_failed:
+            cancel_app_builds(apps, '所有目标主机的部署准备都失败了')
+        raise
+
+    for level in dependency_levels(apps):
+        ops: List[str] = []
+        op_apps: List[str] = []
+        # 同一层的应用, 在一次 supervisor 调用中一起停止/启动/查看状态
+        level_names = ' '.join([app.name for app in level])
+
+        def add(app_name: str, *app_ops: str):
+            ops.extend(app_ops)
+            op_apps.extend([app_name] * len(app_ops))
+
+        if args.rolling:
+            # 正在运行的实例使用的是旧版本目录下的文件, 可以先切换 current, 再逐个重启实例
+            for app in level:
+                add(app.name, f'activate --app-name {app.name} --sha256 {app.sha256} --rolling',
+                    f'rolling_restart --app-name {app.name}')
+        else:
+            # 应用只在 stop 到 start 之间 (切换 current 符号链接) 停止服务; 先全部启动, 再逐个等待就绪, 启动过程互相重叠
+            add('', f'stop --app-name {level_names}')
+            for app in level:
+                add(app.name, f'activate --app-name {app.name} --sha256 {app.sha256}')
+            add('', f'start --app-name {level_names}')
+            for app in level:
+                add(app.name, f'wait_ready --app-name {app.name}')
+        add('', f'status --app-name {level_names}')
+
+        _, results = setup_ops(*ops)
+        for app in level:
+            report_ready(app.name, [r for r, name in zip(results, op_apps) if name == app.name])
+            info(f"应用[{app.name}]在目标机器上部署完毕")
 
 
 def deploy_conf(args: argparse.Namespace):
+    """
+    部署运行环境配置文件, 只在需要时重启应用:
+    * 与目标主机上的配置目录比较, 只上传变化的文件 (一次传输), 由目标主机复制到 current/conf
+    * 没有文件变化, 部署参数也没有变化时, 不重启; 部署参数有变化时, 先按新的部署参数重新生成 supervisor 配置, 再重启
+    * 变化的文件都是应用可以自行重新加载的 (例如: scan="true" 的 logback.xml), 或者部署参数中声明了可以重新加载的,
+      发送重新加载的信号 (如果有), 不重启
+    """
     info("部署运行环境配置文件")
     app_prj_path = args.prj_dir
     app_name = os.path.basename(app_prj_path)
-    local_conf_dir = f'{args.conf_dir}/*'
-    dest_conf_dir = app_conf_dir(app_name)
-    dest_app_conf_dir = f'{app_home_dir(app_name)}/conf'
 
-    ssh_cmd(f'/usr/local/bin/sz_setup.py init --app-name {app_name}')
-    rsync(local_conf_dir, dest_conf_dir, delete = False)
-    rsync(local_conf_dir, dest_app_conf_dir, delete = False)
-
-    ssh_cmd(f'/usr/local/bin/sz_setup.py stop --app-name {app_name}')
-    ssh_cmd(f'/usr/local/bin/sz_setup.py start --app-name {app_name}')
-    ssh_cmd(f'/usr/local/bin/sz_setup.py status --app-name {app_name}')
+    ops = profile_ops(app_name, args)
+    if len(ops) > 0:
+        # 修改前后的部署参数, 用于判断是否需要重启
+        ops = [f'profile --app-name {app_name}'] + ops
+    _, results = setup_ops(f'init --app-name {app_name}', *ops)
+    profile_changed = len(ops) > 0 and results[1]['data'] != results[2]['data']
+
+    _, changed, _ = mirror_dir(args.conf_dir, app_conf_dir(app_name), f'conf_{app_name}', delete = False)
+    _, results = setup_ops(f'conf_sync --app-name {app_name} --changed {" ".join(shlex.quote(f) for f in changed)}')
+    action = results[-1]['data']['action']
+
+    if action == 'not_installed':
+        info(f'应用[{app_name}]还没有部署, 配置文件在应用部署后生效')
+    elif profile_changed or action == 'restart':
+        _, results = setup_ops(*restart_ops(app_name, args, reconfigure = profile_changed),
+                               f'status --app-name {app_name}')
+        report_ready(app_name, results)
+    elif action == 'reload':
+        info(f'应用[{app_name}]的配置文件已重新加载, 不需要重启')
+    else:
+        info(f'应用[{app_name}]的配置文件没有变化, 不需要重启')
     info(f"应用[{app_name}]的运行环境配置文件在目标机器上部署完毕")
 
 
@@ -130,54 +1124,582 @@ def undeploy(args: argparse.Namespace):
     app_prj_path = args.prj_dir
     app_name = os.path.basename(app_prj_path)
     info(f"开始清理删除部署在目标服务器的应用[{app_name}]")
-    ssh_cmd(f'/usr/local/bin/sz_setup.py uninstall --app-name {app_name}')
+    setup_ops(f'uninstall --app-name {app_name}')
     info(f"应用[{app_name}]在目标机器上清理完毕")
 
 
+def cmd_status(args: argparse.Namespace) -> dict:
+    """
+    一次往返取得目标主机上所有应用的状态和资源占用, 以及主机的整体容量, 由 print_fleet_status() 汇总输出
+    """
+    _, results = setup_ops('status_all', quiet = True)
+    return results[0]['data']
+
+
+def format_bytes(size: int) -> str:
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
+def format_secs(secs: float) -> str:
+    secs = int(secs)
+    days, secs = divmod(secs, 86400)
+    text = f'{secs // 3600}:{secs % 3600 // 60:02}:{secs % 60:02}'
+    return f'{days}d {text}' if days > 0 else text
+
+
+def print_fleet_status(results: List[HostResult], as_json: bool):
+    """
+    汇总输出各目标主机的状态快照: 表格, 或者 json (以 host:port 为键)
+    """
+    if as_json:
+        snapshot = {host_label(r.host, r.port): r.data if r.ok else {'error': r.error or f'return code: {r.exit_code}'}
+                    for r in results}
+        print(json.dumps(snapshot, ensure_ascii = False, indent = 2))
+        return
+
+    header = ['HOST', 'PROCESS', 'STATE', 'PID', 'UPTIME', 'RSS', 'CPU', 'FDS', 'LOGS']
+    rows: List[List[str]] = []
+    hosts: List[List[str]] = []
+    for r in results:
+        name = host_label(r.host, r.port)
+        if not r.ok or r.data is None:
+            rows.append([name, '-', 'FAILED', '', '', '', '', '', ''])
+            continue
+        h = r.data['host']
+        hosts.append([name, h['hostname'], str(h['cpus']), ' '.join([f'{v:.2f}' for v in h['loadavg']]),
+                      f'{format_bytes(h["mem_available"])}/{format_bytes(h["mem_total"])}',
+                      f'{format_bytes(h["disk_free"])}/{format_bytes(h["disk_total"])}'])
+        for it in r.data['processes']:
+            rows.append([name, it['process'], it['state'], str(it['pid'] or ''), format_secs(it['uptime']) if it['uptime'] else '',
+                         format_bytes(it['rss']) if it['pid'] else '', f'{it["cpu_secs"]:.1f}s' if it['pid'] else '',
+                         str(it['fds']) if it['pid'] else '', format_bytes(it['logs_bytes'])])
+
+    def print_table(header: List[str], rows: List[List[str]]):
+        widths = [max([len(row[i]) for row in [header] + rows]) for i in range(len(header))]
+        for row in [header] + rows:
+            print('  '.join([v.ljust(w) for v, w in zip(row, widths)]).rstrip())
+
+    print_table(header, rows)
+    if len(hosts) > 0:
+        print()
+        print_table(['HOST', 'HOSTNAME', 'CPUS', 'LOADAVG', 'MEM AVAIL', 'DISK FREE'], hosts)
+
+
+def cmd_logs(args: argparse.Namespace):
+    """
+    输出应用日志中新写入的行. 本机 (~/.sz_deploy/logs.json) 按主机/应用记录每个日志文件读到的位置和 inode,
+    再次执行时只输出上次之后新写入的行; --grep 在目标主机上过滤. --follow 时每隔 --interval 秒查询一次,
+    每次查询只需要一次 agent 往返
+    """
+    session = current_session()
+    key = f'{session.host}_{session.port}'
+    reset = args.reset
+    opts = f'--file {shlex.quote(args.file)} --lines {args.lines}'
+    if args.app_name:
+        opts += ' --app-name ' + ' '.join([shlex.quote(name) for name in args.app_name])
+    if args.grep:
+        opts += f' --grep {shlex.quote(args.grep)}'
+    if args.ignore_case:
+        opts += ' --ignore-case'
+    while True:
+        stored = {} if reset else load_state('logs').get(key, {})
+        reset = False
+        offsets = {name: stored[name] for name in args.app_name if name in stored} if args.app_name else stored
+        _, results = setup_ops(f'tail_logs {opts} --offsets {shlex.quote(json.dumps(offsets))}', quiet = True)
+        data = results[-1]['data']
+        for app_name, name, line in data['lines']:
+            output_printer.put(f'{Fore.CYAN}{host_prefix()}{app_name}/{name}{Fore.RESET} {line}', block = True)
+        stored.update(data['apps'])
+        update_state('logs', key, stored)
+        if data['more']:
+            continue
+        if not args.follow or cancel_event.wait(args.interval):
+            break
+    output_printer.flush()
+
+
 def cmd_list_nginx_conf(args: argparse.Namespace):
-    ssh_cmd(f'/usr/local/bin/sz_setup.py list_nginx_conf')
+    setup_ops('list_nginx_conf')
 
 
 def cmd_dump_nginx_conf(args: argparse.Namespace):
     conf_name = args.conf
     conf_path = os.path.join(nginx_conf_dir, conf_name)
-    ssh_cmd(f'cat {conf_path}', showPrefix = False)
+    ssh_cmd(f'cat {conf_path}', showPrefix = False, dropLines = False)
 
 
 def cmd_install_nginx_conf(args: argparse.Namespace):
     """
-    * 将指定的 nginx 配置文件上传到目标服务器的 /etc/nginx/conf.d 目录下
-    * 在目标服务器上检查配置文件是否合法有效
-    * 检查通过, 则重启 nginx 服务
-    * 检查不通过, 则删除此配置文件
+    * 将指定的一组 nginx 配置文件上传到目标服务器的临时目录下
+    * 在目标服务器上将这组配置文件一起放入 /etc/nginx/conf.d 目录, 只检查一次配置是否合法有效
+    * 检查通过, 则平滑重新加载 nginx 配置 (不重启 nginx 服务)
+    * 检查不通过, 则将 /etc/nginx/conf.d 目录恢复到安装之前的状态
 
     Parameters
     ----------
     args : 命令行参数对象
     """
-    conf_path: str = args.conf
-    if not os.path.exists(conf_path):
-        err(f'File [{conf_path}] does not exists.')
-        sys.exit(-1)
-    if not conf_path.endswith('.conf'):
-        err('File extension name must be ".conf".')
+    conf_paths: List[str] = args.conf
+    for conf_path in conf_paths:
+        if not os.path.exists(conf_path):
+            err(f'File [{conf_path}] does not exists.')
+            sys.exit(-1)
+        if not conf_path.endswith('.conf'):
+            err('File extension name must be ".conf".')
+            sys.exit(-1)
+    conf_names = [os.path.basename(p) for p in conf_paths]
+    if len(set(conf_names)) != len(conf_names):
+        err(f'nginx 配置文件名称重复: {conf_names}')
         sys.exit(-1)
-    conf_name = os.path.basename(conf_path)
-    rsync(conf_path, nginx_conf_dir)
-    ssh_cmd(f'/usr/local/bin/sz_setup.py test_nginx_conf --conf {conf_name}')
+    apply_nginx_confs(conf_paths)
+
+
+def apply_nginx_confs(conf_paths: List[str], exitOnError: bool = True) -> int:
+    """
+    上传一组本地的 nginx 配置文件到目标服务器的临时目录, 然后以事务的方式一起安装到 /etc/nginx/conf.d/
+    """
+    conf_names = [os.path.basename(p) for p in conf_paths]
+    # 临时目录和 conf.d 在同一个文件系统上, 目标服务器上可以原子的 rename 到位
+    staged_dir = f'{nginx_conf_dir}.staging/{os.getpid()}-{int(time.time() * 1000)}/'
+    sftp = current_session().sftp()
+    sftp_makedirs(sftp, staged_dir)
+    for conf_path in conf_paths:
+        sftp_sync(conf_path, staged_dir, delete = False)
+    code, _ = setup_ops(f'apply_nginx_conf --staged-dir {shlex.quote(staged_dir)} '
+                        f'--install {" ".join(shlex.quote(n) for n in conf_names)}', exitOnError = exitOnError)
+    return code
 
 
 def cmd_uninstall_nginx_conf(args: argparse.Namespace):
-    conf_name = args.conf
-    ssh_cmd(f'/usr/local/bin/sz_setup.py delete_nginx_conf --conf {conf_name}')
+    conf_names = ' '.join(shlex.quote(n) for n in args.conf)
+    setup_ops(f'delete_nginx_conf --conf {conf_names}')
+
+
+def route_arg(text: str) -> Tuple[str, str]:
+    """
+    解析 --route 参数: <路径前缀>=<应用名称>, 例如: /api/=api_server
+    """
+    prefix, sep, app_name = text.partition('=')
+    if sep == '' or not prefix.startswith('/') or not prefix.endswith('/') or app_name == '':
+        raise argparse.ArgumentTypeError(f'格式应为 <路径前缀>=<应用名称>, 例如: /api/=api_server, 而不是: {text}')
+    return (prefix, app_name)
+
+
+def nginx_cache_content() -> str:
+    lines: List[str] = []
+    lines.append('# 由 sz_deploy.py gen_nginx_conf 生成, 请勿手工修改')
+    lines.append(f'proxy_cache_path {nginx_cache_dir} levels=1:2 keys_zone={nginx_cache_zone}:10m max_size=256m '
+                 f'inactive=7d use_temp_path=off;')
+    return ''.join([f'{line}\n' for line in lines])
+
+
+def nginx_server_content(registry: dict, args: argparse.Namespace) -> str:
+    """
+    根据目标主机上已安装的应用 (sz_setup.py nginx_apps 的返回结果) 生成 server 配置:
+    * /api/ 等路径前缀转发到应用的 upstream (sz_<应用名称>, 包含应用的所有实例), 与应用保持长连接
+    * /builtinstatic/ 各实例返回的内容一致, 在 nginx 中缓存 (proxy_cache)
+    * web 站点 (/web_html 下的子目录) 的静态文件, 缓存打开的文件描述符 (open_file_cache)
+    """
+    apps = {it['name']: it for it in registry['apps']}
+    routes: List[Tuple[str, str]] = args.route or []
+    if len(routes) == 0:
+        if len(apps) != 1:
+            raise Exception(f'目标主机上安装了多个应用 {sorted(apps)}, 请通过 --route 指定转发规则, 例如: --route /api/=api_server')
+        routes = [('/api/', list(apps)[0])]
+    for _, app_name in routes:
+        if app_name not in apps:
+            raise Exception(f'应用[{app_name}]没有安装在目标主机上, 已安装的应用: {sorted(apps)}')
+    static_app = args.static_app or routes[0][1]
+    if static_app not in apps:
+        raise Exception(f'应用[{static_app}]没有安装在目标主机上, 已安装的应用: {sorted(apps)}')
+
+    web_apps = {it['name']: it for it in registry['web_apps']}
+    web_app = None
+    if args.web_app:
+        web_app = web_apps.get(args.web_app)
+        if web_app is None:
+            raise Exception(f'web 站点[{args.web_app}]没有部署在目标主机上, 已部署的站点: {sorted(web_apps)}')
+    elif len(web_apps) == 1:
+        web_app = list(web_apps.values())[0]
+
+    lines: List[str] = []
+    lines.append('# 由 sz_deploy.py gen_nginx_conf 生成, 请勿手工修改')
+    lines.append('server {')
+    lines.append(f'    server_name  {args.server_name};')
+    for listen in args.listen:
+        lines.append(f'    listen       {listen};')
+    if args.ssl_cert:
+        lines.append('    listen       443 ssl;')
+        lines.append(f'    ssl_certificate     {args.ssl_cert};')
+        lines.append(f'    ssl_certificate_key {args.ssl_key};')
+        lines.append('    ssl_session_cache   shared:SSL:10m;')
+        lines.append('    ssl_session_timeout 10m;')
+        lines.append('    ssl_protocols       TLSv1.2 TLSv1.3;')
+    lines.append('')
+    lines.append('    # 与 upstream 中的应用实例保持长连接, 而不是每个请求新建一个 TCP 连接')
+    lines.append('    proxy_http_version 1.1;')
+    lines.append('    proxy_set_header   Connection       "";')
+    lines.append('    proxy_set_header   Host             $http_host;')
+    lines.append('    proxy_set_header   X-Real-IP        $remote_addr;')
+    lines.append('    proxy_set_header   X-Forwarded-For  $proxy_add_x_forwarded_for;')
+    lines.append('')
+    lines.append('    # 一般的 json 响应放在内存缓冲区中, 尽快释放应用的连接, 不写入临时文件')
+    lines.append('    proxy_buffering         on;')
+    lines.append('    proxy_buffer_size       16k;')
+    lines.append('    proxy_buffers           32 16k;')
+    lines.append('    proxy_busy_buffers_size 64k;')
+    lines.append('')
+    lines.append('    client_max_body_size 100m;')
+    lines.append('    # 超过缓冲区大小的请求体写入临时文件, 避免每个上传请求都占用 100m 内存')
+    lines.append('    client_body_buffer_size 1m;')
+    lines.append('    client_header_timeout 60s;')
+    lines.append('    client_body_timeout 600s;')
+    lines.append('    proxy_connect_timeout 60s;')
+    lines.append('    proxy_read_timeout 60s;')
+    lines.append('    proxy_send_timeout 600s;')
+    if web_app is not None:
+        lines.append('')
+        lines.append(f'    # web 站点 [{web_app["name"]}]: 缓存打开的文件描述符和文件元数据, 站点更新后最多 {args.open_file_cache_valid} 生效')
+        lines.append('    open_file_cache          max=10000 inactive=60s;')
+        lines.append(f'    open_file_cache_valid    {args.open_file_cache_valid};')
+        lines.append('    open_file_cache_min_uses 2;')
+        lines.append('    open_file_cache_errors   on;')
+        if web_app['snippet']:
+            lines.append(f'    include {web_app["snippet"]};')
+        else:
+            lines.append('    location / {')
+            lines.append(f'        root   {web_app["root"]};')
+            lines.append('        index  index.html index.htm;')
+            lines.append('    }')
+    lines.append('')
+    lines.append('    error_page   500 502 503 504  /50x.html;')
+    lines.append('    location = /50x.html {')
+    lines.append('        root   html;')
+    lines.append('    }')
+    lines.append('')
+    lines.append(f'    # 各实例返回的内容一致, 缓存 {args.static_cache_valid}, 应用重启期间返回缓存的内容')
+    lines.append('    location /builtinstatic/ {')
+    lines.append(f'        proxy_pass   http://{apps[static_app]["upstream"]};')
+    lines.append(f'        proxy_cache  {nginx_cache_zone};')
+    lines.append(f'        proxy_cache_valid 200 301 302 {args.static_cache_valid};')
+    lines.append('        proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;')
+    lines.append('        proxy_cache_lock on;')
+    lines.append('        proxy_cache_background_update on;')
+    lines.append('        add_header   X-Cache-Status $upstream_cache_status;')
+    lines.append('    }')
+    for prefix, app_name in routes:
+        ports = ', '.join([str(port) for port in apps[app_name]['ports']])
+        lines.append('')
+        lines.append(f'    # 应用[{app_name}], 端口: {ports}')
+        lines.append(f'    location {prefix} {{')
+        lines.append(f'        proxy_pass   http://{apps[app_name]["upstream"]};')
+        lines.append('    }')
+    lines.append('}')
+    return ''.join([f'{line}\n' for line in lines])
+
+
+def remote_file_content(remote_path: str) -> str:
+    """
+    读取目标主机上的文本文件, 不存在时返回 None
+    """
+    try:
+        with current_session().sftp().open(remote_path, 'r') as f:
+            return f.read().decode('utf-8')
+    except IOError:
+        return None
+
+
+def cmd_gen_nginx_conf(args: argparse.Namespace):
+    """
+    * 取得目标主机上已安装的应用及其端口 (同时生成/更新各应用的 upstream 配置, 带 keepalive 长连接池)
+    * 在本机生成 server 配置和 proxy_cache_path 配置, 保存在 ~/.sz_deploy/nginx/<主机>/ 下, 便于检查
+    * 与目标主机上的配置有变化时, 通过 install_nginx_conf 相同的事务方式安装 (只检查一次, 失败时全部回滚)
+    """
+    _, results = setup_ops('nginx_apps', quiet = True)
+    registry = results[0]['data']
+    confs = {nginx_cache_conf: nginx_cache_content(),
+             f'{args.conf_name}.conf': nginx_server_content(registry, args)}
+
+    out_dir = os.path.join(local_state_dir, 'nginx', current_session().tag.replace(':', '_'))
+    os.makedirs(out_dir, exist_ok = True)
+    changed: List[str] = []
+    for name, content in confs.items():
+        conf_path = os.path.join(out_dir, name)
+        with open(conf_path, 'w') as f:
+            f.write(content)
+        if remote_file_content(os.path.join(nginx_conf_dir, name)) != content:
+            changed.append(conf_path)
+    if args.dry_run:
+        for name in confs:
+            info(f'生成的配置文件: {os.path.join(out_dir, name)}')
+        return
+
+    if len(changed) > 0:
+        apply_nginx_confs(changed)
+    elif len(registry['upstream_changed']) > 0:
+        # server 配置没有变化, 只有应用的 upstream (实例/端口) 有变化
+        setup_ops('reload_nginx')
+    else:
+        info('nginx 配置没有变化')
+
+
+def is_hashed_name(name: str) -> bool:
+    """
+    文件名中是否带有内容 hash. hash 中必须既有数字又有字母, 排除 banner-20230101.jpg 这样的日期和 deadbeef 这样的单词
+    """
+    m = hashed_name_pattern.search(name)
+    if m is None:
+        return False
+    h = m.group(1)
+    return any([c.isdigit() for c in h]) and any([c.isalpha() for c in h])
+
+
+def precompress_file(fpath: str, use_brotli: bool) -> Tuple[int, int]:
+    """
+    为一个静态资源生成 .gz (以及 .br) 压缩文件, 修改时间与源文件一致, 源文件没有变化时不重复压缩.
+    压缩效果不明显 (压缩后大于原文件的 90%) 时, 不生成压缩文件, 由 nginx 直接返回原文件.
+    压缩文件先写入临时文件再 rename, 不会写穿暂存目录中的硬链接
+
+    Returns
+    -------
+    (int, int)
+        元组: (原文件大小, gz 文件大小), 没有生成 gz 文件时为 0
+    """
+    st = os.stat(fpath)
+    gz_size = 0
+    siblings = [('.gz', lambda data: gzip.compress(data, compresslevel = 9, mtime = 0))]
+    if use_brotli:
+        siblings.append(('.br', lambda data: brotli.compress(data, quality = 11)))
+    data = None
+    for ext, compress in siblings:
+        sibling = fpath + ext
+        if os.path.exists(sibling) and os.stat(sibling).st_mtime_ns == st.st_mtime_ns:
+            size = os.path.getsize(sibling)
+        else:
+            if data is None:
+                with open(fpath, 'rb') as f:
+                    data = f.read()
+            compressed = compress(data)
+            if len(compressed) > len(data) * 0.9:
+                if os.path.exists(sibling):
+                    os.remove(sibling)
+                continue
+            with open(f'{sibling}.sz_tmp', 'wb') as f:
+                f.write(compressed)
+            os.utime(f'{sibling}.sz_tmp', ns = (st.st_atime_ns, st.st_mtime_ns))
+            os.replace(f'{sibling}.sz_tmp', sibling)
+            size = len(compressed)
+        if ext == '.gz':
+            gz_size = size
+    return (st.st_size, gz_size)
+
+
+def web_staging_dir(app_name: str) -> str:
+    return os.path.join(local_state_dir, 'web', app_name)
+
+
+def stage_web_app(web_local: str, staging: str) -> List[str]:
+    """
+    将 web 应用同步到本机的暂存目录, 预压缩文件只生成在暂存目录中, 不修改 (也不删除) 源目录中的任何文件.
+    文件优先使用硬链接, 不复制内容; 源文件被替换 (inode, 大小或者修改时间变化) 时重新链接
+
+    Returns
+    -------
+    List[str]
+        源目录中所有文件的相对路径
+    """
+    files: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(web_local):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, web_local)
+        dest_dir = os.path.normpath(os.path.join(staging, rel_dir))
+        if os.path.isfile(dest_dir):
+            os.remove(dest_dir)
+        os.makedirs(dest_dir, exist_ok = True)
+        for name in sorted(filenames):
+            src = os.path.join(dirpath, name)
+            dest = os.path.join(dest_dir, name)
+            files.append(os.path.normpath(os.path.join(rel_dir, name)))
+            st = os.stat(src)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            elif os.path.exists(dest):
+                dst = os.stat(dest)
+                if dst.st_ino == st.st_ino or (dst.st_size == st.st_size and dst.st_mtime_ns == st.st_mtime_ns):
+                    continue
+            try:
+                os.link(src, f'{dest}.sz_tmp')
+            except OSError:
+                # 跨文件系统等无法硬链接的情况, 复制文件
+                shutil.copy2(src, f'{dest}.sz_tmp')
+            os.replace(f'{dest}.sz_tmp', dest)
+    return files
+
+
+def precompress_web_app(web_local: str, staging: str, use_brotli: bool) -> List[str]:
+    """
+    将 web 应用同步到本机的暂存目录, 在暂存目录中并行的为可压缩的静态资源生成 .gz/.br 文件 (与原文件放在一起),
+    nginx 通过 gzip_static 直接返回, 不再为每个请求实时压缩. 暂存目录中源目录已经没有的文件 (包括过期的压缩文件) 被删除.
+    源目录中自带 .gz/.br 文件的资源不再压缩
+
+    Returns
+    -------
+    List[str]
+        web 应用中所有文件名带有内容 hash 的文件 (相对路径)
+    """
+    files = stage_web_app(web_local, staging)
+    file_set = set(files)
+    targets: List[str] = []
+    hashed: List[str] = []
+    for rel in files:
+        name = os.path.basename(rel)
+        if is_hashed_name(name):
+            hashed.append(rel)
+        if os.path.splitext(name)[1].lower() in web_compress_exts \
+                and f'{rel}.gz' not in file_set and f'{rel}.br' not in file_set \
+                and os.path.getsize(os.path.join(staging, rel)) >= web_compress_min_size:
+            targets.append(rel)
+
+    begin = time.time()
+    # zlib/brotli 压缩时释放 GIL, 线程池即可利用多核
+    with ThreadPoolExecutor(max_workers = os.cpu_count() or 4) as executor:
+        sizes = list(executor.map(lambda rel: precompress_file(os.path.join(staging, rel), use_brotli), targets))
+
+    # 清理暂存目录中多余的文件和目录
+    keep = file_set | {f'{rel}{ext}' for rel in targets for ext in ['.gz', '.br']}
+    for dirpath, dirnames, filenames in os.walk(staging, topdown = False):
+        for name in filenames:
+            fpath = os.path.join(dirpath, name)
+            if os.path.relpath(fpath, staging) not in keep:
+                os.remove(fpath)
+        if dirpath != staging and len(os.listdir(dirpath)) == 0:
+            os.rmdir(dirpath)
+
+    raw = sum([s for s, gz in sizes if gz > 0])
+    compressed = sum([gz for _, gz in sizes])
+    info(f'[precompress] {len([1 for _, gz in sizes if gz > 0])}/{len(targets)} 个文件, '
+         f'{raw} -> {compressed} bytes (gzip), 耗时 {time.time() - begin:.2f}s, 带 hash 的文件: {len(hashed)} 个')
+    return hashed
+
+
+def web_app_snippet(web_local: str, app_name: str, hashed: List[str], use_brotli: bool,
+                    immutable_dirs_arg: List[str] = []) -> str:
+    """
+    生成 web 应用的 nginx 配置片段 (在 server {} 中 include, 代替 location / 的配置):
+    * 所有请求优先返回预压缩的 .gz (.br) 文件
+    * 入口文件 (index.html 等) 不缓存, 每次向服务器确认
+    * 全部由带 hash 的文件组成的目录, 其他带 hash 的文件, 以及 immutable_dirs_arg 指定的目录 (相对路径), 长期缓存 (immutable)
+    """
+    hashed_set = set(hashed)
+    for d in immutable_dirs_arg:
+        d = os.path.normpath(d.strip('/'))
+        if not os.path.isdir(os.path.join(web_local, d)):
+            warn(f'--immutable_dir 指定的目录在 web 应用中不存在: [{d}]')
+            continue
+        for dirpath, _, filenames in os.walk(os.path.join(web_local, d)):
+            hashed_set.update([os.path.relpath(os.path.join(dirpath, name), web_local) for name in filenames
+                               if os.path.splitext(name)[1] not in ['.gz', '.br']])
+    # 目录 -> 目录树下是否全部都是带 hash 的文件
+    all_hashed = {}
+    for dirpath, _, filenames in os.walk(web_local, topdown = False):
+        rel_dir = os.path.relpath(dirpath, web_local)
+        ok = True
+        for name in filenames:
+            if os.path.splitext(name)[1] in ['.gz', '.br']:
+                continue
+            if os.path.normpath(os.path.join(rel_dir, name)) not in hashed_set:
+                ok = False
+        for sub, sub_ok in all_hashed.items():
+            if os.path.dirname(sub) == rel_dir and not sub_ok:
+                ok = False
+        all_hashed[rel_dir] = ok
+
+    immutable_dirs = sorted([d for d, ok in all_hashed.items()
+                             if ok and d != '.' and not all_hashed.get(os.path.dirname(d) or '.', False)])
+    immutable_files = sorted([f for f in hashed_set if not any([f.startswith(d + os.sep) for d in immutable_dirs])])
+
+    root = f'{web_apps_dir}{app_name}'
+    static = ['    gzip_static on;']
+    if use_brotli:
+        # 需要 nginx 加载 ngx_brotli 模块
+        static.append('    brotli_static on;')
+
+    lines: List[str] = []
+    lines.append('# 由 sz_deploy.py install_web_app --precompress 生成, 请勿手工修改')
+    lines.append(f'# 在 server {{}} 中 include 本文件, 代替 web 应用 [{app_name}] 的 location / 配置')
+    lines.append('location / {')
+    lines.append(f'    root   {root};')
+    lines.append('    index  index.html index.htm;')
+    lines.extend(static)
+    lines.append('    add_header Cache-Control "no-cache";')
+    lines.append('}')
+    for d in immutable_dirs:
+        lines.append(f'location ^~ /{d.replace(os.sep, "/")}/ {{')
+        lines.append(f'    root   {root};')
+        lines.extend(static)
+        lines.append(f'    add_header Cache-Control "{immutable_cache_control}";')
+        lines.append('}')
+    for f in immutable_files:
+        lines.append(f'location = /{f.replace(os.sep, "/")} {{')
+        lines.append(f'    root   {root};')
+        lines.extend(static)
+        lines.append(f'    add_header Cache-Control "{immutable_cache_control}";')
+        lines.append('}')
+    return ''.join([f'{line}\n' for line in lines])
+
+
+def prepare_web_app(args: argparse.Namespace):
+    """
+    在本机为 web 应用预压缩静态资源, 生成 nginx 配置片段, 无论部署到多少台目标主机, 只执行一次
+    """
+    args.web_snippet = None
+    args.web_staging = None
+    if not (args.precompress or args.brotli):
+        return
+    if not os.path.isdir(args.web_app):
+        return
+    use_brotli = args.brotli
+    if use_brotli and brotli is None:
+        warn('没有安装 brotli 模块 (pip install brotli), 只生成 .gz 预压缩文件')
+        use_brotli = False
+    app_name = args.app_name or os.path.basename(args.web_app)
+    staging = web_staging_dir(app_name)
+    hashed = precompress_web_app(args.web_app, staging, use_brotli)
+    args.web_staging = staging
+    args.web_snippet = web_app_snippet(staging, app_name, hashed, use_brotli, args.immutable_dir)
+
+
+def install_web_snippet(app_name: str, snippet: str):
+    """
+    上传 web 应用的 nginx 配置片段, 内容有变化时, 检查并平滑重新加载 nginx 配置
+    """
+    snippet_path = f'{web_snippets_dir}{app_name}.conf'
+    sftp = current_session().sftp()
+    try:
+        with sftp.open(snippet_path, 'r') as f:
+            if f.read().decode('utf-8') == snippet:
+                return
+    except IOError:
+        pass
+    sftp_makedirs(sftp, web_snippets_dir)
+    with sftp.open(f'{snippet_path}.sz_tmp', 'w') as f:
+        f.write(snippet.encode('utf-8'))
+    sftp.posix_rename(f'{snippet_path}.sz_tmp', snippet_path)
+    info(f'nginx 配置片段已更新: {snippet_path}, 请在 server {{}} 中 include 该文件')
+    code, _ = setup_ops('reload_nginx', exitOnError = False)
+    if code != 0:
+        warn('nginx 配置检查不通过, 请检查 include 了该配置片段的 server 配置')
 
 
 def cmd_install_web_app(args: argparse.Namespace):
     """
     * 检查 --web_app 指定的路径是否存在
     * 确定 app_name
-    * 远程创建目标目录
-    * rsync 传输文件
+    * 以镜像的方式同步到目标主机 (只上传变化的文件, 只修改变化的文件的所有者)
 
     Parameters
     ----------
@@ -196,32 +1718,43 @@ def cmd_install_web_app(args: argparse.Namespace):
 
     dest_dir = f'{web_apps_dir}{app_name}'
 
-    ssh_cmd(f'mkdir -p {dest_dir}')
-    rsync(f'{web_local}/*', dest_dir)
-    ssh_cmd(f'chown -R nginx:nginx {dest_dir}')
+    # 预压缩时, 上传的是本机暂存目录 (源目录 + 压缩文件)
+    mirror_dir(getattr(args, 'web_staging', None) or web_local, dest_dir, f'web_{app_name}', owner = 'nginx:nginx')
+    if getattr(args, 'web_snippet', None):
+        install_web_snippet(app_name, args.web_snippet)
     info("部署完毕")
 
 
 def cmd_uninstall_web_app(args: argparse.Namespace):
     app_name = args.app_name
     dest_dir = f'{web_apps_dir}{app_name}'
-    ssh_cmd(f'rm -rvf {dest_dir}')
+    # 先删除配置片段 (检查通过才生效), 避免 nginx 继续指向已经删除的目录
+    setup_ops(f'delete_web_snippet --app-name {shlex.quote(app_name)}')
+    ssh_cmd(f'rm -rvf {dest_dir} {manifests_dir}web_{app_name}.json', hideOutput = True, tag = app_name)
     info('删除完毕')
 
 
+def host_prefix() -> str:
+    session = getattr(_thread_ctx, 'session', None)
+    if show_host_tag and session is not None:
+        return f'[{session.tag}] '
+    return ''
+
+
 def info(msg: str):
-    print(Fore.GREEN + '==> ' + msg + Fore.RESET)
+    print(Fore.GREEN + '==> ' + host_prefix() + msg + Fore.RESET, file = log_file)
 
 
 def warn(msg: str):
-    print(Fore.YELLOW + '==> ' + msg + Fore.RESET)
+    print(Fore.YELLOW + '==> ' + host_prefix() + msg + Fore.RESET, file = log_file)
 
 
 def err(msg: str):
-    print(Fore.RED + '==> ' + msg + Fore.RESET)
+    print(Fore.RED + '==> ' + host_prefix() + msg + Fore.RESET, file = log_file)
 
 
-def shell(cmd: str, exitOnError: bool = True, useShell: bool = True, hideOutput: bool = False):
+def shell(cmd: str, exitOnError: bool = True, useShell: bool = True, hideOutput: bool = False, cwd: str = None,
+          tag: str = ''):
     """
     执行 shell 命令, 如果命令执行失败, 程序结束.
 
@@ -235,6 +1768,10 @@ def shell(cmd: str, exitOnError: bool = True, useShell: bool = True, hideOutput:
         是否使用shell, 默认为 True
     hideOutput : bool
         是否隐藏输出, 默认为 False, 不隐藏
+    cwd : str
+        命令执行的工作目录, 默认为当前目录
+    tag : str
+        输出的每一行前面加上的应用名称, 多个应用并行构建时区分输出, 默认为空
     """
     # info(cmd)
     # ret = os.system(cmd)
@@ -242,25 +1779,59 @@ def shell(cmd: str, exitOnError: bool = True, useShell: bool = True, hideOutput:
     #     if (ret != 0):
     #         err('Deploy operation failed.')
     #         sys.exit(ret)
+    if cancel_event.is_set():
+        warn(f'部署已取消, 不再执行: {cmd}')
+        sys.exit(1)
     info(cmd)
-    p = subprocess.Popen(cmd, stdout = subprocess.PIPE,
-                         stderr = subprocess.STDOUT, shell = useShell)
-    if not hideOutput:
-        for line in io.TextIOWrapper(p.stdout, encoding = 'utf-8'):
-            li = line.rstrip()
-            print(li)
-
-    ret = p.wait()
+    with tracer.span(cmd.split()[0], 'local', cmd = cmd) as span:
+        with _state_lock:
+            # 在独立的进程组中执行, 取消部署时可以终止命令启动的所有进程 (例如: gradle 脚本启动的 java 进程)
+            p = subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                                 stderr = subprocess.STDOUT, shell = useShell, cwd = cwd, start_new_session = True)
+            _local_procs.add(p)
+        try:
+            if not hideOutput:
+                for line in io.TextIOWrapper(p.stdout, encoding = 'utf-8'):
+                    li = line.rstrip()
+                    print(f'[{tag}] {li}' if tag else li, file = log_file)
+
+            ret = p.wait()
+        finally:
+            with _state_lock:
+                _local_procs.discard(p)
+        span['code'] = ret
     if exitOnError:
         if (ret != 0):
+            if cancel_event.is_set():
+                warn(f'部署已取消, 命令被终止: {cmd}')
+                sys.exit(1)
             err(f'operation failed. [return code: {ret}]')
             sys.exit(ret)
     return ret
 
 
-def ssh_cmd(cmd: str, exitOnError: bool = True, showPrefix: bool = True) -> (List[str], int):
+def cancel_local_work(reason: str):
+    """
+    取消部署: 终止本机正在执行的命令 (例如: gradle build), 之后 shell() 不再启动新的命令. 只有第一次调用生效
+    """
+    with _state_lock:
+        if cancel_event.is_set():
+            return
+        cancel_event.set()
+        procs = list(_local_procs)
+    warn(f'取消部署: {reason}')
+    for p in procs:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def ssh_cmd(cmd: str, exitOnError: bool = True, showPrefix: bool = True, hideOutput: bool = False,
+            dropLines: bool = True, tailLines: int = default_tail_lines, tag: str = '') -> (List[str], int):
     """
-    在目标主机上, 通过 ssh 执行命令.
+    在目标主机上, 通过 ssh 执行命令. 非阻塞的读取命令的 stdout 和 stderr, 输出交给打印线程, 只在内存中保留最后 tailLines 行,
+    输出再多 (例如: cat 大文件, unzip -v), 内存占用也不会增长, 终端输出慢也不会拖慢远程命令
 
     Parameters
     ----------
@@ -268,43 +1839,280 @@ def ssh_cmd(cmd: str, exitOnError: bool = True, showPrefix: bool = True) -> (Lis
         要在远程ssh主机上执行的命令字符串
     exitOnError : Bool
         命令执行失败的时候, 是否结束退出程序, 默认: True
+    showPrefix : bool
+        输出的每一行是否带上前缀 (主机/应用), 默认: True
+    hideOutput : bool
+        是否隐藏输出, 默认为 False; 隐藏时, 命令失败会输出最后 tailLines 行
+    dropLines : bool
+        终端输出过慢时, 是否允许丢弃输出行, 默认: True. 输出内容本身就是命令结果时应该为 False
+    tailLines : int
+        保留的最后的输出行数, 用于出错时报告
+    tag : str
+        输出前缀中的应用名称, 默认为空
 
     Returns
     ----------
     (List[str], int)
-        元组: (命令输出[列表], exit_status)
+        元组: (最后 tailLines 行命令输出[列表], exit_status)
     """
     info(f'[ssh] {cmd}')
-    global ssh_client
-    cmd_txt = f'{cmd} 2>&1'
-    _, stdout, _ = ssh_client.exec_command(cmd_txt)
-    output_lines = []
-    for line in io.TextIOWrapper(stdout, encoding = 'utf-8'):
-        li = line.rstrip()
-        output_lines.append(li)
+    session = current_session()
+    tail = collections.deque(maxlen = tailLines)
+    counts = {'lines': 0, 'bytes': 0, 'dropped': 0}
+    app_prefix = f'[{tag}] ' if tag else ''
+
+    def on_line(line: str, color: str):
+        tail.append(line)
+        counts['lines'] += 1
+        if hideOutput:
+            return
         if showPrefix:
-            print(Fore.BLUE + '==> ' + Fore.RESET + li)
-        else:
-            print(li)
-    ret = stdout.channel.recv_exit_status()
+            line = color + '==> ' + Fore.RESET + host_prefix() + app_prefix + line
+        if not output_printer.put(line, block = not dropLines):
+            counts['dropped'] += 1
+
+    stdout = LineSplitter(lambda line: on_line(line, Fore.BLUE))
+    stderr = LineSplitter(lambda line: on_line(line, Fore.YELLOW))
+    with tracer.span(cmd.split()[0], 'ssh', cmd = cmd) as span:
+        channel = session.client.get_transport().open_session()
+        channel.exec_command(cmd)
+        while True:
+            select.select([channel], [], [], 0.5)
+            while channel.recv_ready():
+                data = channel.recv(65536)
+                counts['bytes'] += len(data)
+                stdout.feed(data)
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(65536)
+                counts['bytes'] += len(data)
+                stderr.feed(data)
+            if channel.exit_status_ready() and (channel.eof_received or channel.closed) \
+                    and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+        stdout.feed(b'', final = True)
+        stderr.feed(b'', final = True)
+        ret = channel.recv_exit_status()
+        channel.close()
+        span.update(code = ret, lines = counts['lines'], output_bytes = counts['bytes'])
+    output_printer.flush()
+    if ret != 0 and (hideOutput or counts['dropped'] > 0):
+        err(f'[ssh] {cmd} 失败 [return code: {ret}], 最后 {len(tail)} 行输出:')
+        for line in tail:
+            print(Fore.RED + '==> ' + Fore.RESET + host_prefix() + app_prefix + line, file = log_file)
     if exitOnError:
         if ret != 0:
             sys.exit(ret)
-    return (output_lines, ret)
+    return (list(tail), ret)
+
+
+def setup_ops(*ops: str, exitOnError: bool = True, quiet: bool = False) -> Tuple[int, List[dict]]:
+    """
+    在目标主机上, 通过 sz_setup.py agent 一次往返执行一批 sz_setup.py 子命令.
+
+    Parameters
+    ----------
+    ops : str
+        sz_setup.py 子命令及参数, 例如: 'init --app-name api_server'
+    exitOnError : bool
+        操作执行失败的时候, 是否结束退出程序, 默认: True
+    quiet : bool
+        不输出要执行的操作, 默认: False
+
+    Returns
+    ----------
+    (int, List[dict])
+        元组: (整批操作的 exit code, 每个已执行操作的结果)
+    """
+    if not quiet:
+        for op in ops:
+            info(f'[setup] {op}')
+    req_ops = [{'argv': shlex.split(op)} for op in ops]
+
+    def on_log(index: int, line: str):
+        output_printer.put(Fore.BLUE + '==> ' + Fore.RESET + host_prefix() + line)
+
+    def on_result(result: dict):
+        # 操作在目标主机上的耗时由 agent 给出, 以收到结果的时间为结束时间
+        args = {'argv': ops[len(results_seen)], 'code': result['code']}
+        if isinstance(result.get('data'), dict) and 'ready_secs' in result['data']:
+            args['ready_secs'] = result['data']['ready_secs']
+        results_seen.append(result)
+        tracer.add(f'op:{result["cmd"]}', 'remote', time.perf_counter() - result['elapsed'], result['elapsed'], args)
+
+    results_seen: List[dict] = []
+    with tracer.span('batch', 'setup', ops = len(ops)) as span:
+        try:
+            agent = remote_agent()
+            ret, results = agent.call(req_ops, on_log = on_log, on_result = on_result)
+            if agent.outdated:
+                # 不支持校验的旧版本, 这批操作已经执行, 之后的操作使用重新上传的 sz_setup.py
+                warn('目标主机上的 sz_setup.py 是旧版本, 重新上传')
+                current_session().reset_agent()
+                deploy_setup_script(force = True)
+        except AgentUnavailable as e:
+            # 本机缓存的指纹已经过期 (例如: 容器被重建, 或者其他人部署了不同版本的 sz_setup.py), 强制重新上传后重试一次
+            warn(f'目标主机上的 sz_setup.py 不可用 ({e}), 重新上传')
+            session = current_session()
+            session.reset_agent()
+            deploy_setup_script(force = True)
+            ret, results = session.agent().call(req_ops, on_log = on_log, on_result = on_result)
+        span['code'] = ret
+    output_printer.flush()
+    if ret != 0:
+        failed = results[-1]['cmd'] if len(results) > 0 else ''
+        err(f'sz_setup.py {failed} failed. [return code: {ret}]')
+        if exitOnError:
+            sys.exit(ret)
+    return (ret, results)
+
+
+def current_session() -> SSHSession:
+    """
+    返回当前线程绑定的 ssh 会话
+    """
+    session = getattr(_thread_ctx, 'session', None)
+    if session is None:
+        raise Exception('当前线程没有连接目标主机')
+    return session
+
+
+def connect_ssh(host: str, port: int, ssh_key: str) -> SSHSession:
+    """
+    连接目标主机, 并将 ssh 会话绑定到当前线程
+    """
+    session = SSHSession(host, port, ssh_key)
+    _thread_ctx.session = session
+    session.connect()
+    return session
 
 
-def connect_ssh(host: str, port: int, ssh_key: str):
-    global ssh_client, dest_host, ssh_port, sshkey
-    dest_host = host
-    ssh_port = port
-    sshkey = ssh_key
-    ssh_client.connect(hostname = host, port = port,
-                       username = 'root', key_filename = sshkey)
+def disconnect_ssh():
+    session = getattr(_thread_ctx, 'session', None)
+    if session is not None:
+        session.close()
+        _thread_ctx.session = None
 
 
-def rsync(local_path: str, dest_path: str, delete: bool = True, excluded_del: List[str] = [], hideOutput: bool = False):
+class SyncStats(object):
+    """
+    一次文件同步操作的统计信息
     """
-    向目标主机, 通过 rsync 命令传输文件.
+
+    def __init__(self):
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.skipped_files = 0
+        self.deleted = 0
+
+
+def sync_excluded(name: str, is_dir: bool, excluded: List[str]) -> bool:
+    for pattern in excluded:
+        if pattern.endswith('/'):
+            if is_dir and fnmatch.fnmatch(name, pattern[:-1]):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def sftp_makedirs(sftp: SFTPClient, remote_dir: str):
+    """
+    在目标主机上递归创建目录, 相当于 mkdir -p
+    """
+    try:
+        if stat.S_ISDIR(sftp.stat(remote_dir).st_mode):
+            return
+    except IOError:
+        pass
+    parent = posixpath.dirname(remote_dir.rstrip('/'))
+    if parent and parent != remote_dir:
+        sftp_makedirs(sftp, parent)
+    try:
+        sftp.mkdir(remote_dir)
+    except IOError:
+        # 其他线程/进程可能已经创建了该目录
+        if not stat.S_ISDIR(sftp.stat(remote_dir).st_mode):
+            raise
+
+
+def sftp_put_file(sftp: SFTPClient, local_file: str, remote_file: str, stats: SyncStats,
+                  remote_attr: paramiko.SFTPAttributes = None):
+    """
+    上传单个文件, 大小和修改时间都与目标主机上的文件一致时跳过 (与 rsync 默认的 quick check 规则相同).
+    先上传到临时文件, 再 rename 覆盖目标文件, 避免目标主机上出现不完整的文件
+    """
+    st = os.stat(local_file)
+    if remote_attr is not None and stat.S_ISREG(remote_attr.st_mode) \
+            and remote_attr.st_size == st.st_size and remote_attr.st_mtime == int(st.st_mtime):
+        stats.skipped_files += 1
+        return
+
+    tmp_file = posixpath.join(posixpath.dirname(remote_file), f'.{posixpath.basename(remote_file)}.sz_tmp')
+    sftp.put(local_file, tmp_file, confirm = False)
+    sftp.chmod(tmp_file, stat.S_IMODE(st.st_mode))
+    sftp.utime(tmp_file, (int(st.st_atime), int(st.st_mtime)))
+    sftp.posix_rename(tmp_file, remote_file)
+    stats.sent_files += 1
+    stats.sent_bytes += st.st_size
+
+
+def sftp_sync_dir(sftp: SFTPClient, local_dir: str, remote_dir: str, delete: bool, excluded_del: List[str],
+                  stats: SyncStats, removals: List[str]):
+    sftp_makedirs(sftp, remote_dir)
+    remote_attrs = {a.filename: a for a in sftp.listdir_attr(remote_dir)}
+    local_names = sorted(os.listdir(local_dir))
+    for name in local_names:
+        local_path = os.path.join(local_dir, name)
+        remote_path = posixpath.join(remote_dir, name)
+        remote_attr = remote_attrs.get(name)
+        if os.path.islink(local_path):
+            if remote_attr is not None:
+                removals.append(remote_path)
+                flush_removals(removals, stats)
+            sftp.symlink(os.readlink(local_path), remote_path)
+            stats.sent_files += 1
+        elif os.path.isdir(local_path):
+            if remote_attr is not None and not stat.S_ISDIR(remote_attr.st_mode):
+                sftp.remove(remote_path)
+            sftp_sync_dir(sftp, local_path, remote_path, delete, excluded_del, stats, removals)
+        else:
+            if remote_attr is not None and stat.S_ISDIR(remote_attr.st_mode):
+                removals.append(remote_path)
+                flush_removals(removals, stats)
+                remote_attr = None
+            sftp_put_file(sftp, local_path, remote_path, stats, remote_attr)
+
+    if delete:
+        for name, attr in remote_attrs.items():
+            if name in local_names or name.endswith('.sz_tmp'):
+                continue
+            if sync_excluded(name, stat.S_ISDIR(attr.st_mode), excluded_del):
+                continue
+            removals.append(posixpath.join(remote_dir, name))
+
+
+def flush_removals(removals: List[str], stats: SyncStats):
+    """
+    在目标主机上, 用一条 rm -rf 命令删除所有收集到的多余文件/目录
+    """
+    if len(removals) == 0:
+        return
+    paths = ' '.join([shlex.quote(p) for p in removals])
+    _, stdout, _ = current_session().client.exec_command(f'rm -rf {paths}')
+    stdout.channel.recv_exit_status()
+    stats.deleted += len(removals)
+    removals.clear()
+
+
+def sftp_sync(local_path: str, dest_path: str, delete: bool = True, excluded_del: List[str] = [],
+              hideOutput: bool = False) -> SyncStats:
+    """
+    通过当前 ssh 会话已认证的连接 (sftp 子系统), 向目标主机同步文件, 不再为每次传输建立新的 ssh 连接.
+    同步规则与 rsync -a 一致:
+    * local_path 为文件时, 传输到 dest_path 目录下
+    * local_path 为目录时, 在 dest_path 下创建同名子目录; 以 / 结尾时, 传输目录下的内容
+    * local_path 可以使用通配符, 例如: conf/*
+    * 大小和修改时间都未变化的文件不会被重复传输
 
     Parameters
     ----------
@@ -318,14 +2126,431 @@ def rsync(local_path: str, dest_path: str, delete: bool = True, excluded_del: Li
         目标机器上本应该被删除的文件, 按照此参数进行排除
     hideOutput : bool
         是否隐藏输出内容, 默认不隐藏
+
+    Returns
+    ----------
+    SyncStats
+        本次同步的统计信息
+    """
+    if not hideOutput:
+        info(f'[sftp] {local_path} -> {dest_path}')
+    begin = time.time()
+    sftp = current_session().sftp()
+    stats = SyncStats()
+    removals: List[str] = []
+    with tracer.span('sftp', 'transfer', src = local_path, dest = dest_path) as span:
+        if glob.has_magic(local_path):
+            sources = sorted(glob.glob(local_path))
+        else:
+            sources = [local_path]
+
+        for src in sources:
+            if not os.path.exists(src):
+                err(f'File [{src}] does not exists.')
+                sys.exit(-1)
+            if os.path.isdir(src):
+                if src.endswith('/'):
+                    remote_dir = dest_path
+                else:
+                    remote_dir = posixpath.join(dest_path, os.path.basename(src))
+                sftp_sync_dir(sftp, src, remote_dir, delete, excluded_del, stats, removals)
+            else:
+                sftp_makedirs(sftp, dest_path)
+                remote_file = posixpath.join(dest_path, os.path.basename(src))
+                try:
+                    remote_attr = sftp.stat(remote_file)
+                except IOError:
+                    remote_attr = None
+                sftp_put_file(sftp, src, remote_file, stats, remote_attr)
+        flush_removals(removals, stats)
+        span.update(bytes = stats.sent_bytes, files = stats.sent_files, skipped = stats.skipped_files,
+                    deleted = stats.deleted)
+
+    if not hideOutput:
+        elapsed = max(time.time() - begin, 0.001)
+        info(f'[sftp] sent {stats.sent_files} files, {stats.sent_bytes} bytes ({stats.sent_bytes / elapsed / 1024 / 1024:.1f} MB/s), '
+             f'unchanged {stats.skipped_files} files, deleted {stats.deleted}')
+    return stats
+
+
+def mirror_cache_path(key: str) -> str:
+    return os.path.join(local_state_dir, 'mirror', f'{key}.json')
+
+
+def local_manifest(local_dir: str) -> dict:
     """
-    global dest_host, ssh_port, sshkey
-    if delete and len(excluded_del) > 0:
-        excluded_expr = ' '.join([f'--exclude "{it}"' for it in excluded_del])
-        cmd = f'rsync -av --delete {excluded_expr} --progress -e "ssh -i {sshkey} -p {ssh_port}" {local_path} root@{dest_host}:{dest_path}'
+    本机目录的 manifest, 文件 hash 缓存在 ~/.sz_deploy/mirror/ 下, 没有变化的文件不重新计算 hash
+    """
+    cache_path = mirror_cache_path('local_' + hashlib.sha1(os.path.abspath(local_dir).encode('utf-8')).hexdigest())
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    old_cache = dict(cache)
+    files = sz_setup.scan_manifest(local_dir, cache)
+    if cache != old_cache:
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        with open(f'{cache_path}.{threading.get_ident()}.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(f'{cache_path}.{threading.get_ident()}.tmp', cache_path)
+    return files
+
+
+def remote_manifest(name: str, remote_dir: str, digest: str) -> dict:
+    """
+    目标主机上的 manifest. 本机缓存的 (上次部署的) manifest 与目标主机上的 digest 一致时, 不需要下载
+    """
+    session = current_session()
+    cache_path = mirror_cache_path(f'{session.host}_{session.port}_{name}')
+    if digest is None:
+        # 目标主机上还没有 manifest (例如: 以前通过 rsync 部署的目录), 先扫描生成
+        _, results = setup_ops(f'manifest_build --name {name} --dir {shlex.quote(remote_dir)}')
+        digest = results[-1]['data']['digest']
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() == digest:
+            return json.loads(data)['files']
+    with current_session().sftp().open(f'{manifests_dir}{name}.json', 'r') as f:
+        f.prefetch()
+        data = f.read()
+    return json.loads(data)['files']
+
+
+def mirror_dir(local_dir: str, remote_dir: str, name: str, owner: str = '',
+               delete: bool = True) -> Tuple[SyncStats, List[str], List[str]]:
+    """
+    以镜像的方式将本机目录同步到目标主机, 适用于文件数量很多的目录 (例如: web 应用).
+    * 目标主机上为每个镜像目录保存一个 manifest (文件的大小, hash, 权限), 与本机目录比较, 得到变化的文件和删除的文件
+    * 变化的文件打包成一个 tar, 一次上传, 在目标主机上一次解包; 删除的文件由目标主机删除
+    * 只修改变化的文件的所有者, 不再对整个目录 chown -R
+    * 没有任何变化时, 只需要扫描本机目录 (有 hash 缓存) 和一次 agent 往返
+
+    Parameters
+    ----------
+    local_dir : str
+        本机目录
+    remote_dir : str
+        目标主机上的目录
+    name : str
+        manifest 名称, 每个镜像目录一个, 例如: web_<应用名称>
+    owner : str
+        变化的文件的所有者 user:group, 默认不修改
+    delete : bool
+        是否删除本机目录中已经删除的文件, 默认: True
+
+    Returns
+    -------
+    (SyncStats, List[str], List[str])
+        元组: (统计信息, 变化的文件[相对路径], 删除的文件[相对路径])
+    """
+    info(f'[mirror] {local_dir} -> {remote_dir}')
+    begin = time.time()
+    stats = SyncStats()
+    files = local_manifest(local_dir)
+    new_bytes = sz_setup.manifest_bytes(files)
+    new_digest = hashlib.sha256(new_bytes).hexdigest()
+
+    _, results = setup_ops(f'manifest_digest --name {name}')
+    digest = results[-1]['data']['digest']
+    session = current_session()
+    cache_path = mirror_cache_path(f'{session.host}_{session.port}_{name}')
+    if digest == new_digest:
+        stats.skipped_files = len(files)
+        info(f'[mirror] 没有变化, {len(files)} 个文件, 耗时 {time.time() - begin:.2f}s')
+        return (stats, [], [])
+
+    old_files = remote_manifest(name, remote_dir, digest)
+    changed = sorted([rel for rel, it in files.items() if old_files.get(rel) != it])
+    deleted = sorted([rel for rel in old_files if rel not in files]) if delete else []
+    stats.skipped_files = len(files) - len(changed)
+    stats.deleted = len(deleted)
+
+    def strip_owner(ti: tarfile.TarInfo) -> tarfile.TarInfo:
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = ''
+        return ti
+
+    tmp_dir = f'{manifests_dir}tmp/'
+    sftp = session.sftp()
+    sftp_makedirs(sftp, tmp_dir)
+    with tracer.span('mirror', 'transfer', manifest = name, files = len(changed), deleted = len(deleted)) as span:
+        with sftp.open(f'{tmp_dir}{name}.tar', 'w') as remote:
+            remote.set_pipelined(True)
+            with tarfile.open(fileobj = remote, mode = 'w|', bufsize = 1024 * 1024) as tar:
+                for rel in changed:
+                    tar.add(os.path.join(local_dir, rel), arcname = rel, recursive = False, filter = strip_owner)
+                    stats.sent_bytes += files[rel][0]
+            stats.sent_files = len(changed)
+        with sftp.open(f'{tmp_dir}{name}.plan.json', 'w') as f:
+            f.write(json.dumps({'deleted': deleted}).encode('utf-8'))
+        with sftp.open(f'{tmp_dir}{name}.json', 'w') as f:
+            f.set_pipelined(True)
+            f.write(new_bytes)
+        span['bytes'] = stats.sent_bytes
+
+    owner_arg = f' --owner {shlex.quote(owner)}' if owner else ''
+    setup_ops(f'mirror_apply --name {name} --dir {shlex.quote(remote_dir)}{owner_arg}')
+    os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+    with open(cache_path, 'wb') as f:
+        f.write(new_bytes)
+    info(f'[mirror] 上传 {stats.sent_files} 个文件, {stats.sent_bytes} bytes, 删除 {stats.deleted} 个文件, '
+         f'未变化 {stats.skipped_files} 个文件, 耗时 {time.time() - begin:.2f}s')
+    return (stats, changed, deleted)
+
+
+def add_host_args(parser: argparse.ArgumentParser):
+    """
+    为子命令添加目标主机相关的参数
+    """
+    parser.add_argument('--host',
+                        help = '目标主机IP, 可以重复指定多个, 默认:127.0.0.1',
+                        action = 'append',
+                        type = host_arg,
+                        metavar = "127.0.0.1")
+    parser.add_argument('--hosts-file',
+                        action = PathArgAction,
+                        help = '目标主机清单文件, 每行一个 host[:port], # 开头的行为注释',
+                        metavar = '~/work/test_env/hosts.txt')
+    parser.add_argument('--port',
+                        help = '目标主机ssh服务端口,默认:10022',
+                        type = int,
+                        default = default_ssh_port,
+                        metavar = '10022')
+    parser.add_argument('--ssh-key',
+                        action = PathArgAction,
+                        help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
+                        default = os.path.expanduser('~/.ssh/id_rsa'),
+                        metavar = '~/.ssh/id_rsa')
+    parser.add_argument('--force-setup',
+                        help = '忽略本机缓存的指纹, 强制检查并更新目标主机上的 sz_setup.py',
+                        action = 'store_true')
+    parser.add_argument('--parallel',
+                        help = f'同时进行部署操作的目标主机数量上限,默认:{default_parallel}',
+                        type = int,
+                        default = default_parallel,
+                        metavar = f'{default_parallel}')
+    parser.add_argument('--timing',
+                        help = '结束时输出各阶段(构建, 传输, 目标主机上的操作)的耗时汇总',
+                        action = 'store_true')
+    parser.add_argument('--trace',
+                        action = PathArgAction,
+                        help = '将各阶段的耗时导出为 Chrome trace 格式的 json 文件, 同时输出耗时汇总',
+                        metavar = '~/deploy_trace.json')
+
+
+def add_restart_args(parser: argparse.ArgumentParser):
+    """
+    为子命令添加应用重启和就绪检查相关的参数, 就绪检查参数会保存在目标主机上, 之后的部署沿用
+    """
+    parser.add_argument('--rolling',
+                        help = '滚动重启: 逐个实例从 nginx upstream 摘除/重启/就绪后加回, 多台目标主机时逐台进行',
+                        action = 'store_true')
+    parser.add_argument('--drain-timeout',
+                        help = '滚动重启时, 等待实例上正在处理的请求结束的最长秒数, 默认:30',
+                        type = float,
+                        metavar = '30')
+    parser.add_argument('--app-port',
+                        help = '应用服务监听的 http 端口, 多实例时为起始端口, auto 表示由目标主机自动分配, 默认:9000',
+                        type = sz_setup.port_arg,
+                        metavar = '9000')
+    parser.add_argument('--instances',
+                        help = '应用的实例 (进程) 数量, auto 表示按目标主机的 CPU 核数计算 (每个实例 2 核), 默认:1',
+                        type = sz_setup.count_arg,
+                        metavar = 'N|auto')
+    parser.add_argument('--ready-tcp',
+                        help = '就绪检查: 应用端口可以连接 (默认)',
+                        action = 'store_true',
+                        default = None)
+    parser.add_argument('--no-ready-tcp',
+                        help = '就绪检查: 不检查应用端口. 没有配置任何就绪检查时, 进程持续运行 5 秒才算启动成功',
+                        action = 'store_false',
+                        dest = 'ready_tcp')
+    parser.add_argument('--ready-http',
+                        help = '就绪检查: 应用端口上的 http 路径返回成功, 空字符串表示不检查',
+                        metavar = '/api/ping')
+    parser.add_argument('--ready-log',
+                        help = '就绪检查: 启动后应用日志中出现的正则表达式, 空字符串表示不检查',
+                        metavar = 'Started')
+    parser.add_argument('--ready-timeout',
+                        help = '就绪检查超时秒数, 默认:120',
+                        type = float,
+                        metavar = '120')
+    parser.add_argument('--jvm-heap',
+                        help = 'JVM 堆大小, 默认: auto (容器内存在同一主机的所有 JVM 之间平分, 其中 --jvm-heap-percent 作为堆)',
+                        metavar = '512m')
+    parser.add_argument('--jvm-heap-percent',
+                        help = '--jvm-heap 为 auto 时, 每个 JVM 分到的内存中堆所占的百分比, 默认:60',
+                        type = int,
+                        metavar = '60')
+    parser.add_argument('--jvm-gc',
+                        help = '垃圾回收器, 默认: auto (分到的 CPU 少于 2 核或者堆小于 1792M 时为 serial, 否则为 g1)',
+                        choices = ['auto', 'serial', 'parallel', 'g1', 'z', 'shenandoah'])
+    parser.add_argument('--cds',
+                        help = '在目标主机上为每个新版本生成 AppCDS 归档, 加快应用启动',
+                        action = 'store_true',
+                        default = None)
+    parser.add_argument('--no-cds',
+                        help = '不使用 AppCDS 归档',
+                        action = 'store_false',
+                        dest = 'cds')
+    parser.add_argument('--jvm-opts',
+                        help = '附加的 JVM 参数, 空字符串表示没有',
+                        metavar = '"-Xss512k"')
+    parser.add_argument('--reload-files',
+                        help = '应用可以不重启就重新加载的配置文件 (相对于配置目录, 可以使用通配符), 部署 conf 时只有这些文件变化则不重启. '
+                               'scan="true" 的 logback.xml 和设置了 monitorInterval 的 log4j2.xml 不需要指定. 不带值表示清空',
+                        nargs = '*',
+                        metavar = 'logback.xml')
+    parser.add_argument('--reload-signal',
+                        help = '只有 --reload-files 中的文件变化时, 向应用发送的信号, 例如: HUP. 默认不发送 (应用自行检测文件变化), 空字符串表示不发送',
+                        metavar = 'HUP')
+
+
+def parse_host(txt: str, default_port: int) -> Tuple[str, int]:
+    """
+    解析 host[:port], IPv6 地址带端口时需要加上方括号: [::1]:10022; 不带端口时可以不加: ::1
+    """
+    txt = txt.strip()
+    if txt.startswith('['):
+        host, sep, port = txt[1:].partition(']')
+        if not sep or (port and not port.startswith(':')):
+            raise argparse.ArgumentTypeError(f'非法的目标主机: {txt}, IPv6 地址的格式为: [::1]:10022')
+        port = port[1:]
+    elif txt.count(':') > 1:
+        # 没有方括号的 IPv6 地址, 不能带端口
+        host, port = txt, ''
     else:
-        cmd = f'rsync -av --progress -e "ssh -i {sshkey} -p {ssh_port}" {local_path} root@{dest_host}:{dest_path}'
-    shell(cmd, hideOutput = hideOutput)
+        host, _, port = txt.partition(':')
+    if host == '':
+        raise argparse.ArgumentTypeError(f'非法的目标主机: {txt}')
+    if port == '':
+        return (host, default_port)
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise argparse.ArgumentTypeError(f'非法的目标主机端口: {txt}')
+    return (host, int(port))
+
+
+def host_label(host: str, port: int) -> str:
+    """
+    输出用的 host:port, IPv6 地址加上方括号
+    """
+    return f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+
+
+def host_arg(txt: str) -> str:
+    """
+    检查 --host 参数的格式, 端口在 load_hosts() 中与 --port 一起确定
+    """
+    parse_host(txt, default_ssh_port)
+    return txt.strip()
+
+
+def load_hosts(args: argparse.Namespace) -> List[Tuple[str, int]]:
+    """
+    根据 --host 和 --hosts-file 参数, 返回目标主机清单 [(host, port)], 去掉重复的主机, 保持原有顺序
+
+    Parameters
+    ----------
+    args : 命令行参数对象
+
+    Returns
+    -------
+    List[Tuple[str, int]]
+        目标主机清单
+    """
+    items: List[str] = list(args.host or [])
+    if args.hosts_file:
+        if not os.path.exists(args.hosts_file):
+            err(f'File [{args.hosts_file}] does not exists.')
+            sys.exit(-1)
+        with open(args.hosts_file, 'r') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    items.append(line)
+    if len(items) == 0:
+        items.append(default_host)
+
+    hosts: List[Tuple[str, int]] = []
+    for it in items:
+        try:
+            host = parse_host(it, args.port)
+        except argparse.ArgumentTypeError as e:
+            err(f'{args.hosts_file}: {e}')
+            sys.exit(2)
+        if host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+def run_on_host(host: str, port: int, action, args: argparse.Namespace) -> HostResult:
+    """
+    在当前线程中连接一台目标主机, 并执行子命令. 子命令执行失败时的 sys.exit() 在这里被捕获, 记录到结果中,
+    不影响其他主机上的部署
+    """
+    result = HostResult(host, port)
+    begin = time.time()
+    try:
+        with tracer.span('connect', 'ssh'):
+            connect_ssh(host = host, port = port, ssh_key = args.ssh_key)
+        with tracer.span(args.cmd_name, 'host'):
+            result.data = action(args)
+    except SystemExit as e:
+        if e.code is None:
+            result.exit_code = 0
+        else:
+            result.exit_code = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        err(f'{type(e).__name__}: {e}')
+        result.exit_code = 1
+        result.error = str(e)
+    finally:
+        disconnect_ssh()
+        result.elapsed = time.time() - begin
+    return result
+
+
+def run_on_hosts(hosts: List[Tuple[str, int]], action, args: argparse.Namespace) -> List[HostResult]:
+    """
+    同时在多台目标主机上执行子命令, 同时执行的主机数量不超过 --parallel 指定的值
+
+    Returns
+    -------
+    List[HostResult]
+        每台主机的执行结果, 顺序与 hosts 一致
+    """
+    global show_host_tag
+    show_host_tag = len(hosts) > 1
+    workers = max(1, min(args.parallel, len(hosts)))
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(run_on_host, host, port, action, args) for host, port in hosts]
+        try:
+            return [f.result() for f in futures]
+        except KeyboardInterrupt:
+            # 退出 with 时会等待各主机的线程结束, 需要先通知它们
+            if getattr(args, 'follow', False):
+                # logs --follow 通过 Ctrl-C 正常退出, 各主机的线程在当前这次查询结束后退出
+                cancel_event.set()
+            else:
+                # 本机的命令在独立的进程组中, 收不到终端的 Ctrl-C, 需要主动终止
+                cancel_local_work('用户中断')
+            raise
+
+
+def print_host_summary(results: List[HostResult]):
+    info('各目标主机执行结果:')
+    width = max([len(host_label(r.host, r.port)) for r in results])
+    for r in results:
+        name = host_label(r.host, r.port).ljust(width)
+        if r.ok:
+            print(f'    {name}  {Fore.GREEN}OK{Fore.RESET}      {r.elapsed:7.1f}s')
+        else:
+            print(f'    {name}  {Fore.RED}FAILED{Fore.RESET}  {r.elapsed:7.1f}s  [return code: {r.exit_code}] {r.error}')
+    failed = len([r for r in results if not r.ok])
+    if failed > 0:
+        err(f'{failed}/{len(results)} 台主机执行失败')
 
 
 def main():
@@ -337,23 +2562,27 @@ def main():
     # <editor-fold desc="子命令: app">
     deployapp_parser = subcmds.add_parser('app', help = '部署[应用]到目标服务器')
     deployapp_parser.add_argument('--prj-dir',
+                                  action = PathListArgAction,
+                                  nargs = '+',
+                                  help = '[应用]对应的gradle工程目录路径, 可以指定多个, 按指定的顺序重启',
+                                  metavar = '~/work/vertx-web-mutli/api_server')
+    deployapp_parser.add_argument('--apps-file',
                                   action = PathArgAction,
-                                  help = '[应用]对应的gradle工程目录路径,必填参数',
-                                  metavar = '~/work/vertx-web-mutli/api_server', required = True)
-    deployapp_parser.add_argument('--host',
-                                  help = '目标主机IP,默认:127.0.0.1',
-                                  default = "127.0.0.1",
-                                  metavar = "127.0.0.1")
-    deployapp_parser.add_argument('--port',
-                                  help = '目标主机ssh服务端口,默认:10022',
+                                  help = '要部署的应用清单 (json), 可以声明应用之间的依赖关系 (重启顺序), 格式见 load_app_builds()',
+                                  metavar = '~/work/test_env/apps.json')
+    deployapp_parser.add_argument('--build-jobs',
+                                  help = f'同时进行的 gradle 构建数量上限 (同一个多工程构建中的应用只有一次构建), 默认: CPU 核数 ({os.cpu_count()})',
                                   type = int,
-                                  default = 10022,
-                                  metavar = '10022')
-    deployapp_parser.add_argument('--ssh-key',
-                                  action = PathArgAction,
-                                  help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                  default = '~/.ssh/id_rsa',
-                                  metavar = '~/.ssh/id_rsa')
+                                  default = os.cpu_count() or 1)
+    deployapp_parser.add_argument('--min-free-mb',
+                                  help = '部署前检查目标主机的剩余空间, 除了新版本需要的空间之外, 还需要保留的 MB 数, 默认: 256',
+                                  type = int,
+                                  default = 256)
+    deployapp_parser.add_argument('--no-build-cache',
+                                  help = '不使用构建缓存, 总是执行 gradle build',
+                                  action = 'store_true')
+    add_restart_args(deployapp_parser)
+    add_host_args(deployapp_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: conf">
@@ -368,20 +2597,8 @@ def main():
                                    help = '[应用]对应的gradle工程目录路径,必填参数',
                                    metavar = '~/work/vertx-web-mutli/api_server',
                                    required = True)
-    deployconf_parser.add_argument('--host',
-                                   help = '目标主机IP,默认:127.0.0.1',
-                                   default = "127.0.0.1",
-                                   metavar = "127.0.0.1")
-    deployconf_parser.add_argument('--port',
-                                   help = '目标主机ssh服务端口,默认:10022',
-                                   type = int,
-                                   default = 10022,
-                                   metavar = '10022')
-    deployconf_parser.add_argument('--ssh-key',
-                                   action = PathArgAction,
-                                   help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                   default = '~/.ssh/id_rsa',
-                                   metavar = '~/.ssh/id_rsa')
+    add_restart_args(deployconf_parser)
+    add_host_args(deployconf_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: undeploy">
@@ -392,39 +2609,13 @@ def main():
                                  help = '[应用]对应的gradle工程目录路径,必填参数',
                                  metavar = '~/work/vertx-web-mutli/api_server',
                                  required = True)
-    undeploy_parser.add_argument('--host',
-                                 help = '目标主机IP,默认:127.0.0.1',
-                                 default = "127.0.0.1",
-                                 metavar = "127.0.0.1")
-    undeploy_parser.add_argument('--port',
-                                 help = '目标主机ssh服务端口,默认:10022',
-                                 type = int,
-                                 default = 10022,
-                                 metavar = '10022')
-    undeploy_parser.add_argument('--ssh-key',
-                                 action = PathArgAction,
-                                 help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                 default = '~/.ssh/id_rsa',
-                                 metavar = '~/.ssh/id_rsa')
+    add_host_args(undeploy_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: list_nginx_conf">
     list_nginx_conf_parser = subcmds.add_parser('list_nginx_conf',
                                                 help = '列出服务器上 /etc/nginx/conf.d/ 下所有的配置文件')
-    list_nginx_conf_parser.add_argument('--host',
-                                        help = '目标主机IP,默认:127.0.0.1',
-                                        default = "127.0.0.1",
-                                        metavar = "127.0.0.1")
-    list_nginx_conf_parser.add_argument('--port',
-                                        help = '目标主机ssh服务端口,默认:10022',
-                                        type = int,
-                                        default = 10022,
-                                        metavar = '10022')
-    list_nginx_conf_parser.add_argument('--ssh-key',
-                                        action = PathArgAction,
-                                        help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                        default = '~/.ssh/id_rsa',
-                                        metavar = '~/.ssh/id_rsa')
+    add_host_args(list_nginx_conf_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: dump_nginx_conf">
@@ -433,65 +2624,70 @@ def main():
     dump_nginx_conf_parser.add_argument('--conf',
                                         help = '指定的 nginx 配置文件名称(仅文件名)',
                                         required = True)
-    dump_nginx_conf_parser.add_argument('--host',
-                                        help = '目标主机IP,默认:127.0.0.1',
-                                        default = "127.0.0.1",
-                                        metavar = "127.0.0.1")
-    dump_nginx_conf_parser.add_argument('--port',
-                                        help = '目标主机ssh服务端口,默认:10022',
-                                        type = int,
-                                        default = 10022,
-                                        metavar = '10022')
-    dump_nginx_conf_parser.add_argument('--ssh-key',
-                                        action = PathArgAction,
-                                        help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                        default = '~/.ssh/id_rsa',
-                                        metavar = '~/.ssh/id_rsa')
+    add_host_args(dump_nginx_conf_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: install_nginx_conf">
     install_nginx_conf_parser = subcmds.add_parser('install_nginx_conf',
-                                                   help = '部署/更新指定的 nginx 配置文件')
+                                                   help = '部署/更新指定的 nginx 配置文件, 多个配置文件一起检查/生效, 失败时全部回滚')
     install_nginx_conf_parser.add_argument('--conf',
-                                           action = PathArgAction,
-                                           help = '本地需要部署目标服务器的 nginx 配置文件路径',
+                                           action = PathListArgAction,
+                                           nargs = '+',
+                                           help = '本地需要部署目标服务器的 nginx 配置文件路径, 可以指定多个',
                                            required = True)
-    install_nginx_conf_parser.add_argument('--host',
-                                           help = '目标主机IP,默认:127.0.0.1',
-                                           default = "127.0.0.1",
-                                           metavar = "127.0.0.1")
-    install_nginx_conf_parser.add_argument('--port',
-                                           help = '目标主机ssh服务端口,默认:10022',
-                                           type = int,
-                                           default = 10022,
-                                           metavar = '10022')
-    install_nginx_conf_parser.add_argument('--ssh-key',
-                                           action = PathArgAction,
-                                           help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                           default = '~/.ssh/id_rsa',
-                                           metavar = '~/.ssh/id_rsa')
+    add_host_args(install_nginx_conf_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: uninstall_nginx_conf">
     uninstall_nginx_conf_parser = subcmds.add_parser('uninstall_nginx_conf',
                                                      help = '从目标主机里删除指定的 nginx 配置')
     uninstall_nginx_conf_parser.add_argument('--conf',
-                                             help = '需要删除的 nginx 配置文件名称(仅文件名)',
+                                             help = '需要删除的 nginx 配置文件名称(仅文件名), 可以指定多个',
+                                             nargs = '+',
                                              required = True)
-    uninstall_nginx_conf_parser.add_argument('--host',
-                                             help = '目标主机IP,默认:127.0.0.1',
-                                             default = "127.0.0.1",
-                                             metavar = "127.0.0.1")
-    uninstall_nginx_conf_parser.add_argument('--port',
-                                             help = '目标主机ssh服务端口,默认:10022',
-                                             type = int,
-                                             default = 10022,
-                                             metavar = '10022')
-    uninstall_nginx_conf_parser.add_argument('--ssh-key',
-                                             action = PathArgAction,
-                                             help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                             default = '~/.ssh/id_rsa',
-                                             metavar = '~/.ssh/id_rsa')
+    add_host_args(uninstall_nginx_conf_parser)
+    # </editor-fold>
+
+    # <editor-fold desc="子命令: gen_nginx_conf">
+    gen_nginx_conf_parser = subcmds.add_parser('gen_nginx_conf',
+                                               help = '根据目标主机上已安装的应用及其端口生成 nginx 配置 (upstream 长连接, proxy 缓冲/缓存), 检查通过后生效')
+    gen_nginx_conf_parser.add_argument('--route',
+                                       help = '转发规则: <路径前缀>=<应用名称>, 可以指定多个. 目标主机上只安装了一个应用时, 默认为: /api/=<该应用>',
+                                       type = route_arg,
+                                       nargs = '+',
+                                       metavar = '/api/=api_server')
+    gen_nginx_conf_parser.add_argument('--static-app',
+                                       help = '/builtinstatic/ 转发到的应用, 默认为第一条转发规则的应用',
+                                       default = '')
+    gen_nginx_conf_parser.add_argument('--web-app',
+                                       help = f'location / 对应的 web 站点 ({web_apps_dir} 下的子目录), 只部署了一个站点时默认为该站点',
+                                       default = '')
+    gen_nginx_conf_parser.add_argument('--server-name',
+                                       help = '域名, 默认: _ (匹配任意域名)',
+                                       default = '_')
+    gen_nginx_conf_parser.add_argument('--listen',
+                                       help = '监听端口, 可以指定多个, 默认: 80',
+                                       nargs = '+',
+                                       default = ['80'])
+    gen_nginx_conf_parser.add_argument('--ssl-cert',
+                                       help = '目标主机上的证书文件路径, 指定时同时监听 443 (https)',
+                                       default = '')
+    gen_nginx_conf_parser.add_argument('--ssl-key',
+                                       help = '目标主机上的证书私钥文件路径',
+                                       default = '')
+    gen_nginx_conf_parser.add_argument('--static-cache-valid',
+                                       help = '/builtinstatic/ 的缓存时间, 默认: 10m',
+                                       default = '10m')
+    gen_nginx_conf_parser.add_argument('--open-file-cache-valid',
+                                       help = 'web 站点文件描述符缓存的校验间隔, 默认: 30s',
+                                       default = '30s')
+    gen_nginx_conf_parser.add_argument('--conf-name',
+                                       help = '生成的 server 配置文件名称 (不含 .conf), 默认: sz_site',
+                                       default = 'sz_site')
+    gen_nginx_conf_parser.add_argument('--dry-run',
+                                       help = '只生成配置文件 (保存在 ~/.sz_deploy/nginx/<主机>/ 下), 不安装',
+                                       action = 'store_true')
+    add_host_args(gen_nginx_conf_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: install_web_app">
@@ -504,20 +2700,18 @@ def main():
     install_web_app_parser.add_argument('--app_name',
                                         help = 'web 应用的名称, 以该名称在目标服务器上创建子目录进行部署. 如果不指定, 则以 --web_app 指定的目录的目录名为应用名称',
                                         default = '')
-    install_web_app_parser.add_argument('--host',
-                                        help = '目标主机IP,默认:127.0.0.1',
-                                        default = "127.0.0.1",
-                                        metavar = "127.0.0.1")
-    install_web_app_parser.add_argument('--port',
-                                        help = '目标主机ssh服务端口,默认:10022',
-                                        type = int,
-                                        default = 10022,
-                                        metavar = '10022')
-    install_web_app_parser.add_argument('--ssh-key',
-                                        action = PathArgAction,
-                                        help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                        default = '~/.ssh/id_rsa',
-                                        metavar = '~/.ssh/id_rsa')
+    install_web_app_parser.add_argument('--precompress',
+                                        help = f'上传前为可压缩的静态资源生成 .gz 文件, 并生成 nginx 配置片段 (gzip_static, 带 hash 的文件长期缓存) 上传到 {web_snippets_dir}',
+                                        action = 'store_true')
+    install_web_app_parser.add_argument('--brotli',
+                                        help = '同时生成 .br 文件 (需要安装 brotli 模块, nginx 需要 ngx_brotli 模块), 包含 --precompress',
+                                        action = 'store_true')
+    install_web_app_parser.add_argument('--immutable_dir',
+                                        help = '--precompress 时, 该目录 (相对于 web 应用的路径, 例如: assets) 下的文件长期缓存 (immutable), '
+                                               '用于文件名中的 hash 不是 16 进制的构建工具 (例如: vite), 可以指定多次',
+                                        action = 'append',
+                                        default = [])
+    add_host_args(install_web_app_parser)
     # </editor-fold>
 
     # <editor-fold desc="子命令: uninstall_web_app">
@@ -526,20 +2720,50 @@ def main():
     uninstall_web_app_parser.add_argument('--app_name',
                                           help = '要删除的 web 应用的名称',
                                           default = '')
-    uninstall_web_app_parser.add_argument('--host',
-                                          help = '目标主机IP,默认:127.0.0.1',
-                                          default = "127.0.0.1",
-                                          metavar = "127.0.0.1")
-    uninstall_web_app_parser.add_argument('--port',
-                                          help = '目标主机ssh服务端口,默认:10022',
-                                          type = int,
-                                          default = 10022,
-                                          metavar = '10022')
-    uninstall_web_app_parser.add_argument('--ssh-key',
-                                          action = PathArgAction,
-                                          help = '用于ssh登录的证书路径,默认:~/.ssh/id_rsa',
-                                          default = '~/.ssh/id_rsa',
-                                          metavar = '~/.ssh/id_rsa')
+    add_host_args(uninstall_web_app_parser)
+    # </editor-fold>
+
+    # <editor-fold desc="子命令: status">
+    status_parser = subcmds.add_parser('status',
+                                       help = '查看目标服务器上所有应用的状态和资源占用 (内存/CPU/文件描述符/日志), 以及主机的整体容量')
+    status_parser.add_argument('--json',
+                               help = '以 json 格式输出 (以 host:port 为键), 其他信息输出到 stderr',
+                               action = 'store_true')
+    add_host_args(status_parser)
+    # </editor-fold>
+
+    # <editor-fold desc="子命令: logs">
+    logs_parser = subcmds.add_parser('logs',
+                                     help = '输出应用日志中新写入的行, 本机记录每个日志文件读到的位置, 再次执行时只输出新的内容')
+    logs_parser.add_argument('--app-name',
+                             help = '应用名称, 可以指定多个, 默认: 目标主机上的所有应用',
+                             nargs = '+',
+                             default = [],
+                             metavar = 'api_server')
+    logs_parser.add_argument('--file',
+                             help = '日志文件名称的通配符 (应用的 logs 目录下), 默认: *.log',
+                             default = '*.log')
+    logs_parser.add_argument('--grep',
+                             help = '只输出匹配该正则表达式的行, 在目标主机上过滤',
+                             default = '')
+    logs_parser.add_argument('-i', '--ignore-case',
+                             help = '--grep 忽略大小写',
+                             action = 'store_true')
+    logs_parser.add_argument('-n', '--lines',
+                             help = '第一次查看 (或者 --reset) 时, 每个文件输出的最后行数 (在 --grep 过滤之前计数), 默认: 20',
+                             type = int,
+                             default = 20)
+    logs_parser.add_argument('-f', '--follow',
+                             help = '持续输出新写入的行, Ctrl-C 退出',
+                             action = 'store_true')
+    logs_parser.add_argument('--interval',
+                             help = '--follow 时查询的间隔秒数, 默认: 1',
+                             type = float,
+                             default = 1.0)
+    logs_parser.add_argument('--reset',
+                             help = '忽略本机记录的位置, 重新从每个文件的最后 --lines 行开始',
+                             action = 'store_true')
+    add_host_args(logs_parser)
     # </editor-fold>
 
     cmd_actions = {
@@ -550,8 +2774,11 @@ def main():
         'dump_nginx_conf': cmd_dump_nginx_conf,
         'install_nginx_conf': cmd_install_nginx_conf,
         'uninstall_nginx_conf': cmd_uninstall_nginx_conf,
+        'gen_nginx_conf': cmd_gen_nginx_conf,
         'install_web_app': cmd_install_web_app,
-        'uninstall_web_app': cmd_uninstall_web_app
+        'uninstall_web_app': cmd_uninstall_web_app,
+        'status': cmd_status,
+        'logs': cmd_logs
     }
 
     args = top_parser.parse_args()
@@ -559,12 +2786,54 @@ def main():
     if not args.cmd_name:
         top_parser.print_help()
         sys.exit(1)
+    if args.cmd_name == 'gen_nginx_conf' and bool(args.ssl_cert) != bool(args.ssl_key):
+        top_parser.error('--ssl-cert 和 --ssl-key 需要同时指定')
+
+    # 只需要在本机执行一次的步骤(例如: 编译构建), 在连接目标主机之前完成
+    local_actions = {
+        'app': build_app_zip,
+        'install_web_app': prepare_web_app
+    }
+
+    global force_setup_script, log_file
+    force_setup_script = args.force_setup
+    if getattr(args, 'json', False):
+        log_file = sys.stderr
+    hosts = load_hosts(args)
+    args.host_count = len(hosts)
+    if getattr(args, 'follow', False):
+        # 持续输出日志时, 每台主机一个线程
+        args.parallel = max(args.parallel, len(hosts))
+    if getattr(args, 'rolling', False):
+        if args.instances is not None or args.app_port is not None:
+            # 实例数量和端口变化时, 只能整体重新加载 supervisor 的进程组
+            err('滚动部署不能修改实例数量或端口 (--instances, --app-port), 请去掉 --rolling')
+            sys.exit(2)
+        # 滚动部署时, 多台目标主机也逐台进行, 保证任何时刻只有一部分实例不提供服务
+        args.parallel = 1
+    if args.cmd_name in local_actions:
+        local_actions[args.cmd_name](args)
 
     action = cmd_actions[args.cmd_name]
-    connect_ssh(host = args.host, port = args.port, ssh_key = args.ssh_key)
-    deploy_setup_script()
+    try:
+        results = run_on_hosts(hosts, action, args)
+    except KeyboardInterrupt:
+        if getattr(args, 'follow', False):
+            sys.exit(0)
+        cancel_local_work('用户中断')
+        raise
+    if args.cmd_name == 'status':
+        print_fleet_status(results, args.json)
+    elif len(results) > 1:
+        print_host_summary(results)
+    if args.timing or args.trace:
+        tracer.print_summary()
+    if args.trace:
+        tracer.export_chrome_trace(args.trace)
+    failed = [r for r in results if not r.ok]
+    if len(failed) > 0:
+        sys.exit(failed[0].exit_code or 1)
 
-    action(args)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
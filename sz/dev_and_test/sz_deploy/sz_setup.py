@@ -6,24 +6,81 @@
     目录结构说明
     1. /etc/supervisor/conf.d/  每个应用服务, 一个独立的服务配置文件, 文件名为应用服务名称
     2. /sz/apps/        应用服务的部署目录, 在该目录, 每个应用服务一个独立的子目录, 子目录名为应用服务名称
+        /sz/apps/<应用名称>/releases/<版本>   每次部署的版本一个独立的目录, 版本名称取制品 sha256 的前16位
+        /sz/apps/<应用名称>/current           符号链接, 指向当前运行的版本
+        /sz/apps/<应用名称>/logs, h2db        各版本共用的目录, 不随版本切换
     3. /sz/configs/     应用服务的配置文件目录, 在该目录, 每个应用服务一个独立的子目录, 子目录名为应用服务名称
+    4. /sz/deploy/profiles/  每个应用服务一个 <应用名称>.json, 保存端口, 就绪检查, JVM 运行参数等部署参数
+    5. /sz/deploy/manifests/ 以镜像方式同步的目录 (例如: web 应用), 每个目录一个 <名称>.json, 记录目录下所有文件的大小, hash, 权限
 """
 
 import argparse
+import configparser
+import contextlib
+import fnmatch
+import functools
+import grp
+import hashlib
+import http.client
 import io
+import json
 import os
+import pwd
+import shlex
 import shutil
+import stat
 import subprocess
 import sys
 import time
 import pathlib
-from typing import List
-
-supervisor_conf_dir = '/etc/supervisor/conf.d/'
-apps_dir = '/sz/apps/'
-app_configs_dir = '/sz/deploy/configs/'
-apps_zip_dir = '/sz/deploy/zips/'
-nginx_conf_dir = '/etc/nginx/conf.d/'
+import re
+import socket
+import tarfile
+import urllib.parse
+import urllib.request
+import xmlrpc.client
+import zipfile
+from typing import List, Tuple
+
+# 以下目录都位于根目录 root_dir 之下, 默认为 /; 可以通过环境变量 SZ_SETUP_ROOT 指定其他的根目录,
+# 例如: 基准测试 (sz_bench.py) 在本机的临时目录中模拟目标主机
+root_dir = os.environ.get('SZ_SETUP_ROOT', '').rstrip('/')
+
+supervisor_conf_dir = f'{root_dir}/etc/supervisor/conf.d/'
+apps_dir = f'{root_dir}/sz/apps/'
+app_configs_dir = f'{root_dir}/sz/deploy/configs/'
+apps_zip_dir = f'{root_dir}/sz/deploy/zips/'
+app_profiles_dir = f'{root_dir}/sz/deploy/profiles/'
+artifact_store_dir = f'{root_dir}/sz/deploy/zips/store/'
+manifests_dir = f'{root_dir}/sz/deploy/manifests/'
+nginx_conf_dir = f'{root_dir}/etc/nginx/conf.d/'
+web_apps_dir = f'{root_dir}/web_html/'
+# install_web_app --precompress 生成的 nginx 配置片段所在的目录
+web_snippets_dir = f'{root_dir}/etc/nginx/sz_web/'
+# supervisord 的主配置文件, 从中读取 XML-RPC 的 unix socket 路径
+supervisord_main_conf = f'{root_dir}/etc/supervisor/supervisord.conf'
+
+# 端口登记表, 记录各应用占用的端口范围
+port_registry_path = f'{app_profiles_dir}ports.json'
+# 没有配置任何就绪检查时, supervisor startsecs 的最小值
+no_probe_startsecs = 5
+# 自动分配端口时的起始端口
+auto_port_start = 9000
+# nginx upstream 中每个 worker 进程保持的到应用的空闲长连接数量
+upstream_keepalive = 32
+
+# tail_logs 每次最多返回的日志字节数, 剩余的内容由下一次调用返回
+tail_max_bytes = 1024 * 1024
+
+# 调用 supervisord XML-RPC 接口的超时秒数 (停止进程组时, 需要等待进程退出)
+supervisor_rpc_timeout = 120
+
+# 每个应用在制品库中保留的最近使用过的制品数量, 用于回滚
+artifact_keep = 5
+# 每个应用保留的版本目录数量, 用于回滚
+release_keep = 5
+# 各版本共用的目录
+shared_dirs = ['logs', 'h2db']
 
 
 def code_to_chars(code):
@@ -87,7 +144,8 @@ def shell(cmd: str) -> int:
         需要执行的命令字符串
     """
     info(cmd)
-    p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = True)
+    # agent 模式下, stdin 是与部署端通信的通道, 子进程不能读取它
+    p = subprocess.Popen(cmd, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = True)
     for line in io.TextIOWrapper(p.stdout, encoding = 'utf-8'):
         li = line.rstrip()
         print(li)
@@ -112,7 +170,33 @@ def app_home_dir(app_name: str) -> str:
 
 
 def app_script_path(app_name: str) -> str:
-    return f'{apps_dir}{app_name}/bin/{app_name}'
+    return f'{apps_dir}{app_name}/current/bin/{app_name}'
+
+
+def app_releases_dir(app_name: str) -> str:
+    return f'{apps_dir}{app_name}/releases/'
+
+
+def app_current_link(app_name: str) -> str:
+    return f'{apps_dir}{app_name}/current'
+
+
+def app_release_history(app_name: str) -> List[str]:
+    """
+    返回应用依次激活过的版本列表, 最后一个为当前版本
+    """
+    try:
+        with open(f'{app_releases_dir(app_name)}history.json', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+def app_current_release(app_name: str) -> str:
+    link = app_current_link(app_name)
+    if not os.path.islink(link):
+        return ''
+    return os.path.basename(os.readlink(link))
 
 
 def app_conf_dir(app_name: str) -> str:
@@ -123,6 +207,53 @@ def app_sz_props_url(app_name: str) -> str:
     return f'{app_conf_dir(app_name)}/sz.app.properties'
 
 
+def app_profile_path(app_name: str) -> str:
+    return f'{app_profiles_dir}{app_name}.json'
+
+
+def load_app_profile(app_name: str) -> dict:
+    """
+    读取应用的部署参数, 没有设置过的参数使用默认值
+    * port: 应用服务监听的 http 端口, 多实例时为起始端口; auto 表示由端口登记表自动分配
+    * instances: 实例 (进程) 数量, auto 表示按 CPU 核数计算
+    * startsecs: supervisor 认为进程启动成功需要持续运行的秒数, 没有配置任何就绪检查时至少为 no_probe_startsecs
+    * ready: 就绪检查, tcp (是否检查端口可连接, 默认检查应用登记的端口), http (检查的 http 路径), log (日志中出现的正则表达式), timeout (超时秒数)
+    * drain_timeout: 滚动重启时, 等待实例上正在处理的请求结束的最长秒数
+    * jvm: JVM 运行参数, heap (堆大小, 例如: 512m; auto 表示按容器内存和同一主机上的 JVM 数量计算),
+      heap_percent (auto 时, 每个 JVM 分到的内存中堆所占的百分比), gc (auto/serial/parallel/g1/z/shenandoah),
+      cds (每个版本生成 AppCDS 归档, 加快启动), opts (附加的 JVM 参数)
+    * reload: 应用可以不重启就重新加载的配置文件, files (相对于配置目录的通配符), signal (这些文件变化时发送的信号, 空字符串表示不发送)
+    """
+    profile = {
+        'port': 9000,
+        'instances': 1,
+        'startsecs': 1,
+        'drain_timeout': 30,
+        'ready': {'tcp': True, 'http': '', 'log': '', 'timeout': 120},
+        'jvm': {'heap': 'auto', 'heap_percent': 60, 'gc': 'auto', 'cds': False, 'opts': ''},
+        'reload': {'files': [], 'signal': ''}
+    }
+    try:
+        with open(app_profile_path(app_name), 'r') as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        saved = {}
+    for key, value in saved.items():
+        if isinstance(value, dict) and isinstance(profile.get(key), dict):
+            profile[key].update(value)
+        else:
+            profile[key] = value
+    return profile
+
+
+def save_app_profile(app_name: str, profile: dict):
+    os.makedirs(app_profiles_dir, exist_ok = True)
+    fpath = app_profile_path(app_name)
+    with open(f'{fpath}.tmp', 'w') as f:
+        json.dump(profile, f, indent = 2, sort_keys = True)
+    os.replace(f'{fpath}.tmp', fpath)
+
+
 def app_supervisord_conf(app_name: str) -> str:
     """
     返回指定的应用服务对应的 supervisor 配置文件路径
@@ -194,45 +325,1550 @@ def app_supervisor_exists(app_name: str) -> bool:
     return os.path.exists(conf_path)
 
 
+def read_int_file(fpath: str) -> int:
+    """
+    读取只包含一个整数的文件 (例如: cgroup 的限制), 文件不存在或者内容不是整数 (例如: max) 时返回 0
+    """
+    try:
+        with open(fpath, 'r') as f:
+            return int(f.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+def container_memory_limit() -> int:
+    """
+    容器可以使用的内存字节数: cgroup (v2/v1) 的内存限制与主机物理内存中较小的一个
+    """
+    with open('/proc/meminfo', 'r') as f:
+        total = int(f.readline().split()[1]) * 1024
+    limit = read_int_file('/sys/fs/cgroup/memory.max') or read_int_file('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    return min(limit, total) if limit > 0 else total
+
+
+def container_cpu_limit() -> float:
+    """
+    容器可以使用的 CPU 核数: cgroup (v2/v1) 的 CPU 配额, 没有配额时为 CPU 核数
+    """
+    cpus = float(os.cpu_count() or 1)
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return min(cpus, int(quota) / int(period))
+    except (IOError, ValueError):
+        quota = read_int_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = read_int_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if quota > 0 and period > 0:
+            return min(cpus, quota / period)
+    return cpus
+
+
+def parse_size(text: str) -> int:
+    """
+    解析 JVM 风格的大小, 例如: 512m, 2g, 返回字节数
+    """
+    m = re.fullmatch(r'(\d+)([kmg]?)', text.strip().lower())
+    if m is None:
+        raise Exception(f'无法识别的大小: [{text}], 例如: 512m, 2g')
+    return int(m.group(1)) * {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[m.group(2)]
+
+
+def installed_jvm_apps(app_name: str) -> List[str]:
+    """
+    同一主机上运行的 (部署在 /sz/apps/ 下的) 应用, 包括正在部署的应用
+    """
+    apps = [it['name'] for it in supervisor_programs() if it['directory'].startswith(apps_dir)]
+    return apps if app_name in apps else apps + [app_name]
+
+
+_java_version = None
+
+
+def java_version() -> int:
+    """
+    目标主机上 java 的主版本号 (例如: 8, 11, 17), 找不到 java 时返回 0 (agent 进程中只运行一次 java -version)
+    """
+    global _java_version
+    if _java_version is None:
+        _java_version = 0
+        java = java_bin()
+        if java:
+            p = subprocess.run([java, '-version'], stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+            m = re.search(r'version "(\d+)(?:\.(\d+))?', p.stdout.decode('utf-8', 'replace'))
+            if m is not None:
+                major = int(m.group(1))
+                # 1.8.0_xxx -> 8
+                _java_version = int(m.group(2) or 0) if major == 1 else major
+    return _java_version
+
+
+def java_bin() -> str:
+    java_home = os.environ.get('JAVA_HOME', '')
+    if java_home and os.access(os.path.join(java_home, 'bin', 'java'), os.X_OK):
+        return os.path.join(java_home, 'bin', 'java')
+    return shutil.which('java') or ''
+
+
+def app_cds_archive(app_name: str, release_id: str) -> str:
+    return f'{app_releases_dir(app_name)}{release_id}/cds/{app_name}.jsa'
+
+
+def app_current_cds_archive(app_name: str) -> str:
+    # 经由 current 符号链接引用当前版本的归档, JVM 参数不随版本变化
+    return f'{app_current_link(app_name)}/cds/{app_name}.jsa'
+
+
+def app_jvm_options_path(app_name: str) -> str:
+    return f'{app_home_dir(app_name)}/jvm.options'
+
+
+def jvm_options(app_name: str) -> List[str]:
+    """
+    由应用的 JVM 运行参数生成 JAVA_OPTS 中的 JVM 参数.
+    heap 为 auto 时, 容器内存在同一主机上的所有 JVM 之间平分, 每个 JVM 分到的内存中 heap_percent% 作为堆,
+    其余留给元空间, 线程栈, 直接内存等; -Xms 与 -Xmx 相同, 各应用占用的内存上限在启动时就确定, 不会互相挤占
+    """
+    jvm = load_app_profile(app_name)['jvm']
+    apps = installed_jvm_apps(app_name)
+    jvm_count = sum([len(app_instances(it)) for it in apps])
+    cpus = container_cpu_limit() / jvm_count
+    version = java_version()
+
+    if jvm['heap'] == 'auto':
+        share = container_memory_limit() // jvm_count
+        heap_mb = max(64, share * jvm['heap_percent'] // 100 // 1024 // 1024)
+    else:
+        heap_mb = max(1, parse_size(jvm['heap']) // 1024 // 1024)
+
+    gc = jvm['gc']
+    if gc == 'auto':
+        # 与 JVM 自身的选择规则一致: 分到的 CPU 少于 2 核, 或者堆小于 1792M 时, G1 的额外开销不划算
+        gc = 'serial' if cpus < 2 or heap_mb < 1792 else 'g1'
+    gc_flags = {
+        'serial': ['-XX:+UseSerialGC'],
+        'parallel': ['-XX:+UseParallelGC'],
+        'g1': ['-XX:+UseG1GC'],
+        'z': ['-XX:+UseZGC'],
+        'shenandoah': ['-XX:+UseShenandoahGC']
+    }
+    if gc not in gc_flags:
+        raise Exception(f'应用[{app_name}]的 JVM 参数 gc 不支持: [{gc}], 可选值: auto, {", ".join(gc_flags)}')
+
+    opts = [f'-Xms{heap_mb}m', f'-Xmx{heap_mb}m'] + gc_flags[gc]
+    if version == 0 or version >= 10:
+        # 多个 JVM 共用容器的 CPU 时, GC/JIT 线程数按各自分到的核数计算
+        opts.append(f'-XX:ActiveProcessorCount={max(1, round(cpus))}')
+        opts.append('-XX:+ExitOnOutOfMemoryError')
+    if jvm['cds']:
+        archive = app_current_cds_archive(app_name)
+        if os.path.exists(archive):
+            opts.extend([f'-XX:SharedArchiveFile={archive}', '-Xshare:auto'])
+    opts.extend(shlex.split(jvm['opts']))
+    info(f'应用[{app_name}] JVM 参数: {" ".join(opts)} (同一主机上 {jvm_count} 个 JVM, java 版本: {version or "未知"})')
+    return opts
+
+
+def supervisor_env_value(value: str, expand: str = '') -> str:
+    """
+    supervisor 配置中 environment 的值: 放在双引号中, % 需要写成 %% (否则会被当作 %(ENV_X)s 展开), 转义 \\ 和 ".
+    expand 原样追加在值的末尾, 用于需要 supervisor 展开的表达式, 例如: %(process_num)d
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('%', '%%') + expand + '"'
+
+
+def write_jvm_options(app_name: str) -> bool:
+    """
+    生成应用的 JVM 参数文件 (jvm.options), 进程每次启动时读取, 修改后逐个重启实例即可生效, 不需要重新加载 supervisor 的进程组
+
+    Returns
+    -------
+    bool
+        文件内容是否有变化
+    """
+    fpath = app_jvm_options_path(app_name)
+    text = ' '.join([f'-Dsz.properties.url=file://{app_sz_props_url(app_name)}'] + jvm_options(app_name)) + '\n'
+    try:
+        with open(fpath, 'r') as f:
+            if f.read() == text:
+                return False
+    except IOError:
+        pass
+    with open(f'{fpath}.tmp', 'w') as f:
+        f.write(text)
+    os.replace(f'{fpath}.tmp', fpath)
+    return True
+
+
 # noinspection PyListCreation
 def setup_app_supervisor(app_name: str):
+    """
+    生成应用的 supervisor 配置. 多实例时, 利用 numprocs_start 使每个进程的 process_num 就是它的端口,
+    通过环境变量 APP_PORT 和 JAVA_OPTS 中的 -Dsz.app.port 传给应用.
+    JAVA_OPTS 在进程启动时由 jvm.options 生成, 因此 supervisor 配置只在端口, 实例数量, startsecs 变化时才会变化
+    """
     conf_path = app_supervisord_conf(app_name)
+    base, count = assign_app_ports(app_name)
+    write_jvm_options(app_name)
+    port = '%(process_num)d' if count > 1 else str(base)
+    env = {
+        'APP_PORT': supervisor_env_value('', expand = port)
+    }
+    command = (f'JAVA_OPTS="$(cat {app_jvm_options_path(app_name)}) -Dsz.app.port=$APP_PORT"; export JAVA_OPTS; '
+               f'exec {app_script_path(app_name)}')
     lines: List[str] = []
     lines.append(f'[program:{app_name}]')
+    if count > 1:
+        lines.append('process_name=%(program_name)s_%(process_num)d')
+        lines.append(f'numprocs={count}')
+        lines.append(f'numprocs_start={base}')
     lines.append(f'directory={app_home_dir(app_name)}')
-    lines.append(f'command={app_script_path(app_name)}')
-    lines.append(f'environment=JAVA_OPTS="-Dsz.properties.url=file://{app_sz_props_url(app_name)}"')
+    lines.append(f"command=/bin/sh -c '{command}'")
+    lines.append('environment=' + ','.join([f'{key}={value}' for key, value in env.items()]))
     lines.append('autostart=true')
     lines.append('autorestart=false')
-    lines.append('startsecs=5')
+    # 是否真正可以提供服务, 由 wait_ready 进行就绪检查, 这里只需要能发现启动后立即退出的情况
+    lines.append(f'startsecs={app_startsecs(load_app_profile(app_name))}')
 
     with open(conf_path, 'w') as f:
         f.writelines([f'{line}\n' for line in lines])
+    update_jvm_shares(app_name)
 
 
-def start_app(app_name: str):
-    if not app_supervisor_exists(app_name):
-        info(f'应用服务[{app_name}]未安装')
-        return
-    shell(f'supervisorctl start {app_name}')
+def update_jvm_shares(app_name: str):
+    """
+    应用安装/卸载, 或者实例数量变化后, 同一主机上的 JVM 数量随之变化, 重新生成其它应用的 jvm.options (堆大小, CPU 核数).
+    正在运行的实例仍然使用启动时的参数, 给出警告: 在它们重启之前, 各 JVM 的内存之和可能超过容器的内存
+    """
+    for name in installed_jvm_apps(app_name):
+        if name == app_name:
+            continue
+        if not os.path.exists(app_jvm_options_path(name)):
+            warn(f'应用[{name}]的 JVM 参数在 supervisor 配置中 (旧的部署方式), 重新部署后才会按同一主机上的 JVM 数量重新计算')
+            continue
+        if not write_jvm_options(name):
+            continue
+        running = [it['process'] for it in supervisor_status([f'{name}:*'], quiet = True)
+                   if it['state'] in ['RUNNING', 'STARTING']]
+        if running:
+            warn(f'同一主机上的 JVM 数量有变化, 应用[{name}]的 JVM 参数已重新计算, 正在运行的 {len(running)} 个实例重启后生效 '
+                 f'(可以使用 rolling_restart), 在此之前各 JVM 的内存之和可能超过容器的内存')
+
+
+def app_startsecs(profile: dict) -> int:
+    """
+    supervisor 的 startsecs. 没有配置任何就绪检查时, 进程运行 startsecs 秒就被认为就绪, 不能太短
+    """
+    ready = profile['ready']
+    if ready['tcp'] or ready['http'] or ready['log']:
+        return profile['startsecs']
+    return max(profile['startsecs'], no_probe_startsecs)
 
 
-def stop_app(app_name: str):
-    if not app_supervisor_exists(app_name):
-        info(f'应用服务[{app_name}]未安装')
-        return
-    shell(f'supervisorctl stop {app_name}')
+def app_start_state_path(app_name: str) -> str:
+    return f'{app_home_dir(app_name)}/.start_state.json'
 
 
-def status_of(app_name):
-    if not app_supervisor_exists(app_name):
-        info(f'应用服务[{app_name}]未安装')
+def log_offsets(app_name: str) -> dict:
+    """
+    返回应用 logs 目录下每个文件当前的大小, 就绪检查只在启动之后新写入的日志中查找
+    """
+    logs_dir = f'{app_home_dir(app_name)}/logs'
+    offsets = {}
+    if os.path.isdir(logs_dir):
+        for name in os.listdir(logs_dir):
+            fpath = os.path.join(logs_dir, name)
+            if os.path.isfile(fpath):
+                offsets[name] = os.path.getsize(fpath)
+    return offsets
+
+
+class UnixSocketHTTPConnection(http.client.HTTPConnection):
+    """
+    通过 unix socket 连接的 http 连接
+    """
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__('localhost', timeout = timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class UnixSocketTransport(xmlrpc.client.Transport):
+    """
+    xmlrpc.client 通过 unix socket 发送请求, 同一个连接在多次调用之间复用
+    """
+
+    def __init__(self, socket_path: str, timeout: float = supervisor_rpc_timeout):
+        super().__init__()
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        # get_host_info() 处理 url 中的 user:password, 生成 Authorization 请求头
+        _, self._extra_headers, _ = self.get_host_info(host)
+        self._connection = host, UnixSocketHTTPConnection(self.socket_path, self.timeout)
+        return self._connection[1]
+
+
+class SupervisorRpc(object):
+    """
+    直接调用 supervisord 的 XML-RPC 接口 (unix socket), 代替每个操作 fork 一个 supervisorctl 进程.
+    对多个进程的同一类操作, 合并为一次 system.multicall 请求
+    """
+
+    def __init__(self, socket_path: str, username: str = '', password: str = ''):
+        auth = f'{urllib.parse.quote(username)}:{urllib.parse.quote(password)}@' if username else ''
+        self.proxy = xmlrpc.client.ServerProxy(f'http://{auth}localhost/RPC2',
+                                               transport = UnixSocketTransport(socket_path))
+
+    def call(self, method: str, *params):
+        """
+        调用一个方法, 例如: call('supervisor.getProcessInfo', 'api_server'), 失败时抛出 xmlrpc.client.Fault
+        """
+        return functools.reduce(getattr, method.split('.'), self.proxy)(*params)
+
+    def multicall(self, calls: List[Tuple[str, list]]) -> list:
+        """
+        一次请求中按顺序执行多个调用
+
+        Parameters
+        ----------
+        calls : List[Tuple[str, list]]
+            [(方法名称, 参数列表)]
+
+        Returns
+        -------
+        list
+            每个调用的结果, 调用失败时为 xmlrpc.client.Fault 对象 (不抛出异常)
+        """
+        if len(calls) == 0:
+            return []
+        results = self.proxy.system.multicall([{'methodName': method, 'params': list(params)}
+                                               for method, params in calls])
+        return [xmlrpc.client.Fault(r['faultCode'], r['faultString'])
+                if isinstance(r, dict) and 'faultCode' in r else r for r in results]
+
+
+def supervisor_server_conf() -> Tuple[str, str, str]:
+    """
+    从 supervisord 的配置文件中读取 supervisorctl 连接 supervisord 使用的 unix socket 路径和认证信息
+
+    Returns
+    -------
+    Tuple[str, str, str]
+        (unix socket 路径, 用户名, 密码), 没有启用 unix socket 时路径为空字符串
+    """
+    parser = configparser.RawConfigParser(strict = False, inline_comment_prefixes = (';', '#'))
+    try:
+        parser.read(supervisord_main_conf)
+    except configparser.Error:
+        return ('', '', '')
+    url = parser.get('supervisorctl', 'serverurl', fallback = '')
+    if url.startswith('unix://'):
+        path = url[len('unix://'):]
+    elif url == '':
+        path = parser.get('unix_http_server', 'file', fallback = '')
+    else:
+        return ('', '', '')
+    username = parser.get('supervisorctl', 'username', fallback = parser.get('unix_http_server', 'username', fallback = ''))
+    password = parser.get('supervisorctl', 'password', fallback = parser.get('unix_http_server', 'password', fallback = ''))
+    return (path, username, password)
+
+
+_supervisor_rpc = None
+
+
+def supervisor_rpc() -> SupervisorRpc:
+    """
+    返回 supervisord 的 XML-RPC 客户端 (agent 进程中只连接一次). supervisord 没有启用 unix socket,
+    或者无法连接时返回 None, 调用方改用 supervisorctl 命令
+    """
+    global _supervisor_rpc
+    if _supervisor_rpc is None:
+        path, username, password = supervisor_server_conf()
+        rpc = False
+        if path and os.path.exists(path):
+            try:
+                client = SupervisorRpc(path, username, password)
+                client.call('supervisor.getAPIVersion')
+                rpc = client
+            except (OSError, xmlrpc.client.Error) as e:
+                warn(f'无法通过 {path} 连接 supervisord ({e}), 改用 supervisorctl')
+        _supervisor_rpc = rpc
+    return _supervisor_rpc or None
+
+
+def process_full_name(it: dict) -> str:
+    return it['name'] if it['group'] == it['name'] else f'{it["group"]}:{it["name"]}'
+
+
+def supervisor_fault(fault: xmlrpc.client.Fault) -> str:
+    # 例如: "BAD_NAME: api_server" -> BAD_NAME
+    return fault.faultString.split(':', 1)[0]
+
+
+def print_process_status(processes: List[dict]):
+    for it in processes:
+        print(f'{it["process"]:<32} {it["state"]:<9} {it["description"]}')
+
+
+def process_matches(name: str, process: str) -> bool:
+    """
+    进程名称 process 是否匹配 name: name 为 group:* 时匹配进程组中的所有进程
+    """
+    if name.endswith(':*'):
+        group = name[:-2]
+        return process == group or process.startswith(f'{group}:')
+    return process == name
+
+
+def supervisor_status(names: List[str], quiet: bool = False) -> List[dict]:
+    """
+    查询 supervisor 管理的进程的状态
+
+    Parameters
+    ----------
+    names : List[str]
+        进程名称 (进程组中的进程为 group:name, group:* 表示进程组中的所有进程)
+    quiet : bool
+        不输出状态信息, 默认: False
+
+    Returns
+    -------
+    List[dict]
+        每个进程的状态 {process, state, pid, description}, 进程不存在时 state 为 UNKNOWN
+    """
+    rpc = supervisor_rpc()
+    if rpc is None:
+        p = subprocess.run(['supervisorctl', 'status', *names], stdin = subprocess.DEVNULL,
+                           stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        all_processes = []
+        for line in p.stdout.decode('utf-8').splitlines():
+            fields = line.split(None, 2)
+            if len(fields) > 1:
+                all_processes.append({'process': fields[0], 'state': fields[1], 'pid': 0,
+                                      'description': fields[2] if len(fields) > 2 else ''})
+    else:
+        all_processes = [{'process': process_full_name(it), 'state': it['statename'], 'pid': it['pid'],
+                          'description': it['description']} for it in rpc.call('supervisor.getAllProcessInfo')]
+
+    processes: List[dict] = []
+    for name in names:
+        matched = [it for it in all_processes if process_matches(name, it['process'])]
+        if len(matched) == 0:
+            matched = [{'process': name, 'state': 'UNKNOWN', 'pid': 0, 'description': 'BAD_NAME'}]
+        processes.extend(matched)
+    if not quiet:
+        print_process_status(processes)
+    return processes
+
+
+def supervisor_wait(names: List[str], pending_states: List[str]) -> List[dict]:
+    """
+    等待进程离开 pending_states 中的状态 (例如: STARTING, STOPPING), 返回最终状态
+    """
+    delay = 0.05
+    while True:
+        processes = supervisor_status(names, quiet = True)
+        if all([it['state'] not in pending_states for it in processes]):
+            return processes
+        time.sleep(delay)
+        delay = min(delay * 1.5, 0.5)
+
+
+def supervisor_control(method: str, names: List[str]) -> List[Tuple[str, str]]:
+    """
+    对多个进程调用 startProcess/stopProcess (group:* 调用对应的 startProcessGroup/stopProcessGroup), 不等待完成,
+    所有调用合并为一次请求
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        [(进程名称, 错误名称)], 成功时错误名称为空字符串, 例如: ALREADY_STARTED, NOT_RUNNING
+    """
+    rpc = supervisor_rpc()
+    calls = [(f'supervisor.{method}Group', [name[:-2], False]) if name.endswith(':*')
+             else (f'supervisor.{method}', [name, False]) for name in names]
+    outcomes: List[Tuple[str, str]] = []
+    for name, r in zip(names, rpc.multicall(calls)):
+        if isinstance(r, xmlrpc.client.Fault):
+            outcomes.append((name, supervisor_fault(r)))
+        elif isinstance(r, list):
+            # 进程组的调用, 返回组中每个进程的结果, description 为 OK 或者 "ALREADY_STARTED: ..."
+            for it in r:
+                fault = it['description'].split(':', 1)[0]
+                outcomes.append((process_full_name(it), '' if fault == 'OK' else fault))
+        else:
+            outcomes.append((name, ''))
+    return outcomes
+
+
+def supervisor_start(names: List[str]) -> List[dict]:
+    """
+    启动多个进程: 一次请求同时启动所有进程, 再等待它们都离开 STARTING 状态 (运行时间达到 startsecs).
+    与 supervisorctl start 一样, 已经启动的进程不算失败; 有进程启动失败时抛出异常
+    """
+    if supervisor_rpc() is None:
+        shell(f'supervisorctl start {" ".join(names)}')
+        return supervisor_status(names, quiet = True)
+
+    outcomes = supervisor_control('startProcess', names)
+    for name, fault in outcomes:
+        if fault not in ['', 'ALREADY_STARTED']:
+            raise Exception(f'进程[{name}]启动失败: {fault}')
+    processes = supervisor_wait(names, ['STARTING', 'BACKOFF'])
+    for it in processes:
+        if it['state'] != 'RUNNING':
+            raise Exception(f'进程[{it["process"]}]启动失败, 状态: {it["state"]} {it["description"]}')
+    for name, fault in outcomes:
+        print(f'{name}: ERROR (already started)' if fault else f'{name}: started')
+    return processes
+
+
+def supervisor_stop(names: List[str]) -> List[dict]:
+    """
+    停止多个进程: 一次请求同时通知所有进程停止, 再等待它们都离开 STOPPING 状态. 没有运行的进程不算失败
+    """
+    if supervisor_rpc() is None:
+        shell(f'supervisorctl stop {" ".join(names)}')
+        return supervisor_status(names, quiet = True)
+
+    outcomes = supervisor_control('stopProcess', names)
+    for name, fault in outcomes:
+        if fault not in ['', 'NOT_RUNNING']:
+            raise Exception(f'进程[{name}]停止失败: {fault}')
+    processes = supervisor_wait(names, ['STOPPING'])
+    for name, fault in outcomes:
+        print(f'{name}: ERROR (not running)' if fault else f'{name}: stopped')
+    return processes
+
+
+def supervisor_signal(name: str, sig: str) -> bool:
+    """
+    向 supervisor 管理的进程发送信号, 例如: HUP. 进程不存在或者发送失败时返回 False
+    """
+    rpc = supervisor_rpc()
+    if rpc is None:
+        return shell(f'supervisorctl signal {sig} {name}') == 0
+    try:
+        rpc.call('supervisor.signalProcess', name, sig)
+        return True
+    except xmlrpc.client.Fault as e:
+        warn(f'向进程[{name}]发送信号 {sig} 失败: {e.faultString}')
+        return False
+
+
+def installed_apps(app_names: List[str]) -> List[str]:
+    apps = []
+    for app_name in app_names:
+        if app_supervisor_exists(app_name):
+            apps.append(app_name)
+        else:
+            info(f'应用服务[{app_name}]未安装')
+    return apps
+
+
+def start_apps(app_names: List[str]) -> List[dict]:
+    # 按进程组操作: 应用的所有实例一起启动, 实例数量变化后 (进程名称不同) 也不受影响
+    apps = installed_apps(app_names)
+    if len(apps) == 0:
+        return []
+    for app_name in apps:
+        record_start_state(app_name)
+    return supervisor_start([f'{app_name}:*' for app_name in apps])
+
+
+def stop_apps(app_names: List[str]) -> List[dict]:
+    apps = installed_apps(app_names)
+    if len(apps) == 0:
+        return []
+    return supervisor_stop([f'{app_name}:*' for app_name in apps])
+
+
+def status_of(app_names: List[str]) -> List[dict]:
+    apps = installed_apps(app_names)
+    if len(apps) == 0:
+        return []
+    return supervisor_status([f'{app_name}:*' for app_name in apps])
+
+
+def supervisor_state(name: str) -> str:
+    """
+    返回 supervisor 管理的进程的状态, 例如: RUNNING, STARTING, STOPPED, FATAL
+    """
+    return supervisor_status([name], quiet = True)[0]['state']
+
+
+def supervisor_programs() -> List[dict]:
+    """
+    返回 /etc/supervisor/conf.d/ 下所有配置文件中定义的 program: [{name, directory}]
+    """
+    programs: List[dict] = []
+    if not os.path.isdir(supervisor_conf_dir):
+        return programs
+    for fname in sorted(os.listdir(supervisor_conf_dir)):
+        if not fname.endswith('.conf'):
+            continue
+        parser = configparser.RawConfigParser(strict = False, inline_comment_prefixes = (';',))
+        try:
+            parser.read(os.path.join(supervisor_conf_dir, fname))
+        except configparser.Error as e:
+            warn(f'无法解析 supervisor 配置文件[{fname}]: {e}')
+            continue
+        for section in parser.sections():
+            if section.startswith('program:'):
+                programs.append({'name': section[len('program:'):],
+                                 'directory': parser.get(section, 'directory', fallback = '')})
+    return programs
+
+
+def proc_children() -> dict:
+    """
+    扫描 /proc, 返回 {ppid: [pid]}
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+    return children
+
+
+def proc_usage(pid: int, children: dict) -> dict:
+    """
+    统计进程及其所有子进程 (例如: 启动脚本启动的 java 进程) 的资源占用: 常驻内存, CPU 时间, 打开的文件描述符数量
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    clk_tck = os.sysconf('SC_CLK_TCK')
+    usage = {'rss': 0, 'cpu_secs': 0.0, 'fds': 0, 'procs': 0}
+    stack = [pid]
+    while len(stack) > 0:
+        p = stack.pop()
+        stack.extend(children.get(p, []))
+        try:
+            with open(f'/proc/{p}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{p}/statm', 'r') as f:
+                usage['rss'] += int(f.read().split()[1]) * page_size
+            usage['fds'] += len(os.listdir(f'/proc/{p}/fd'))
+        except (IOError, IndexError):
+            # 进程已经退出
+            continue
+        # fields[11], fields[12]: utime, stime (单位: clock ticks)
+        usage['cpu_secs'] += (int(fields[11]) + int(fields[12])) / clk_tck
+        usage['procs'] += 1
+    usage['cpu_secs'] = round(usage['cpu_secs'], 2)
+    return usage
+
+
+def dir_disk_usage(dir_path: str) -> int:
+    """
+    目录占用的磁盘空间 (按实际分配的块计算), 目录不存在时返回 0
+    """
+    total = 0
+    stack = [dir_path]
+    while len(stack) > 0:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks = False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks = False):
+                total += entry.stat(follow_symlinks = False).st_blocks * 512
+    return total
+
+
+def host_usage() -> dict:
+    """
+    主机的整体容量: CPU 核数, 负载, 内存, 应用目录所在文件系统的空间
+    """
+    meminfo = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    disk = shutil.disk_usage(apps_dir if os.path.isdir(apps_dir) else '/')
+    return {
+        'hostname': socket.gethostname(),
+        'cpus': os.cpu_count(),
+        'loadavg': list(os.getloadavg()),
+        'mem_total': meminfo.get('MemTotal', 0),
+        'mem_available': meminfo.get('MemAvailable', 0),
+        'disk_total': disk.total,
+        'disk_free': disk.free
+    }
+
+
+def probe_tcp(port: int) -> bool:
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout = 1):
+            return True
+    except OSError:
+        return False
+
+
+def probe_http(port: int, path: str) -> bool:
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout = 2) as resp:
+            return resp.status < 400
+    except (OSError, ValueError):
+        return False
+
+
+def probe_log(app_name: str, pattern: str, offsets: dict) -> bool:
+    """
+    在应用启动之后新写入的日志中查找指定的正则表达式
+    """
+    regex = re.compile(pattern)
+    logs_dir = f'{app_home_dir(app_name)}/logs'
+    if not os.path.isdir(logs_dir):
+        return False
+    for name in os.listdir(logs_dir):
+        fpath = os.path.join(logs_dir, name)
+        if not os.path.isfile(fpath):
+            continue
+        with open(fpath, 'rb') as f:
+            offset = offsets.get(name, 0)
+            if offset <= os.path.getsize(fpath):
+                f.seek(offset)
+            for line in f:
+                if regex.search(line.decode('utf-8', errors = 'replace')):
+                    return True
+    return False
+
+
+def tail_start_offset(fpath: str, size: int, lines: int) -> int:
+    """
+    文件中倒数第 lines 行的起始位置, 从文件末尾向前按块查找换行符, 不读取整个文件
+    """
+    if lines <= 0:
+        return size
+    pos = size
+    # 文件末尾的换行符是最后一行的结束, 不计数
+    count = -1
+    with open(fpath, 'rb') as f:
+        while pos > 0:
+            step = min(64 * 1024, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step)
+            idx = len(data)
+            while True:
+                idx = data.rfind(b'\n', 0, idx)
+                if idx < 0:
+                    break
+                count += 1
+                if count == lines:
+                    return pos + idx + 1
+    return 0
+
+
+def read_log_lines(fpath: str, start: int, budget: int, regex) -> Tuple[int, List[str]]:
+    """
+    从 start 开始读取最多 budget 字节中完整的行, 最后不完整的行留到下一次 (一行超过 budget 时按 budget 截断)
+
+    Returns
+    -------
+    Tuple[int, List[str]]
+        (读到的位置, 匹配 regex 的行)
+    """
+    with open(fpath, 'rb') as f:
+        f.seek(start)
+        data = f.read(budget)
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        if len(data) < budget:
+            return (start, [])
+        end = len(data)
+    lines = data[:end].decode('utf-8', errors = 'replace').splitlines()
+    if regex is not None:
+        lines = [line for line in lines if regex.search(line)]
+    return (start + end, lines)
+
+
+def wait_app_ready(app_name: str, process_name: str, port: int, timeout: float = None) -> float:
+    """
+    等待应用就绪: 进程处于 RUNNING 状态, 并且通过应用配置的就绪检查 (tcp 端口/http 路径/日志). 按退避间隔重试, 超时抛出异常
+
+    Returns
+    -------
+    float
+        从应用启动到就绪所用的秒数
+    """
+    profile = load_app_profile(app_name)
+    ready = profile['ready']
+    if timeout is None:
+        timeout = ready['timeout']
+    try:
+        with open(app_start_state_path(app_name), 'r') as f:
+            start_state = json.load(f)
+    except (IOError, ValueError):
+        start_state = {'time': time.time(), 'log_offsets': {}}
+
+    begin = time.time()
+    delay = 0.1
+    pending = ''
+    while True:
+        state = supervisor_state(process_name)
+        if state in ['FATAL', 'EXITED', 'BACKOFF', 'STOPPED']:
+            raise Exception(f'应用[{process_name}]启动失败, 状态: {state}')
+        if state != 'RUNNING':
+            pending = f'进程状态 {state}'
+        elif ready['tcp'] and not probe_tcp(port):
+            pending = f'端口 {port} 无法连接'
+        elif ready['http'] and not probe_http(port, ready['http']):
+            pending = f'http://127.0.0.1:{port}{ready["http"]} 未就绪'
+        elif ready['log'] and not probe_log(app_name, ready['log'], start_state['log_offsets']):
+            pending = f'日志中未出现 [{ready["log"]}]'
+        else:
+            return time.time() - start_state['time']
+        if time.time() - begin > timeout:
+            raise Exception(f'应用[{process_name}]在 {timeout}s 内没有就绪: {pending}')
+        time.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+
+
+def load_port_registry() -> dict:
+    """
+    端口登记表: 每个已部署的应用占用的端口范围 {应用名称: {"base": 起始端口, "count": 实例数量}}
+    """
+    try:
+        with open(port_registry_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_port_registry(registry: dict):
+    os.makedirs(app_profiles_dir, exist_ok = True)
+    with open(f'{port_registry_path}.tmp', 'w') as f:
+        json.dump(registry, f, indent = 2, sort_keys = True)
+    os.replace(f'{port_registry_path}.tmp', port_registry_path)
+
+
+def app_instance_count(app_name: str, instances = None) -> int:
+    """
+    应用的实例数量 (instances 默认取部署参数中的设置): auto 时, 容器的 CPU 在同一主机上的应用之间平分, 每个实例 2 核
+    """
+    if instances is None:
+        instances = load_app_profile(app_name)['instances']
+    if instances == 'auto':
+        cpus = container_cpu_limit() / len(installed_jvm_apps(app_name))
+        return max(1, int(cpus // 2))
+    return int(instances)
+
+
+def assign_app_ports(app_name: str, profile: dict = None, save: bool = True) -> Tuple[int, int]:
+    """
+    为应用的实例分配端口 (连续的一段端口), 登记到端口登记表中.
+    * 部署参数 port 为固定端口时, 使用 [port, port + 实例数量); 与其他应用的端口范围重叠时, 多实例的应用报错, 单实例只给出警告
+    * port 为 auto 时, 沿用登记过的端口范围; 没有登记过, 或者与其他应用重叠时, 从 auto_port_start 开始找一段空闲的端口
+
+    Parameters
+    ----------
+    app_name : str
+        应用服务名称
+    profile : dict
+        按该部署参数分配, 默认为保存的部署参数
+    save : bool
+        是否登记到端口登记表, 为 False 时只检查能否分配, 默认: True
+
+    Returns
+    -------
+    Tuple[int, int]
+        (起始端口, 实例数量)
+    """
+    if profile is None:
+        profile = load_app_profile(app_name)
+    port = profile['port']
+    count = app_instance_count(app_name, profile['instances'])
+    registry = load_port_registry()
+    # 引入端口登记表之前部署的应用, 按部署参数中的端口登记
+    for name in installed_jvm_apps(app_name):
+        if name not in registry and name != app_name:
+            other_port = load_app_profile(name)['port']
+            if other_port != 'auto':
+                registry[name] = {'base': int(other_port), 'count': 1}
+    others = [(it['base'], it['base'] + it['count']) for name, it in registry.items() if name != app_name]
+
+    def conflicts(base: int) -> List[str]:
+        return [name for name, it in registry.items()
+                if name != app_name and base < it['base'] + it['count'] and it['base'] < base + count]
+
+    if port == 'auto':
+        base = registry.get(app_name, {}).get('base', auto_port_start)
+        if conflicts(base):
+            base = auto_port_start
+            while conflicts(base):
+                base = max([end for start, end in others if base < end and start < base + count])
+    else:
+        base = int(port)
+        used_by = conflicts(base)
+        if used_by and count > 1:
+            raise Exception(f'应用[{app_name}]的端口 {base}-{base + count - 1} 与应用 {used_by} 的端口重叠')
+        if used_by:
+            warn(f'应用[{app_name}]的端口 {base} 与应用 {used_by} 的端口重叠')
+
+    if not save:
+        return (base, count)
+    if registry.get(app_name) != {'base': base, 'count': count}:
+        info(f'应用[{app_name}]的 {count} 个实例使用端口 {base}-{base + count - 1}')
+    registry[app_name] = {'base': base, 'count': count}
+    save_port_registry(registry)
+    return (base, count)
+
+
+def app_instances(app_name: str) -> List[Tuple[str, int]]:
+    """
+    返回应用的所有实例 [(supervisor 进程名称, 端口)]. 单实例的应用, 进程名称为应用名称;
+    多实例的应用, supervisor 的进程组为应用名称, 进程名称为 <应用名称>:<应用名称>_<端口>
+    """
+    it = load_port_registry().get(app_name)
+    if it is None:
+        # 还没有部署过 (没有分配端口)
+        port = load_app_profile(app_name)['port']
+        it = {'base': auto_port_start if port == 'auto' else int(port), 'count': 1}
+    if it['count'] == 1:
+        return [(app_name, it['base'])]
+    return [(f'{app_name}:{app_name}_{port}', port) for port in range(it['base'], it['base'] + it['count'])]
+
+
+def app_upstream_name(app_name: str) -> str:
+    return f'sz_{app_name}'
+
+
+def app_upstream_conf(app_name: str) -> str:
+    return f'{nginx_conf_dir}sz_upstream_{app_name}.conf'
+
+
+def nginx_available() -> bool:
+    return os.path.isdir(nginx_conf_dir) and shutil.which('nginx') is not None
+
+
+def write_app_upstream(app_name: str, down: List[int] = []) -> bool:
+    """
+    生成应用的 nginx upstream 配置 (upstream sz_<应用名称>), 包含应用的所有实例, down 中的端口被标记为下线.
+    nginx 配置中通过 proxy_pass http://sz_<应用名称> 转发请求, 即可支持滚动重启
+
+    Returns
+    -------
+    bool
+        配置文件内容是否有变化
+    """
+    lines: List[str] = []
+    lines.append('# 由 sz_setup.py 生成, 请勿手工修改')
+    lines.append(f'upstream {app_upstream_name(app_name)} {{')
+    for _, port in app_instances(app_name):
+        flag = ' down' if port in down else ''
+        lines.append(f'    server 127.0.0.1:{port}{flag};')
+    # 复用到应用的连接, 需要在 location 中设置 proxy_http_version 1.1 和 proxy_set_header Connection ""
+    lines.append(f'    keepalive {upstream_keepalive};')
+    lines.append('    keepalive_timeout 60s;')
+    lines.append('}')
+    content = ''.join([f'{line}\n' for line in lines])
+
+    conf_path = app_upstream_conf(app_name)
+    if os.path.exists(conf_path):
+        with open(conf_path, 'r') as f:
+            if f.read() == content:
+                return False
+    with open(f'{conf_path}.tmp', 'w') as f:
+        f.write(content)
+    os.replace(f'{conf_path}.tmp', conf_path)
+    return True
+
+
+def nginx_test() -> int:
+    ret = shell('nginx -t')
+    if ret != 0:
+        err('nginx 配置检查不通过')
+    return ret
+
+
+def nginx_signal_reload() -> int:
+    """
+    平滑重新加载 nginx 配置, 已建立的连接和正在处理的请求不受影响
+    """
+    if supervisor_signal('nginx', 'HUP'):
+        return 0
+    return shell('nginx -s reload')
+
+
+def nginx_reload() -> int:
+    """
+    检查 nginx 配置, 通过后平滑重新加载配置
+    """
+    ret = nginx_test()
+    if ret != 0:
+        return ret
+    return nginx_signal_reload()
+
+
+def nginx_transaction(staged_dir: str, installs: List[str], deletes: List[str], conf_dir: str = nginx_conf_dir) -> int:
+    """
+    以事务的方式修改 nginx 配置: 将 staged_dir 下的配置文件放入 conf_dir (默认: /etc/nginx/conf.d/), 删除 deletes 指定的配置文件,
+    然后只执行一次 nginx -t 检查全部配置. 检查通过则平滑重新加载, 不通过则将所有配置文件恢复到修改之前的状态
+
+    Parameters
+    ----------
+    staged_dir : str
+        部署端上传的新配置文件所在的临时目录
+    installs : List[str]
+        需要安装/更新的配置文件名称
+    deletes : List[str]
+        需要删除的配置文件名称
+    conf_dir : str
+        配置文件所在的目录, 例如: web 应用的配置片段所在的 /etc/nginx/sz_web/
+
+    Returns
+    -------
+    int
+        0 表示成功
+    """
+    for name in installs + deletes:
+        if '/' in name or not name.endswith('.conf'):
+            err(f'非法的 nginx 配置文件名称: [{name}]')
+            return -1
+    for name in installs:
+        if not os.path.exists(os.path.join(staged_dir, name)):
+            err(f'The nginx conf file [{os.path.join(staged_dir, name)}] does not exists.')
+            return -1
+
+    backup_dir = f'{conf_dir}.backup/{os.getpid()}-{int(time.time() * 1000)}/'
+    os.makedirs(backup_dir)
+    # 修改之前不存在的配置文件, 回滚时需要删除
+    created: List[str] = []
+    try:
+        for name in installs:
+            target = os.path.join(conf_dir, name)
+            if os.path.exists(target):
+                shutil.copy2(target, os.path.join(backup_dir, name))
+            else:
+                created.append(name)
+            os.replace(os.path.join(staged_dir, name), target)
+        for name in deletes:
+            target = os.path.join(conf_dir, name)
+            if not os.path.exists(target):
+                warn(f'指定的 nginx 配置文件: [{target}] 不存在')
+                continue
+            os.replace(target, os.path.join(backup_dir, name))
+
+        ret = nginx_test()
+        if ret != 0:
+            for name in created:
+                os.remove(os.path.join(conf_dir, name))
+            for name in os.listdir(backup_dir):
+                os.replace(os.path.join(backup_dir, name), os.path.join(conf_dir, name))
+            err('nginx 配置已回滚到修改之前的状态')
+            return ret
+        ret = nginx_signal_reload()
+        if ret == 0:
+            info(f'nginx 配置已生效: 安装/更新 {installs}, 删除 {deletes}')
+        return ret
+    finally:
+        shutil.rmtree(backup_dir, ignore_errors = True)
+        if staged_dir:
+            shutil.rmtree(staged_dir, ignore_errors = True)
+
+
+def established_connections(port: int) -> int:
+    """
+    从 /proc/net/tcp, /proc/net/tcp6 统计本机端口上已建立的 tcp 连接数量
+    """
+    count = 0
+    for fpath in ['/proc/net/tcp', '/proc/net/tcp6']:
+        if not os.path.exists(fpath):
+            continue
+        with open(fpath, 'r') as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                # fields[1]: 本地地址 ip:port (16进制), fields[3]: 连接状态, 01 为 ESTABLISHED
+                if len(fields) > 3 and fields[3] == '01' and int(fields[1].rsplit(':', 1)[1], 16) == port:
+                    count += 1
+    return count
+
+
+def wait_drained(port: int, timeout: float) -> int:
+    """
+    等待端口上已建立的连接全部结束, 超时后返回剩余的连接数量
+    """
+    begin = time.time()
+    delay = 0.1
+    remaining = established_connections(port)
+    while remaining > 0 and time.time() - begin < timeout:
+        time.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
+        remaining = established_connections(port)
+    return remaining
+
+
+def record_start_state(app_name: str):
+    # 记录启动时间和日志文件的位置, 用于就绪检查和统计就绪耗时
+    with open(app_start_state_path(app_name), 'w') as f:
+        json.dump({'time': time.time(), 'log_offsets': log_offsets(app_name)}, f)
+
+
+def rolling_restart(app_name: str) -> List[dict]:
+    """
+    逐个重启应用的实例: 从 nginx upstream 中摘除 -> 等待正在处理的请求结束 -> 重启 -> 等待就绪 -> 加回 upstream.
+    任何时刻最多只有一个实例不提供服务
+
+    Returns
+    -------
+    List[dict]
+        每个实例的重启结果
+    """
+    profile = load_app_profile(app_name)
+    instances = app_instances(app_name)
+    use_nginx = nginx_available()
+    if len(instances) < 2:
+        warn(f'应用[{app_name}]只有一个实例, 滚动重启期间无法避免服务中断')
+
+    results: List[dict] = []
+    for process_name, port in instances:
+        begin = time.time()
+        if use_nginx and len(instances) > 1:
+            write_app_upstream(app_name, down = [port])
+            nginx_reload()
+            remaining = wait_drained(port, profile['drain_timeout'])
+            if remaining > 0:
+                warn(f'实例[{process_name}]仍有 {remaining} 个连接未结束, 继续重启')
+        supervisor_stop([process_name])
+        record_start_state(app_name)
+        supervisor_start([process_name])
+        ready_secs = wait_app_ready(app_name, process_name, port)
+        if use_nginx and write_app_upstream(app_name):
+            nginx_reload()
+        info(f'实例[{process_name}]重启完毕, 启动就绪耗时 {ready_secs:.2f}s, 总耗时 {time.time() - begin:.2f}s')
+        results.append({'process': process_name, 'port': port, 'ready_secs': ready_secs})
+    return results
+
+
+def supervisord_update(restart_changed: bool = True):
+    """
+    重新读取 supervisor 的配置, 与 supervisorctl update 相同: 删除/变化的进程组先停止再移除, 新增/变化的进程组重新加入.
+    restart_changed 为 False 时 (滚动部署), 配置变化的进程组保持运行, 不重新加入, 新的配置在下一次整体重启时生效
+    """
+    rpc = supervisor_rpc()
+    if rpc is None and restart_changed:
+        shell('supervisorctl update')
         return
-    shell(f'supervisorctl status {app_name}')
 
+    if rpc is None:
+        # supervisorctl reread 的输出: <进程组>: available/changed/disappeared
+        p = subprocess.run(['supervisorctl', 'reread'], stdin = subprocess.DEVNULL,
+                           stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        for line in p.stdout.decode('utf-8', 'replace').splitlines():
+            group, _, state = line.partition(':')
+            if state.strip() == 'available':
+                shell(f'supervisorctl add {group.strip()}')
+            elif state.strip() == 'changed':
+                warn(f'进程组[{group.strip()}]的 supervisor 配置有变化, 滚动部署不重启整个进程组, 下一次非滚动重启时生效')
+        return
+
+    added, changed, removed = rpc.call('supervisor.reloadConfig')[0]
+    if not restart_changed:
+        for group in changed:
+            warn(f'进程组[{group}]的 supervisor 配置有变化, 滚动部署不重启整个进程组, 下一次非滚动重启时生效')
+        changed = []
+    calls: List[Tuple[str, list]] = []
+    for group in changed + removed:
+        calls.append(('supervisor.stopProcessGroup', [group, True]))
+        calls.append(('supervisor.removeProcessGroup', [group]))
+    for group in changed + added:
+        calls.append(('supervisor.addProcessGroup', [group]))
+    for (method, params), r in zip(calls, rpc.multicall(calls)):
+        if isinstance(r, xmlrpc.client.Fault):
+            raise Exception(f'{method}({params[0]}) 失败: {r.faultString}')
+    for group in removed:
+        print(f'{group}: removed process group')
+    for group in changed:
+        print(f'{group}: updated process group')
+    for group in added:
+        print(f'{group}: added process group')
+
+
+def file_sha256(fpath: str) -> str:
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def chunk_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size = 16).hexdigest()
+
+
+def zip_chunk_index(fpath: str) -> List[List]:
+    """
+    将 zip 文件按条目切分成块, 返回每块的 [hash, size].
+    zip 中每个条目(本地文件头+数据)为一块, 中央目录为最后一块. 相同的条目在不同的 zip 文件中偏移位置不同, 但块的内容相同,
+    所以只改动了少量条目的 zip 文件, 大部分块都可以从之前的制品中复用. 不是 zip 文件时, 按 1MB 固定大小切分.
+    部署端(sz_deploy.py)也使用本函数切分, 保证两端的切分结果一致
+    """
+    size = os.path.getsize(fpath)
+    try:
+        with zipfile.ZipFile(fpath) as zf:
+            bounds = sorted(set([it.header_offset for it in zf.infolist()] + [zf.start_dir]))
+    except (zipfile.BadZipFile, OSError):
+        bounds = list(range(0, size, 1024 * 1024))
+    bounds = sorted(set([0] + [b for b in bounds if 0 < b < size] + [size]))
+
+    index: List[List] = []
+    with open(fpath, 'rb') as f:
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            data = f.read(end - begin)
+            index.append([chunk_hash(data), end - begin])
+    return index
+
+
+def artifact_path(sha256: str) -> str:
+    return f'{artifact_store_dir}{sha256}.zip'
 
-def supervisord_update():
-    shell('supervisorctl update')
+
+def artifact_meta_path(sha256: str) -> str:
+    return f'{artifact_store_dir}{sha256}.json'
+
+
+def load_artifact_metas() -> List[dict]:
+    metas: List[dict] = []
+    for fpath in pathlib.Path(artifact_store_dir).glob('*.json'):
+        try:
+            with open(fpath, 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            continue
+        if os.path.exists(artifact_path(meta['sha256'])):
+            metas.append(meta)
+    return metas
+
+
+def save_artifact_meta(meta: dict):
+    fpath = artifact_meta_path(meta['sha256'])
+    with open(f'{fpath}.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{fpath}.tmp', fpath)
+
+
+def mark_artifact_used(sha256: str, app_name: str):
+    with open(artifact_meta_path(sha256), 'r') as f:
+        meta = json.load(f)
+    meta.setdefault('used', {})[app_name] = time.time()
+    save_artifact_meta(meta)
+
+
+def prune_artifacts(forget_app: str = None):
+    """
+    清理制品库: 每个应用只保留最近使用过的 artifact_keep 个制品, 不被任何应用保留的制品将被删除
+
+    Parameters
+    ----------
+    forget_app : str
+        应用被卸载时, 指定该应用的名称, 不再为它保留任何制品
+    """
+    metas = load_artifact_metas()
+    keep = set()
+    by_app = {}
+    for meta in metas:
+        if forget_app is not None and forget_app in meta.get('used', {}):
+            meta['used'].pop(forget_app)
+            save_artifact_meta(meta)
+        for app_name, used_time in meta.get('used', {}).items():
+            by_app.setdefault(app_name, []).append((used_time, meta['sha256']))
+    for items in by_app.values():
+        keep.update([sha256 for _, sha256 in sorted(items, reverse = True)[:artifact_keep]])
+    for meta in metas:
+        if meta['sha256'] in keep:
+            continue
+        # 刚上传还没有被安装过的制品, 保留一天
+        if len(meta.get('used', {})) == 0 and time.time() - meta.get('created', 0) < 24 * 3600:
+            continue
+        os.remove(artifact_path(meta['sha256']))
+        os.remove(artifact_meta_path(meta['sha256']))
+
+
+def cmd_artifact_plan(args: argparse.Namespace) -> dict:
+    """
+    查询制品库中是否已经存在指定 sha256 的制品. 不存在, 并且指定了 --index (部署端上传的块索引文件) 时,
+    从已有的制品中选出相同块的字节数最多的一个作为基础, 返回需要部署端上传的块的序号
+    """
+    os.makedirs(f'{artifact_store_dir}tmp', exist_ok = True)
+    if os.path.exists(artifact_path(args.sha256)) and os.path.exists(artifact_meta_path(args.sha256)):
+        return {'present': True}
+    if not args.index:
+        return {'present': False}
+
+    with open(args.index, 'r') as f:
+        index = json.load(f)
+    wanted = set([it[0] for it in index])
+    base = None
+    base_bytes = 0
+    for meta in load_artifact_metas():
+        reusable = sum([size for h, size in set([tuple(it) for it in meta['chunks']]) if h in wanted])
+        if reusable > base_bytes:
+            base = meta
+            base_bytes = reusable
+
+    have = set([it[0] for it in base['chunks']]) if base is not None else set()
+    missing = [i for i, it in enumerate(index) if it[0] not in have]
+    missing_bytes = sum([index[i][1] for i in missing])
+    info(f'制品[{args.sha256[:12]}]: 可复用 {base_bytes} bytes, 需要上传 {missing_bytes} bytes')
+    return {
+        'present': False,
+        'base': base['sha256'] if base is not None else None,
+        'missing': missing
+    }
+
+
+def cmd_artifact_assemble(args: argparse.Namespace) -> dict:
+    """
+    由基础制品中的块和部署端上传的差量文件 (缺失块按顺序拼接), 还原出新的制品, 校验 sha256 后放入制品库
+    """
+    tmp_dir = f'{artifact_store_dir}tmp/'
+    index_path = f'{tmp_dir}{args.sha256}.index.json'
+    delta_path = f'{tmp_dir}{args.sha256}.delta'
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    base_chunks = {}
+    base_file = None
+    if args.base:
+        with open(artifact_meta_path(args.base), 'r') as f:
+            base_meta = json.load(f)
+        offset = 0
+        for h, size in base_meta['chunks']:
+            base_chunks.setdefault(h, offset)
+            offset += size
+        base_file = open(artifact_path(args.base), 'rb')
+
+    out_path = f'{tmp_dir}{args.sha256}.zip'
+    h = hashlib.sha256()
+    reused = 0
+    try:
+        with open(delta_path, 'rb') as delta, open(out_path, 'wb') as out:
+            for chunk_h, size in index:
+                if chunk_h in base_chunks:
+                    base_file.seek(base_chunks[chunk_h])
+                    data = base_file.read(size)
+                    reused += size
+                else:
+                    data = delta.read(size)
+                if len(data) != size or chunk_hash(data) != chunk_h:
+                    raise Exception(f'制品[{args.sha256[:12]}]还原失败: 块[{chunk_h}]数据不完整')
+                h.update(data)
+                out.write(data)
+    finally:
+        if base_file is not None:
+            base_file.close()
+
+    if h.hexdigest() != args.sha256:
+        os.remove(out_path)
+        raise Exception(f'制品[{args.sha256[:12]}]还原失败: sha256 不一致')
+    os.replace(out_path, artifact_path(args.sha256))
+    save_artifact_meta({'sha256': args.sha256, 'chunks': index, 'created': time.time(), 'used': {}})
+    os.remove(delta_path)
+    os.remove(index_path)
+    info(f'制品[{args.sha256[:12]}]已存入制品库, 复用 {reused} bytes')
+    return {'reused_bytes': reused}
+
+
+def file_hash(fpath: str) -> str:
+    """
+    目录镜像中比较文件内容使用的 hash (blake2b, 比 sha256 快), 部署端与目标主机使用同一个实现
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_manifest(root: str, cache: dict = None) -> dict:
+    """
+    扫描目录下所有的普通文件, 生成 manifest: {相对路径: [大小, hash, 权限]}.
+
+    Parameters
+    ----------
+    root : str
+        要扫描的目录
+    cache : dict
+        上次扫描的 hash 缓存 {相对路径: [大小, mtime_ns, hash]}, 大小和修改时间都没有变化的文件不重新计算 hash.
+        扫描后被更新为本次的结果
+
+    Returns
+    -------
+    dict
+        {相对路径: [大小, hash, 权限]}, 相对路径使用 / 分隔
+    """
+    old_cache = dict(cache) if cache is not None else {}
+    if cache is not None:
+        cache.clear()
+    files = {}
+    # 目录下可能有几万个文件, 直接拼接相对路径, 不使用 os.walk + os.path.relpath
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel = rel_dir + entry.name
+                if entry.is_dir(follow_symlinks = False):
+                    pending.append(rel + '/')
+                    continue
+                if not entry.is_file(follow_symlinks = False):
+                    continue
+                st = entry.stat(follow_symlinks = False)
+                cached = old_cache.get(rel)
+                if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                    digest = cached[2]
+                else:
+                    digest = file_hash(entry.path)
+                if cache is not None:
+                    cache[rel] = [st.st_size, st.st_mtime_ns, digest]
+                files[rel] = [st.st_size, digest, stat.S_IMODE(st.st_mode)]
+    return files
+
+
+def manifest_bytes(files: dict) -> bytes:
+    """
+    manifest 的序列化格式, 部署端与目标主机使用同一个实现, 相同的内容得到相同的字节 (以及 digest)
+    """
+    return json.dumps({'version': 1, 'files': files}, sort_keys = True, separators = (',', ':')).encode('utf-8')
+
+
+def manifest_path(name: str) -> str:
+    return f'{manifests_dir}{name}.json'
+
+
+def manifest_digest(name: str) -> str:
+    fpath = manifest_path(name)
+    if not os.path.exists(fpath):
+        return None
+    return hashlib.sha256(pathlib.Path(fpath).read_bytes()).hexdigest()
+
+
+def cmd_manifest_digest(args: argparse.Namespace) -> dict:
+    """
+    返回目标主机上保存的 manifest 的 digest, 部署端据此判断本机缓存的 manifest 是否可用, 以及目录是否需要更新
+    """
+    return {'digest': manifest_digest(args.name)}
+
+
+def cmd_manifest_build(args: argparse.Namespace) -> dict:
+    """
+    扫描目录 (例如: 以前通过 rsync 部署的 web 应用), 生成 manifest. 目录不存在时生成空的 manifest
+    """
+    files = scan_manifest(args.dir) if os.path.isdir(args.dir) else {}
+    os.makedirs(manifests_dir, exist_ok = True)
+    fpath = manifest_path(args.name)
+    with open(f'{fpath}.tmp', 'wb') as f:
+        f.write(manifest_bytes(files))
+    os.replace(f'{fpath}.tmp', fpath)
+    info(f'扫描 {args.dir}, 生成 manifest: {len(files)} 个文件')
+    return {'digest': manifest_digest(args.name)}
+
+
+def owner_ids(owner: str) -> Tuple[int, int]:
+    """
+    解析 user:group, 用户/组不存在时返回 None
+    """
+    if not owner:
+        return None
+    user, _, group = owner.partition(':')
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+        gid = grp.getgrnam(group).gr_gid if group else pwd.getpwnam(user).pw_gid
+    except KeyError:
+        warn(f'用户/组 [{owner}] 不存在, 不修改文件所有者')
+        return None
+    return (uid, gid)
+
+
+def cmd_mirror_apply(args: argparse.Namespace) -> dict:
+    """
+    将部署端上传的变化文件 (一个 tar 包) 应用到目录中, 删除部署端已经删除的文件, 只修改变化的文件的所有者,
+    最后用部署端上传的新 manifest 替换旧的 manifest. 每个文件先写入临时文件再 rename, 正在被读取的文件不会读到一半的内容
+    """
+    tmp_dir = f'{manifests_dir}tmp/'
+    pack_path = f'{tmp_dir}{args.name}.tar'
+    plan_path = f'{tmp_dir}{args.name}.plan.json'
+    new_manifest_path = f'{tmp_dir}{args.name}.json'
+    with open(plan_path, 'r') as f:
+        plan = json.load(f)
+    ids = owner_ids(args.owner)
+    dest = os.path.abspath(args.dir)
+
+    def chown(fpath: str):
+        if ids is not None:
+            os.chown(fpath, ids[0], ids[1])
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+        chown(dest)
+
+    def safe_path(rel: str) -> str:
+        fpath = os.path.abspath(os.path.join(dest, rel))
+        if not fpath.startswith(dest + os.sep):
+            raise Exception(f'非法的文件路径: {rel}')
+        return fpath
+
+    written = 0
+    with tarfile.open(pack_path, 'r') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            fpath = safe_path(member.name)
+            parent = os.path.dirname(fpath)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+                # 新建的目录也需要修改所有者
+                d = parent
+                while d != dest:
+                    chown(d)
+                    d = os.path.dirname(d)
+            tmp_path = os.path.join(parent, f'.{os.path.basename(fpath)}.sz_tmp')
+            with tar.extractfile(member) as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.chmod(tmp_path, member.mode)
+            os.utime(tmp_path, (member.mtime, member.mtime))
+            chown(tmp_path)
+            os.replace(tmp_path, fpath)
+            written += 1
+
+    deleted = 0
+    parents = set()
+    for rel in plan['deleted']:
+        fpath = safe_path(rel)
+        if os.path.lexists(fpath):
+            os.remove(fpath)
+            deleted += 1
+        parents.add(os.path.dirname(fpath))
+    # 删除文件后变为空的目录
+    for d in sorted(parents, key = len, reverse = True):
+        while d != dest and os.path.isdir(d) and len(os.listdir(d)) == 0:
+            os.rmdir(d)
+            d = os.path.dirname(d)
+
+    os.replace(new_manifest_path, manifest_path(args.name))
+    os.remove(pack_path)
+    os.remove(plan_path)
+    info(f'{args.dir}: 更新 {written} 个文件, 删除 {deleted} 个文件')
+    return {'written': written, 'deleted': deleted}
 
 
 def cmd_init(args: argparse.Namespace):
@@ -242,36 +1878,306 @@ def cmd_init(args: argparse.Namespace):
     info(f'应用服务[{args.app_name}]目录初始化完毕')
 
 
-def cmd_install_zip(args: argparse.Namespace):
-    app_name = args.app_name
-    app_dir = app_home_dir(app_name)
-    zip_path = os.path.join(apps_zip_dir, f'{app_name}.zip')
-    if not os.path.exists(zip_path):
-        raise Exception(f'请先rsync应用包:[{app_name}.zip]到目录: {apps_zip_dir}')
+def cmd_prepare(args: argparse.Namespace) -> dict:
+    """
+    部署前的准备 (部署端在本机构建的同时执行): 创建各应用的目录, 版本目录和制品库的临时目录,
+    检查应用目录和制品库所在文件系统的剩余空间, 空间不足时立即失败, 不必等到上传制品时才发现.
+    应用目录和制品库位于同一个文件系统时, 两者需要的空间合并计算
+    """
+    for app_name in args.app_name:
+        os.makedirs(app_conf_dir(app_name), exist_ok = True)
+        os.makedirs(app_releases_dir(app_name), exist_ok = True)
+    os.makedirs(apps_zip_dir, exist_ok = True)
+    os.makedirs(f'{artifact_store_dir}tmp', exist_ok = True)
+
+    needs = {}
+    for path, need in [(apps_dir, args.apps_bytes), (artifact_store_dir, args.store_bytes)]:
+        dev = os.stat(path).st_dev
+        if dev in needs:
+            needs[dev][1] += need
+        else:
+            needs[dev] = [path, need]
+
+    free = {}
+    for path, need in needs.values():
+        usage = shutil.disk_usage(path)
+        free[path] = usage.free
+        if usage.free < need:
+            raise Exception(f'目录[{path}]所在文件系统的剩余空间不足: 剩余 {usage.free // 1024 // 1024} MB, '
+                            f'需要 {need // 1024 // 1024} MB')
+    info(f'应用服务 {args.app_name} 部署准备完毕, 剩余空间: ' +
+         ', '.join([f'{path} {size // 1024 // 1024} MB' for path, size in free.items()]))
+    return {'free': free}
+
+
+def extract_zip(zip_path: str, dest_dir: str, verbose: bool = False) -> Tuple[int, int]:
+    """
+    在进程内将 zip 文件以流的方式解压到 dest_dir, 不产生中间文件.
+    gradle distZip 生成的 zip 包, 所有条目都在一个顶层目录下(应用名称), 解压时去掉这一层目录.
+    保留 unix 文件权限 (例如: bin/ 下启动脚本的可执行权限) 和符号链接
+
+    Returns
+    -------
+    (int, int)
+        元组: (解压的文件数量, 解压的字节数)
+    """
+    files = 0
+    total = 0
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = zf.infolist()
+        tops = set([it.filename.split('/', 1)[0] for it in infos])
+        strip_top = len(tops) == 1 and all(['/' in it.filename for it in infos])
+        for it in infos:
+            name = it.filename.split('/', 1)[1] if strip_top else it.filename
+            if not name:
+                continue
+            parts = name.split('/')
+            if name.startswith('/') or '..' in parts:
+                raise Exception(f'zip 包中包含非法路径: [{it.filename}]')
+            target = os.path.join(dest_dir, *parts)
+            mode = (it.external_attr >> 16) & 0xFFFF if it.create_system == 3 else 0
+            if it.is_dir():
+                os.makedirs(target, exist_ok = True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            if stat.S_ISLNK(mode):
+                os.symlink(zf.read(it).decode('utf-8'), target)
+            else:
+                with zf.open(it) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                if stat.S_IMODE(mode):
+                    os.chmod(target, stat.S_IMODE(mode))
+                mtime = time.mktime(it.date_time + (0, 0, -1))
+                os.utime(target, (mtime, mtime))
+            files += 1
+            total += it.file_size
+            if verbose:
+                print(f'  {name}')
+    return (files, total)
 
-    if app_supervisor_exists(app_name):
-        is_upgrade = True
-    else:
-        is_upgrade = False
 
-    shell(f'mkdir -p {app_dir}')
-    shell(f'unzip {zip_path} -d {apps_zip_dir}')
-    rmdir(app_dir, excludes = ['logs'])
-    shell(f'mv -v {apps_zip_dir}{app_name}/* {app_dir}')
-    shell(f'rm -rf {apps_zip_dir}{app_name}')
+def release_id_of(sha256: str) -> str:
+    return sha256[:16]
+
+
+def stage_release(app_name: str, sha256: str, verbose: bool = False) -> str:
+    """
+    将制品解压到应用的版本目录 /sz/apps/<应用名称>/releases/<版本>, 不影响正在运行的版本.
+    版本目录已经存在时 (例如: 回滚到之前部署过的版本), 直接复用
+
+    Returns
+    -------
+    str
+        版本名称
+    """
+    if sha256:
+        zip_path = artifact_path(sha256)
+        if not os.path.exists(zip_path):
+            raise Exception(f'制品库中不存在制品: [{sha256}]')
+    else:
+        zip_path = os.path.join(apps_zip_dir, f'{app_name}.zip')
+        if not os.path.exists(zip_path):
+            raise Exception(f'请先rsync应用包:[{app_name}.zip]到目录: {apps_zip_dir}')
+        sha256 = file_sha256(zip_path)
+
+    release_id = release_id_of(sha256)
+    releases_dir = app_releases_dir(app_name)
+    release_dir = f'{releases_dir}{release_id}'
+    if os.path.isdir(release_dir):
+        info(f'版本[{release_id}]已经存在, 直接复用')
+        return release_id
+
+    # 解压到与应用目录在同一个文件系统的临时目录, 解压完毕后 rename 为版本目录
+    staging_dir = f'{releases_dir}.{release_id}.staging'
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    begin = time.time()
+    files, total = extract_zip(zip_path, staging_dir, verbose = verbose)
+    info(f'解压 {files} 个文件, {total} bytes, 耗时 {time.time() - begin:.2f}s')
+
+    # 版本目录下的 logs, h2db 指向各版本共用的目录
+    for name in shared_dirs:
+        link = os.path.join(staging_dir, name)
+        if not os.path.lexists(link):
+            os.symlink(f'../../{name}', link)
+    os.rename(staging_dir, release_dir)
+    return release_id
+
+
+def activate_release(app_name: str, release_id: str, rolling: bool = False):
+    """
+    将 current 符号链接原子地切换到指定的版本, 并生成配置文件. 应用需要事先停止, 切换完毕后再启动.
+    rolling 为 True 时应用保持运行, 之后由 rolling_restart 逐个重启实例, 不重新加载 supervisor 的进程组
+    """
+    app_dir = app_home_dir(app_name)
+    release_dir = f'{app_releases_dir(app_name)}{release_id}'
+    if not os.path.isdir(release_dir):
+        raise Exception(f'应用[{app_name}]的版本[{release_id}]不存在')
+
+    for name in shared_dirs:
+        os.makedirs(os.path.join(app_dir, name), exist_ok = True)
+
+    link = app_current_link(app_name)
+    tmp_link = f'{link}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(f'releases/{release_id}', tmp_link)
+    os.replace(tmp_link, link)
+
+    # 清理旧的部署方式 (应用文件直接放在应用目录下) 遗留的文件
+    rmdir(app_dir, excludes = ['releases', 'current', 'jvm.options'] + shared_dirs)
+
+    history = [it for it in app_release_history(app_name) if it != release_id] + [release_id]
+    keep = history[-release_keep:]
+    with open(f'{app_releases_dir(app_name)}history.json', 'w') as f:
+        json.dump(keep, f)
+    for name in os.listdir(app_releases_dir(app_name)):
+        path = os.path.join(app_releases_dir(app_name), name)
+        if os.path.isdir(path) and not name.startswith('.') and name not in keep:
+            shutil.rmtree(path)
+    info(f'应用[{app_name}]切换到版本[{release_id}]')
 
     # 判断 app 对应的conf/application.conf 文件是否存在, 如果不存在, 则复制当前的一套配置文件
     conf_dir = app_conf_dir(app_name)
     if not os.path.exists(f'{conf_dir}/application.conf'):
-        shell(f'cp -rvf {app_dir}/conf/* {conf_dir}')
+        shell(f'cp -rvf {release_dir}/conf/* {conf_dir}')
 
     # 生成 config_url.properties 文件
     create_config_url_prop(app_name)
+    apply_app_supervisor(app_name, rolling = rolling)
+
+
+def apply_app_supervisor(app_name: str, rolling: bool = False):
+    """
+    按当前的部署参数生成应用的 supervisor 配置和 jvm.options, 重新加载 supervisor 配置, 更新 nginx upstream
+    """
     # 生成 supervisord conf
     setup_app_supervisor(app_name)
-    supervisord_update()
-    if not is_upgrade:
-        time.sleep(5)
+    supervisord_update(restart_changed = not rolling)
+    # 生成 nginx upstream conf
+    if nginx_available() and write_app_upstream(app_name):
+        nginx_reload()
+
+
+def release_classpath(app_name: str, release_dir: str) -> List[str]:
+    """
+    从 gradle 生成的启动脚本中读取应用的 classpath ($APP_HOME 替换为版本目录的实际路径, 与运行时一致).
+    读取不到时返回空列表
+    """
+    script = os.path.join(release_dir, 'bin', app_name)
+    try:
+        with open(script, 'r') as f:
+            m = re.search(r'^CLASSPATH=(.+)$', f.read(), re.MULTILINE)
+    except IOError:
+        return []
+    if m is None:
+        return []
+    app_home = os.path.realpath(release_dir)
+    text = m.group(1).strip().strip('"').replace('${APP_HOME}', app_home).replace('$APP_HOME', app_home)
+    return [it for it in text.split(':') if it]
+
+
+def build_cds_archive(app_name: str, release_id: str) -> dict:
+    """
+    为版本生成 AppCDS 归档: JDK 自带的常用类列表 (lib/classlist) 加上应用 classpath 中所有的类, 用 -Xshare:dump 生成.
+    不需要试运行应用, 在新版本解压后 (旧版本仍在运行) 生成, 不占用重启的时间.
+    生成失败只输出警告, 应用仍然可以不使用归档启动
+    """
+    release_dir = f'{app_releases_dir(app_name)}{release_id}'
+    archive = app_cds_archive(app_name, release_id)
+    if os.path.exists(archive):
+        return {'archive': archive, 'classes': 0, 'secs': 0.0}
+    java = java_bin()
+    version = java_version()
+    if version < 11:
+        warn(f'目标主机上的 java 版本 ({version or "未找到 java"}) 不支持 AppCDS (需要 11 及以上), 跳过')
+        return {'archive': '', 'classes': 0, 'secs': 0.0}
+    classpath = release_classpath(app_name, release_dir)
+    if len(classpath) == 0:
+        warn(f'无法从启动脚本中读取应用[{app_name}]的 classpath, 跳过 AppCDS 归档')
+        return {'archive': '', 'classes': 0, 'secs': 0.0}
+
+    begin = time.time()
+    classes: List[str] = []
+    jdk_classlist = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(java))), 'lib', 'classlist')
+    if os.path.exists(jdk_classlist):
+        with open(jdk_classlist, 'r') as f:
+            classes.extend([line.split()[0] for line in f if line.strip() and not line.startswith('#') and not line.startswith('@')])
+    for jar in classpath:
+        if not jar.endswith('.jar') or not os.path.isfile(jar):
+            continue
+        with zipfile.ZipFile(jar) as zf:
+            classes.extend([name[:-len('.class')] for name in zf.namelist()
+                            if name.endswith('.class') and not name.startswith('META-INF/')
+                            and not name.endswith('module-info.class')])
+
+    os.makedirs(os.path.dirname(archive), exist_ok = True)
+    list_path = f'{archive}.classlist'
+    with open(list_path, 'w') as f:
+        f.writelines([f'{name}\n' for name in classes])
+    tmp_archive = f'{archive}.tmp'
+    p = subprocess.run([java, '-Xshare:dump', f'-XX:SharedClassListFile={list_path}',
+                        f'-XX:SharedArchiveFile={tmp_archive}', '-cp', ':'.join(classpath)],
+                       stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    os.remove(list_path)
+    if p.returncode != 0 or not os.path.exists(tmp_archive):
+        tail = p.stdout.decode('utf-8', 'replace').splitlines()[-10:]
+        warn(f'生成应用[{app_name}]的 AppCDS 归档失败 [return code: {p.returncode}]:\n' + '\n'.join(tail))
+        return {'archive': '', 'classes': len(classes), 'secs': time.time() - begin}
+    os.rename(tmp_archive, archive)
+    secs = time.time() - begin
+    info(f'生成应用[{app_name}]版本[{release_id}]的 AppCDS 归档: {len(classes)} 个类, '
+         f'{os.path.getsize(archive) // 1024 // 1024} MB, 耗时 {secs:.2f}s')
+    return {'archive': archive, 'classes': len(classes), 'secs': secs}
+
+
+def cmd_stage(args: argparse.Namespace) -> dict:
+    release_id = stage_release(args.app_name, args.sha256, verbose = args.verbose)
+    result = {'release': release_id}
+    if load_app_profile(args.app_name)['jvm']['cds']:
+        result['cds'] = build_cds_archive(args.app_name, release_id)
+    return result
+
+
+def cmd_build_cds(args: argparse.Namespace) -> dict:
+    release_id = args.release or app_current_release(args.app_name)
+    if not release_id:
+        raise Exception(f'应用[{args.app_name}]还没有部署任何版本')
+    return build_cds_archive(args.app_name, release_id)
+
+
+def cmd_activate(args: argparse.Namespace) -> dict:
+    release_id = args.release or release_id_of(args.sha256)
+    activate_release(args.app_name, release_id, rolling = args.rolling)
+    if args.sha256:
+        mark_artifact_used(args.sha256, args.app_name)
+        prune_artifacts()
+    return {'release': release_id}
+
+
+def cmd_rollback(args: argparse.Namespace) -> dict:
+    """
+    切换回上一个版本, 应用需要事先停止
+    """
+    app_name = args.app_name
+    current = app_current_release(app_name)
+    history = [it for it in app_release_history(app_name) if os.path.isdir(f'{app_releases_dir(app_name)}{it}')]
+    previous = [it for it in history if it != current]
+    if len(previous) == 0:
+        raise Exception(f'应用[{app_name}]没有可以回滚的版本')
+    activate_release(app_name, previous[-1])
+    return {'release': previous[-1]}
+
+
+def cmd_install_zip(args: argparse.Namespace):
+    """
+    解压并切换到新版本, 相当于 stage + activate
+    """
+    release_id = stage_release(args.app_name, args.sha256, verbose = args.verbose)
+    activate_release(args.app_name, release_id)
+    if args.sha256:
+        mark_artifact_used(args.sha256, args.app_name)
+        prune_artifacts()
 
 
 def cmd_install(args: argparse.Namespace):
@@ -281,11 +2187,6 @@ def cmd_install(args: argparse.Namespace):
     if not os.path.exists(app_dir):
         raise Exception('请先rsync应用到对应目录')
 
-    if app_supervisor_exists(app_name):
-        is_upgrade = True
-    else:
-        is_upgrade = False
-
     # 判断 app 对应的conf/application.conf 文件是否存在, 如果不存在, 则复制当前的一套配置文件
     conf_dir = app_conf_dir(app_name)
     if not os.path.exists(f'{conf_dir}/application.conf'):
@@ -296,8 +2197,6 @@ def cmd_install(args: argparse.Namespace):
     # 生成 supervisord conf
     setup_app_supervisor(app_name)
     supervisord_update()
-    if not is_upgrade:
-        time.sleep(5)
 
 
 def cmd_uninstall(args: argparse.Namespace):
@@ -306,32 +2205,307 @@ def cmd_uninstall(args: argparse.Namespace):
     conf_dir = app_conf_dir(app_name)
     supervisord_conf = app_supervisord_conf(app_name)
     zip_path = os.path.join(apps_zip_dir, f'{app_name}.zip')
-    stop_app(app_name)
+    stop_apps([app_name])
     shell(f'rm -rf {app_dir}')
     shell(f'rm -rf {conf_dir}')
     shell(f'rm -rf {supervisord_conf}')
     shell(f'rm -rf {zip_path}')
+    prune_artifacts(forget_app = app_name)
     supervisord_update()
+    registry = load_port_registry()
+    if registry.pop(app_name, None) is not None:
+        save_port_registry(registry)
+    update_jvm_shares(app_name)
     info(f'应用[{app_name}]删除清理完毕')
 
 
-def cmd_start(args: argparse.Namespace):
-    start_app(app_name = args.app_name)
+def cmd_start(args: argparse.Namespace) -> List[dict]:
+    return start_apps(args.app_name)
+
+
+def cmd_stop(args: argparse.Namespace) -> List[dict]:
+    return stop_apps(args.app_name)
+
+
+def cmd_wait_ready(args: argparse.Namespace) -> dict:
+    if not app_supervisor_exists(args.app_name):
+        info(f'应用服务[{args.app_name}]未安装')
+        return {'ready_secs': 0.0}
+    # 各实例同时启动, 依次等待即可, 总耗时为最慢的实例的启动耗时
+    timeout = args.timeout if args.timeout > 0 else None
+    ready_secs = 0.0
+    for process_name, port in app_instances(args.app_name):
+        ready_secs = max(ready_secs, wait_app_ready(args.app_name, process_name, port, timeout = timeout))
+    info(f'应用[{args.app_name}]已就绪, 启动耗时 {ready_secs:.2f}s')
+    return {'ready_secs': ready_secs}
+
+
+def cmd_rolling_restart(args: argparse.Namespace) -> dict:
+    if not app_supervisor_exists(args.app_name):
+        info(f'应用服务[{args.app_name}]未安装')
+        return {'instances': []}
+    return {'instances': rolling_restart(args.app_name)}
+
+
+def cmd_supervisor_conf(args: argparse.Namespace):
+    """
+    修改部署参数之后, 按新的部署参数重新生成 supervisor 配置. 应用需要事先停止;
+    --rolling 时应用保持运行, 之后由 rolling_restart 逐个重启实例
+    """
+    app_name = args.app_name
+    if not app_supervisor_exists(app_name):
+        info(f'应用服务[{app_name}]未安装')
+        return
+    release_id = app_current_release(app_name)
+    if release_id and load_app_profile(app_name)['jvm']['cds']:
+        # 已经生成过归档时直接返回
+        build_cds_archive(app_name, release_id)
+    apply_app_supervisor(app_name, rolling = args.rolling)
+
+
+def cmd_profile(args: argparse.Namespace) -> dict:
+    """
+    修改应用的部署参数, 未指定的参数保持不变
+    """
+    profile = load_app_profile(args.app_name)
+    if args.port is not None:
+        profile['port'] = args.port if args.port == 'auto' else int(args.port)
+    if args.instances is not None:
+        profile['instances'] = args.instances if args.instances == 'auto' else max(1, int(args.instances))
+    if args.startsecs is not None:
+        profile['startsecs'] = args.startsecs
+    if args.ready_tcp is not None:
+        profile['ready']['tcp'] = args.ready_tcp
+    if args.ready_http is not None:
+        profile['ready']['http'] = args.ready_http
+    if args.ready_log is not None:
+        profile['ready']['log'] = args.ready_log
+    if args.ready_timeout is not None:
+        profile['ready']['timeout'] = args.ready_timeout
+    if args.drain_timeout is not None:
+        profile['drain_timeout'] = args.drain_timeout
+    if args.port is not None or args.instances is not None:
+        # 在停止应用之前发现端口冲突
+        assign_app_ports(args.app_name, profile, save = False)
+    if args.jvm_heap is not None:
+        if args.jvm_heap != 'auto':
+            parse_size(args.jvm_heap)
+        profile['jvm']['heap'] = args.jvm_heap
+    if args.jvm_heap_percent is not None:
+        profile['jvm']['heap_percent'] = args.jvm_heap_percent
+    if args.jvm_gc is not None:
+        profile['jvm']['gc'] = args.jvm_gc
+    if args.cds is not None:
+        profile['jvm']['cds'] = args.cds
+    if args.jvm_opts is not None:
+        profile['jvm']['opts'] = args.jvm_opts
+    if args.reload_files is not None:
+        profile['reload']['files'] = args.reload_files
+    if args.reload_signal is not None:
+        profile['reload']['signal'] = args.reload_signal.upper()
+    save_app_profile(args.app_name, profile)
+    return profile
+
+
+def conf_self_reloading(fpath: str) -> bool:
+    """
+    配置文件是否会被应用自动重新加载: scan="true" 的 logback.xml, 设置了 monitorInterval 的 log4j2.xml
+    """
+    name = os.path.basename(fpath)
+    if not os.path.isfile(fpath):
+        return False
+    with open(fpath, 'r', errors = 'replace') as f:
+        head = f.read(4096)
+    if name.startswith('logback'):
+        return re.search(r'<configuration[^>]*\bscan\s*=\s*"true"', head) is not None
+    if name.startswith('log4j2'):
+        return re.search(r'<Configuration[^>]*\bmonitorInterval\s*=\s*"[1-9]', head, re.IGNORECASE) is not None
+    return False
+
+
+def cmd_conf_sync(args: argparse.Namespace) -> dict:
+    """
+    部署端将配置文件镜像到配置目录 (/sz/deploy/configs/<应用名称>) 之后, 在目标主机上将其中的配置文件 (manifest 中的文件)
+    复制到 current/conf, 不再上传两次. 然后根据变化的文件, 判断应用需要的操作 (action):
+    * none: 没有文件变化
+    * reload: 变化的文件都可以被应用重新加载, 需要时已经发送了部署参数中的信号
+    * restart: 需要重启应用
+    * not_installed: 应用还没有部署 (没有 supervisor 配置), 配置文件在应用部署后生效
+    """
+    app_name = args.app_name
+    conf_dir = app_conf_dir(app_name)
+    release_conf_dir = os.path.join(app_current_link(app_name), 'conf')
+    try:
+        with open(manifest_path(f'conf_{app_name}'), 'r') as f:
+            files = json.load(f)['files']
+    except (IOError, ValueError):
+        files = {}
+
+    copied: List[str] = []
+    if os.path.isdir(release_conf_dir):
+        for rel in sorted(files):
+            src = os.path.join(conf_dir, rel)
+            dest = os.path.join(release_conf_dir, rel)
+            if not os.path.isfile(src) or (os.path.isfile(dest) and file_hash(dest) == files[rel][1]):
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok = True)
+            shutil.copy2(src, f'{dest}.sz_tmp')
+            os.replace(f'{dest}.sz_tmp', dest)
+            copied.append(rel)
+    changed = sorted(set(args.changed) | set(copied))
+    if len(changed) == 0:
+        return {'copied': copied, 'changed': changed, 'action': 'none'}
+
+    profile = load_app_profile(app_name)
+    patterns = profile['reload']['files']
+    if not app_supervisor_exists(app_name):
+        info(f'应用服务[{app_name}]未安装, 配置文件在应用部署后生效')
+        return {'copied': copied, 'changed': changed, 'action': 'not_installed'}
+    fixed = [rel for rel in changed
+             if not any([fnmatch.fnmatch(rel, p) for p in patterns]) and not conf_self_reloading(os.path.join(conf_dir, rel))]
+    if len(fixed) > 0:
+        info(f'应用[{app_name}]的配置文件 {changed} 有变化, 需要重启')
+        return {'copied': copied, 'changed': changed, 'action': 'restart'}
+
+    sig = profile['reload']['signal']
+    if sig and any([fnmatch.fnmatch(rel, p) for rel in changed for p in patterns]):
+        for process_name, _ in app_instances(app_name):
+            if not supervisor_signal(process_name, sig):
+                return {'copied': copied, 'changed': changed, 'action': 'restart'}
+        info(f'应用[{app_name}]的配置文件 {changed} 有变化, 已发送信号 {sig} 重新加载')
+    else:
+        info(f'应用[{app_name}]的配置文件 {changed} 有变化, 由应用自行重新加载')
+    return {'copied': copied, 'changed': changed, 'action': 'reload'}
 
 
-def cmd_stop(args: argparse.Namespace):
-    stop_app(app_name = args.app_name)
+def cmd_status(args: argparse.Namespace) -> List[dict]:
+    return status_of(args.app_name)
 
 
-def cmd_status(args: argparse.Namespace):
-    status_of(args.app_name)
+def cmd_status_all(args: argparse.Namespace) -> dict:
+    """
+    主机上所有 supervisor 管理的应用 (/etc/supervisor/conf.d/) 的状态快照: 进程状态, 运行时长, pid,
+    进程 (包括子进程) 的常驻内存/CPU 时间/打开的文件描述符数量, logs 目录占用的空间; 以及主机的整体容量
+    """
+    programs = supervisor_programs()
+    directories = {it['name']: it['directory'] or app_home_dir(it['name']) for it in programs}
+    rpc = supervisor_rpc()
+    if rpc is not None:
+        infos = [it for it in rpc.call('supervisor.getAllProcessInfo') if it['group'] in directories]
+        processes = [{'process': process_full_name(it), 'group': it['group'], 'state': it['statename'],
+                      'pid': it['pid'], 'uptime': it['now'] - it['start'] if it['statename'] == 'RUNNING' else 0}
+                     for it in infos]
+    else:
+        processes = []
+        for it in supervisor_status([f'{name}:*' for name in directories], quiet = True):
+            m = re.search(r'pid (\d+)', it['description'])
+            processes.append({'process': it['process'], 'group': it['process'].split(':')[0], 'state': it['state'],
+                              'pid': int(m.group(1)) if m else 0, 'uptime': 0})
+            m = re.search(r'uptime (?:(\d+) days?, )?(\d+):(\d+):(\d+)', it['description'])
+            if m:
+                days, hours, minutes, secs = [int(v or 0) for v in m.groups()]
+                processes[-1]['uptime'] = ((days * 24 + hours) * 60 + minutes) * 60 + secs
+
+    children = proc_children()
+    log_usage = {}
+    for it in processes:
+        usage = proc_usage(it['pid'], children) if it['pid'] > 0 else {'rss': 0, 'cpu_secs': 0.0, 'fds': 0, 'procs': 0}
+        it.update(usage)
+        logs_dir = os.path.join(directories[it['group']], 'logs')
+        if logs_dir not in log_usage:
+            log_usage[logs_dir] = dir_disk_usage(logs_dir)
+        it['logs_bytes'] = log_usage[logs_dir]
+    return {'host': host_usage(), 'processes': processes}
+
+
+def cmd_nginx_apps(args: argparse.Namespace) -> dict:
+    """
+    为主机上所有已安装的应用生成/更新 nginx upstream 配置, 返回应用的 upstream 和端口, 以及 /web_html 下的 web 站点,
+    供 sz_deploy.py gen_nginx_conf 生成 server 配置. upstream 配置的变化在随后安装 server 配置时一起生效
+    """
+    apps: List[dict] = []
+    changed: List[str] = []
+    for name in sorted([it['name'] for it in supervisor_programs() if it['directory'].startswith(apps_dir)]):
+        if os.path.isdir(nginx_conf_dir) and write_app_upstream(name):
+            changed.append(name)
+        apps.append({'name': name, 'upstream': app_upstream_name(name),
+                     'ports': [port for _, port in app_instances(name)]})
+    web_apps: List[dict] = []
+    if os.path.isdir(web_apps_dir):
+        for name in sorted(os.listdir(web_apps_dir)):
+            if os.path.isdir(os.path.join(web_apps_dir, name)) and not name.startswith('.'):
+                snippet = f'{web_snippets_dir}{name}.conf'
+                web_apps.append({'name': name, 'root': os.path.join(web_apps_dir, name),
+                                 'snippet': snippet if os.path.exists(snippet) else ''})
+    return {'apps': apps, 'web_apps': web_apps, 'upstream_changed': changed}
+
+
+def cmd_tail_logs(args: argparse.Namespace) -> dict:
+    """
+    返回应用 logs 目录下日志文件中新写入的行. 部署端按应用保存每个文件上次读到的位置和 inode, 通过 --offsets 传入,
+    返回的 apps 为更新后的位置, 下一次调用只返回之后新写入的行:
+    * 第一次查看应用的日志时, 每个文件返回最后 --lines 行 (在 --grep 过滤之前计数)
+    * 按 inode 识别文件: 日志轮转后, 旧文件 (改名后, 例如 app.log.1) 中剩余的行先返回, 新文件从头返回
+    * 文件变小 (被截断) 时从头读取
+    * 每次最多读取 tail_max_bytes 字节, more 为 True 表示还有没有返回的内容
+    * --grep 在目标主机上过滤, 只有匹配的行通过网络返回
+    """
+    offsets = json.loads(args.offsets)
+    regex = re.compile(args.grep, re.IGNORECASE if args.ignore_case else 0) if args.grep else None
+    app_names = args.app_name or sorted([it['name'] for it in supervisor_programs() if it['directory'].startswith(apps_dir)])
+    budget = tail_max_bytes
+    apps = {}
+    lines: List[list] = []
+    for app_name in app_names:
+        logs_dir = f'{app_home_dir(app_name)}/logs'
+        if not os.path.isdir(logs_dir):
+            continue
+        seen = offsets.get(app_name)
+        by_inode = {it['inode']: it['offset'] for it in (seen or {}).values()}
+        candidates = []
+        for name in os.listdir(logs_dir):
+            fpath = os.path.join(logs_dir, name)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                # 列出目录之后被轮转删除的文件
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            matched = fnmatch.fnmatch(name, args.file)
+            # 不匹配的文件, 只有轮转之前读过 (inode 有记录) 并且还有剩余内容时才读取
+            if matched or by_inode.get(st.st_ino, st.st_size) < st.st_size:
+                candidates.append((st.st_mtime, name, fpath, st))
+
+        files = {}
+        for _, name, fpath, st in sorted(candidates):
+            try:
+                if st.st_ino in by_inode:
+                    start = by_inode[st.st_ino]
+                    if start > st.st_size:
+                        start = 0
+                elif seen is not None:
+                    start = 0
+                else:
+                    start = tail_start_offset(fpath, st.st_size, args.lines)
+                offset = start
+                if budget > 0 and start < st.st_size:
+                    offset, new_lines = read_log_lines(fpath, start, budget, regex)
+                    budget -= offset - start
+                    lines.extend([[app_name, name, line] for line in new_lines])
+            except OSError:
+                # 读取之前被删除的文件, 下一次调用时不再出现
+                continue
+            files[fpath] = {'inode': st.st_ino, 'offset': offset}
+        apps[app_name] = files
+    return {'apps': apps, 'lines': lines, 'more': budget <= 0}
 
 
 def cmd_test_nginx_conf(args: argparse.Namespace):
     """
     * 检查配置文件是否存在
     * 测试配置文件语法是否正确
-    * 如果测试通过, 则重启 nginx 服务
+    * 如果测试通过, 则平滑重新加载 nginx 配置
     * 如果测试不通过, 则删除该配置文件,然后退出程序
 
     Parameters
@@ -339,18 +2513,28 @@ def cmd_test_nginx_conf(args: argparse.Namespace):
         args: 命令行参数对象
 
     """
-    conf_path = os.path.join(nginx_conf_dir, args.conf)
-    if not os.path.exists(conf_path):
-        err(f'The nginx conf file [{conf_path}] does not exists.')
-        sys.exit(-1)
-    # ret = shell(f'nginx -t -c {conf_path}')
-    # if ret != 0:
-    #     # 配置文件有错误, 删除它
-    #     os.remove(conf_path)
-    # else:
-    #     # 配置文件检查通过, 重启 nginx 服务
-    #     ret = shell('supervisorctl restart nginx')
-    ret = shell('supervisorctl restart nginx')
+    for name in args.conf:
+        conf_path = os.path.join(nginx_conf_dir, name)
+        if not os.path.exists(conf_path):
+            err(f'The nginx conf file [{conf_path}] does not exists.')
+            sys.exit(-1)
+    ret = nginx_test()
+    if ret != 0:
+        # 配置文件有错误, 删除它
+        for name in args.conf:
+            os.remove(os.path.join(nginx_conf_dir, name))
+        sys.exit(ret)
+    ret = nginx_signal_reload()
+    sys.exit(ret)
+
+
+def cmd_apply_nginx_conf(args: argparse.Namespace):
+    ret = nginx_transaction(args.staged_dir, args.install, args.delete)
+    sys.exit(ret)
+
+
+def cmd_reload_nginx(args: argparse.Namespace):
+    ret = nginx_reload()
     sys.exit(ret)
 
 
@@ -362,19 +2546,148 @@ def cmd_list_nginx_conf(args: argparse.Namespace):
     info(f'\n{conf_names}')
 
 
+def cmd_delete_web_snippet(args: argparse.Namespace):
+    """
+    删除 web 应用的 nginx 配置片段 (/etc/nginx/sz_web/<应用名称>.conf), 检查通过后平滑重新加载.
+    仍然有 server 配置 include 该片段时检查不通过, 配置片段被恢复
+    """
+    name = f'{args.app_name}.conf'
+    if not os.path.exists(os.path.join(web_snippets_dir, name)):
+        return
+    ret = nginx_transaction('', [], [name], conf_dir = web_snippets_dir)
+    if ret != 0:
+        err(f'请先从 server 配置中去掉 include {web_snippets_dir}{name}')
+    sys.exit(ret)
+
+
 def cmd_delete_nginx_conf(args: argparse.Namespace):
-    # 检查配置文件是否存在
-    # 删除服务器上 /etc/nginx/conf.d/ 下的指定的配置文件
-    conf_name = args.conf
-    conf_path = os.path.join(nginx_conf_dir, conf_name)
-    if not os.path.exists(conf_path):
-        err(f'指定的 nginx 配置文件: [{conf_path}] 不存在')
-    os.remove(conf_path)
-    ret = shell('supervisorctl restart nginx')
+    # 删除服务器上 /etc/nginx/conf.d/ 下的指定的配置文件, 检查通过后平滑重新加载, 不通过则恢复
+    ret = nginx_transaction('', [], args.conf)
     sys.exit(ret)
 
 
-def main():
+class AgentLogWriter(io.TextIOBase):
+    """
+    agent 模式下, 替换 sys.stdout/sys.stderr, 将操作过程中输出的每一行, 封装成 log 消息写回给部署端
+    """
+
+    def __init__(self, agent: 'Agent'):
+        self.agent = agent
+        self.buf = ''
+
+    def writable(self):
+        return True
+
+    def write(self, s: str) -> int:
+        self.buf += s
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            self.agent.send({'type': 'log', 'line': line})
+        return len(s)
+
+    def flush(self):
+        if self.buf:
+            self.agent.send({'type': 'log', 'line': self.buf})
+            self.buf = ''
+
+
+class Agent(object):
+    """
+    常驻 agent, 通过一个 ssh 通道, 以 json 行的方式与部署端通信, 避免每个操作都启动一次 python 解释器, 建立一次 ssh 会话
+
+    请求(一行): {"id": 1, "script": "<sha256>", "ops": [{"argv": ["init", "--app-name", "api_server"]}, {"argv": [...], "check": false}]}
+    响应(多行): {"id": 1, "op": 0, "type": "log", "line": "..."}
+               {"id": 1, "op": 0, "type": "result", "cmd": "init", "code": 0, "elapsed": 0.012, "data": null}
+               {"id": 1, "type": "done", "code": 0, "script": "<sha256>"}
+
+    一批操作按顺序执行, 某个操作失败(code != 0)且 check 不为 false 时, 后续操作不再执行.
+    done 中的 script 为 agent 自身 (sz_setup.py) 的 sha256; 请求中的 script 与之不一致时 (目标主机上的 sz_setup.py 与部署端的版本不同),
+    不执行任何操作, 直接返回 {"type": "done", "code": 1, "script": "<sha256>", "mismatch": true}, 由部署端重新上传并重启 agent
+    """
+
+    def __init__(self, out: io.TextIOBase):
+        self.out = out
+        self.req_id = None
+        self.op_index = None
+        self.script_sha256 = file_sha256(os.path.realpath(__file__))
+
+    def send(self, msg: dict):
+        msg['id'] = self.req_id
+        if self.op_index is not None:
+            msg['op'] = self.op_index
+        self.out.write(json.dumps(msg, ensure_ascii = False) + '\n')
+        self.out.flush()
+
+    def run_op(self, argv: List[str]) -> Tuple[int, object]:
+        parser = build_parser()
+        code = 0
+        data = None
+        try:
+            args = parser.parse_args(argv)
+            if not args.cmd_name or args.cmd_name == 'agent':
+                raise Exception(f'agent 不支持的操作: {argv}')
+            data = cmd_actions[args.cmd_name](args)
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            else:
+                code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            err(f'{type(e).__name__}: {e}')
+            code = 1
+        return (code, data)
+
+    def handle(self, req: dict):
+        self.req_id = req.get('id')
+        if req.get('script', self.script_sha256) != self.script_sha256:
+            self.op_index = None
+            self.send({'type': 'done', 'code': 1, 'script': self.script_sha256, 'mismatch': True})
+            return
+        batch_code = 0
+        writer = AgentLogWriter(self)
+        for index, op in enumerate(req.get('ops', [])):
+            self.op_index = index
+            begin = time.time()
+            with contextlib.redirect_stdout(writer), contextlib.redirect_stderr(writer):
+                code, data = self.run_op(op['argv'])
+                writer.flush()
+            self.send({'type': 'result', 'cmd': op['argv'][0], 'code': code,
+                       'elapsed': round(time.time() - begin, 6), 'data': data})
+            if code != 0 and op.get('check', True):
+                batch_code = code
+                break
+        self.op_index = None
+        self.send({'type': 'done', 'code': batch_code, 'script': self.script_sha256})
+
+    def serve(self, inp: io.TextIOBase):
+        while True:
+            line = inp.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            self.handle(json.loads(line))
+
+
+def cmd_agent(args: argparse.Namespace):
+    agent = Agent(sys.stdout)
+    agent.serve(sys.stdin)
+
+
+def port_arg(text: str) -> str:
+    if text != 'auto' and not text.isdigit():
+        raise argparse.ArgumentTypeError(f'端口应为数字或者 auto: [{text}]')
+    return text
+
+
+def count_arg(text: str) -> str:
+    if text != 'auto' and not (text.isdigit() and int(text) > 0):
+        raise argparse.ArgumentTypeError(f'实例数量应为正整数或者 auto: [{text}]')
+    return text
+
+
+def build_parser() -> argparse.ArgumentParser:
     top_parser = argparse.ArgumentParser(description = 'SZ后端 [应用服务] 安装工具.')
 
     subcmds = top_parser.add_subparsers(title = '子命令', description = "注: 通过以下子命令指定操作类型, 详细参数用法请在子命令后加上 -h 查看",
@@ -384,53 +2697,204 @@ def main():
     init_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
                              metavar = 'api_server', required = True)
 
+    prepare_parser = subcmds.add_parser('prepare', help = '部署前创建各应用需要的目录, 并检查剩余磁盘空间')
+    prepare_parser.add_argument('--app-name', help = '应用服务名称, 可以指定多个, 必填参数',
+                                metavar = 'api_server', nargs = '+', required = True)
+    prepare_parser.add_argument('--apps-bytes', help = '应用目录 (解压新版本) 需要的剩余空间字节数', type = int, default = 0)
+    prepare_parser.add_argument('--store-bytes', help = '制品库 (存入新制品) 需要的剩余空间字节数', type = int, default = 0)
+
     install_zip_parser = subcmds.add_parser('installzip', help = '由上传/更新的应用程序的zip文件,在服务器上 部署/更新 应用服务')
     install_zip_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
                                     metavar = 'api_server', required = True)
+    install_zip_parser.add_argument('--verbose', help = '输出解压的每一个文件', action = 'store_true')
+    install_zip_parser.add_argument('--sha256', help = '从制品库安装指定 sha256 的制品, 不指定时安装 /sz/deploy/zips/<应用名称>.zip',
+                                    default = '')
+
+    stage_parser = subcmds.add_parser('stage', help = '将制品解压到新的版本目录, 不影响正在运行的版本')
+    stage_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                              metavar = 'api_server', required = True)
+    stage_parser.add_argument('--sha256', help = '制品的 sha256, 不指定时使用 /sz/deploy/zips/<应用名称>.zip',
+                              default = '')
+    stage_parser.add_argument('--verbose', help = '输出解压的每一个文件', action = 'store_true')
+
+    activate_parser = subcmds.add_parser('activate', help = '将应用切换到指定的版本, 应用需要事先停止')
+    activate_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                 metavar = 'api_server', required = True)
+    activate_parser.add_argument('--sha256', help = '切换到由该制品解压生成的版本', default = '')
+    activate_parser.add_argument('--release', help = '切换到指定名称的版本', default = '')
+    activate_parser.add_argument('--rolling', help = '应用保持运行, 之后逐个重启实例 (rolling_restart), 不重新加载进程组',
+                                 action = 'store_true')
+
+    build_cds_parser = subcmds.add_parser('build_cds', help = '为应用的版本生成 AppCDS 归档, 加快启动')
+    build_cds_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                  metavar = 'api_server', required = True)
+    build_cds_parser.add_argument('--release', help = '版本名称, 默认为当前版本', default = '')
+
+    rollback_parser = subcmds.add_parser('rollback', help = '将应用切换回上一个版本, 应用需要事先停止')
+    rollback_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                 metavar = 'api_server', required = True)
+
+    artifact_plan_parser = subcmds.add_parser('artifact_plan', help = '查询制品库中是否存在指定的制品, 并给出差量上传计划')
+    artifact_plan_parser.add_argument('--sha256', help = '制品 zip 文件的 sha256', required = True)
+    artifact_plan_parser.add_argument('--index', help = '部署端上传的块索引文件路径', default = '')
+
+    artifact_assemble_parser = subcmds.add_parser('artifact_assemble', help = '由基础制品和差量文件还原出新的制品')
+    artifact_assemble_parser.add_argument('--sha256', help = '制品 zip 文件的 sha256', required = True)
+    artifact_assemble_parser.add_argument('--base', help = '作为基础的制品的 sha256', default = '')
+
+    manifest_digest_parser = subcmds.add_parser('manifest_digest', help = '返回镜像目录的 manifest 的 digest')
+    manifest_digest_parser.add_argument('--name', help = 'manifest 名称', required = True)
+
+    manifest_build_parser = subcmds.add_parser('manifest_build', help = '扫描目录, 生成镜像目录的 manifest')
+    manifest_build_parser.add_argument('--name', help = 'manifest 名称', required = True)
+    manifest_build_parser.add_argument('--dir', help = '镜像目录', required = True)
+
+    mirror_apply_parser = subcmds.add_parser('mirror_apply', help = '将部署端上传的变化文件应用到镜像目录')
+    mirror_apply_parser.add_argument('--name', help = 'manifest 名称', required = True)
+    mirror_apply_parser.add_argument('--dir', help = '镜像目录', required = True)
+    mirror_apply_parser.add_argument('--owner', help = '变化的文件的所有者 user:group, 默认不修改', default = '')
 
     uninstall_parser = subcmds.add_parser('uninstall', help = '在服务器上 卸载 应用服务')
     uninstall_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
                                   metavar = 'api_server', required = True)
 
     start_parser = subcmds.add_parser('start', help = '在服务器上 启动 应用服务')
-    start_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
-                              metavar = 'api_server', required = True)
+    start_parser.add_argument('--app-name', help = '应用服务名称, 可以指定多个, 必填参数',
+                              metavar = 'api_server', nargs = '+', required = True)
 
     stop_parser = subcmds.add_parser('stop', help = '在服务器上 停止 应用服务')
-    stop_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
-                             metavar = 'api_server', required = True)
+    stop_parser.add_argument('--app-name', help = '应用服务名称, 可以指定多个, 必填参数',
+                             metavar = 'api_server', nargs = '+', required = True)
 
     status_parser = subcmds.add_parser('status', help = '在服务器上查看 应用服务 的状态')
-    status_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
-                               metavar = 'api_server', required = True)
+    status_parser.add_argument('--app-name', help = '应用服务名称, 可以指定多个, 必填参数',
+                               metavar = 'api_server', nargs = '+', required = True)
+
+    status_all_parser = subcmds.add_parser('status_all', help = '查看服务器上所有应用服务的状态和资源占用, 以及主机的整体容量')
+
+    tail_logs_parser = subcmds.add_parser('tail_logs', help = '返回应用日志中上次读到的位置之后新写入的行')
+    tail_logs_parser.add_argument('--app-name', help = '应用服务名称, 可以指定多个, 默认: 所有应用', nargs = '*', default = [])
+    tail_logs_parser.add_argument('--file', help = '日志文件名称的通配符, 默认: *.log', default = '*.log')
+    tail_logs_parser.add_argument('--offsets', help = '每个应用的日志文件上次读到的位置 (json)', default = '{}')
+    tail_logs_parser.add_argument('--lines', help = '第一次查看时, 每个文件返回的最后行数', type = int, default = 20)
+    tail_logs_parser.add_argument('--grep', help = '只返回匹配该正则表达式的行', default = '')
+    tail_logs_parser.add_argument('--ignore-case', help = '--grep 忽略大小写', action = 'store_true')
+
+    wait_ready_parser = subcmds.add_parser('wait_ready', help = '等待应用服务启动就绪, 输出启动耗时')
+    wait_ready_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                   metavar = 'api_server', required = True)
+    wait_ready_parser.add_argument('--timeout', help = '超时秒数, 默认使用应用部署参数中的设置',
+                                   type = float, default = 0)
+
+    profile_parser = subcmds.add_parser('profile', help = '查看/修改应用服务的部署参数')
+    profile_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                metavar = 'api_server', required = True)
+    profile_parser.add_argument('--port', help = '应用服务监听的 http 端口 (多实例时为起始端口), auto 表示自动分配',
+                                type = port_arg)
+    profile_parser.add_argument('--instances', help = '应用的实例 (进程) 数量, auto 表示按 CPU 核数计算', type = count_arg)
+    profile_parser.add_argument('--startsecs', help = 'supervisor 的 startsecs', type = int)
+    profile_parser.add_argument('--ready-tcp', help = '就绪检查: 端口可以连接', action = 'store_true', default = None)
+    profile_parser.add_argument('--no-ready-tcp', help = '就绪检查: 不检查端口', action = 'store_false', dest = 'ready_tcp')
+    profile_parser.add_argument('--ready-http', help = '就绪检查: http 路径返回成功, 例如: /api/ping, 空字符串表示不检查')
+    profile_parser.add_argument('--ready-log', help = '就绪检查: 启动后日志中出现的正则表达式, 空字符串表示不检查')
+    profile_parser.add_argument('--ready-timeout', help = '就绪检查超时秒数', type = float)
+    profile_parser.add_argument('--drain-timeout', help = '滚动重启时等待实例上的连接结束的最长秒数', type = float)
+    profile_parser.add_argument('--jvm-heap', help = 'JVM 堆大小, 例如: 512m, auto 表示按容器内存和 JVM 数量计算')
+    profile_parser.add_argument('--jvm-heap-percent', help = 'JVM 堆大小为 auto 时, 每个 JVM 分到的内存中堆所占的百分比', type = int)
+    profile_parser.add_argument('--jvm-gc', help = '垃圾回收器', choices = ['auto', 'serial', 'parallel', 'g1', 'z', 'shenandoah'])
+    profile_parser.add_argument('--cds', help = '每个版本生成 AppCDS 归档, 加快启动', action = 'store_true', default = None)
+    profile_parser.add_argument('--no-cds', help = '不使用 AppCDS 归档', action = 'store_false', dest = 'cds')
+    profile_parser.add_argument('--jvm-opts', help = '附加的 JVM 参数, 空字符串表示没有')
+    profile_parser.add_argument('--reload-files', help = '应用可以不重启就重新加载的配置文件 (通配符), 不带值表示清空', nargs = '*')
+    profile_parser.add_argument('--reload-signal', help = '只有可以重新加载的配置文件变化时发送的信号, 例如: HUP, 空字符串表示不发送')
+
+    conf_sync_parser = subcmds.add_parser('conf_sync',
+                                          help = '将配置目录中部署的配置文件同步到 current/conf, 判断是否需要重启应用')
+    conf_sync_parser.add_argument('--app-name', help = '应用服务名称,必填参数', required = True)
+    conf_sync_parser.add_argument('--changed', help = '本次部署中变化的配置文件 (相对路径)', nargs = '*', default = [])
+
+    rolling_restart_parser = subcmds.add_parser('rolling_restart', help = '逐个重启应用服务的实例, 重启期间不中断服务')
+    rolling_restart_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                        metavar = 'api_server', required = True)
+
+    supervisor_conf_parser = subcmds.add_parser('supervisor_conf', help = '修改部署参数之后, 重新生成应用的 supervisor 配置')
+    supervisor_conf_parser.add_argument('--app-name', help = '应用服务名称,必填参数',
+                                        metavar = 'api_server', required = True)
+    supervisor_conf_parser.add_argument('--rolling', help = '应用保持运行, 之后逐个重启实例 (rolling_restart), 不重新加载进程组',
+                                        action = 'store_true')
 
     test_nginx_conf_parser = subcmds.add_parser('test_nginx_conf', help = '在服务器上测试指定的 nginx 配置文件')
-    test_nginx_conf_parser.add_argument('--conf', help = 'nginx 配置文件名称', required = True)
+    test_nginx_conf_parser.add_argument('--conf', help = 'nginx 配置文件名称, 可以指定多个', nargs = '+', required = True)
+
+    apply_nginx_conf_parser = subcmds.add_parser('apply_nginx_conf',
+                                                 help = '以事务的方式安装/删除一组 nginx 配置文件, 只检查/重新加载一次, 失败时全部回滚')
+    apply_nginx_conf_parser.add_argument('--staged-dir', help = '待安装的配置文件所在的临时目录', default = '')
+    apply_nginx_conf_parser.add_argument('--install', help = '需要安装/更新的配置文件名称', nargs = '*', default = [])
+    apply_nginx_conf_parser.add_argument('--delete', help = '需要删除的配置文件名称', nargs = '*', default = [])
 
     list_nginx_conf_parser = subcmds.add_parser('list_nginx_conf', help = '列出服务器上 /etc/nginx/conf.d/ 下所有的配置文件')
 
+    nginx_apps_parser = subcmds.add_parser('nginx_apps',
+                                           help = '生成/更新所有已安装应用的 nginx upstream 配置, 返回应用端口和 web 站点列表')
+
+    reload_nginx_parser = subcmds.add_parser('reload_nginx', help = '检查 nginx 配置, 通过后平滑重新加载')
+
     delete_nginx_conf_parser = subcmds.add_parser('delete_nginx_conf', help = '删除服务器上 /etc/nginx/conf.d/ 指定名称的配置文件')
-    delete_nginx_conf_parser.add_argument('--conf', help = 'nginx 配置文件名称', required = True)
+    delete_nginx_conf_parser.add_argument('--conf', help = 'nginx 配置文件名称, 可以指定多个', nargs = '+', required = True)
+
+    delete_web_snippet_parser = subcmds.add_parser('delete_web_snippet',
+                                                   help = '删除 web 应用的 nginx 配置片段, 检查通过后平滑重新加载, 不通过则恢复')
+    delete_web_snippet_parser.add_argument('--app-name', help = 'web 应用名称', required = True)
+
+    agent_parser = subcmds.add_parser('agent', help = '以常驻 agent 方式运行, 通过 stdin/stdout 接收批量操作请求, 返回结构化的结果')
+
+    return top_parser
+
+
+cmd_actions = {
+    'init': cmd_init,
+    'prepare': cmd_prepare,
+    # 'install': cmd_install,
+    'installzip': cmd_install_zip,
+    'stage': cmd_stage,
+    'activate': cmd_activate,
+    'rollback': cmd_rollback,
+    'build_cds': cmd_build_cds,
+    'artifact_plan': cmd_artifact_plan,
+    'artifact_assemble': cmd_artifact_assemble,
+    'manifest_digest': cmd_manifest_digest,
+    'manifest_build': cmd_manifest_build,
+    'mirror_apply': cmd_mirror_apply,
+    'uninstall': cmd_uninstall,
+    'start': cmd_start,
+    'stop': cmd_stop,
+    'status': cmd_status,
+    'status_all': cmd_status_all,
+    'tail_logs': cmd_tail_logs,
+    'wait_ready': cmd_wait_ready,
+    'rolling_restart': cmd_rolling_restart,
+    'supervisor_conf': cmd_supervisor_conf,
+    'profile': cmd_profile,
+    'conf_sync': cmd_conf_sync,
+    'test_nginx_conf': cmd_test_nginx_conf,
+    'apply_nginx_conf': cmd_apply_nginx_conf,
+    'list_nginx_conf': cmd_list_nginx_conf,
+    'nginx_apps': cmd_nginx_apps,
+    'reload_nginx': cmd_reload_nginx,
+    'delete_nginx_conf': cmd_delete_nginx_conf,
+    'delete_web_snippet': cmd_delete_web_snippet,
+    'agent': cmd_agent
+}
+
 
+def main():
+    top_parser = build_parser()
     args = top_parser.parse_args()
 
     if not args.cmd_name:
         top_parser.print_help()
         sys.exit(1)
 
-    cmd_actions = {
-        'init': cmd_init,
-        # 'install': cmd_install,
-        'installzip': cmd_install_zip,
-        'uninstall': cmd_uninstall,
-        'start': cmd_start,
-        'stop': cmd_stop,
-        'status': cmd_status,
-        'test_nginx_conf': cmd_test_nginx_conf,
-        'list_nginx_conf': cmd_list_nginx_conf,
-        'delete_nginx_conf': cmd_delete_nginx_conf
-    }
-
     action = cmd_actions[args.cmd_name]
     action(args)
     sys.exit(0)